@@ -1,24 +1,69 @@
+import time
+STARTUP_T0 = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog, colorchooser
-from PIL import Image, ImageTk, ImageOps, ImageEnhance, ImageDraw, ImageFilter
+from PIL import Image, ImageTk, ImageOps, ImageEnhance, ImageFilter
 import numpy as np
-import cv2
 import os
+import sys
 import json
+import threading
 from datetime import datetime
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.colors import LinearSegmentedColormap
 import webbrowser
-import uuid
-from scipy import ndimage
-from scipy.spatial import distance
-from scipy.cluster.vq import kmeans, vq
-import pandas as pd
 from math import sqrt
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
-from collections import Counter
+from histopath_tasks import BackgroundTask
+from histopath_io import load_image, is_lazy_image, reduction_factor, cached_thumbnail, region_reader
+from histopath_export import export_overlay, needs_tiled_export, is_tiff_path, batch_export
+from histopath_metrics import (basic_metrics, points_to_um, distribution_metrics, clustering_metrics,
+                               stain_statistics, cached_result, area_mm2 as compute_area_mm2)
+from histopath_cache import result_cache, stat_file_digest
+from histopath_inference import find_model
+from histopath_service import InferenceService, region_grid
+from histopath_project import (PROJECT_VERSION, JSON_EXTENSION, BINARY_EXTENSION, PROJECT_EXTENSIONS,
+                                JSONL_EXTENSION, LABEL_IDS, points_to_columns, columns_to_points,
+                                read_project, write_project, read_annotations, write_annotations,
+                                AnnotationJournal, JOURNAL_SUFFIX, read_journal, apply_journal,
+                                discard_journal, pending_journal, project_path_in_use, free_project_path)
+from histopath_render import (FigureRenderer, build_count_distribution, build_spatial_scatter,
+                              build_color_scatter, build_color_histograms, build_color_palette,
+                              build_color_pca)
+from histopath_color import (StainDeconvolver, STAIN_FILTERS, NORMALIZE_FILTERS, normalize_image,
+                             ColorStatistics, get_normalizer, dominant_colors as find_dominant_colors)
+
+# La pila científica (matplotlib, cv2, sklearn, scipy) se importa al primer uso
+# dentro de histopath_color / histopath_render, o se precalienta en segundo plano
+# una vez que la ventana ya está visible.
+
+# Presupuesto de arranque en frío (s) hasta que la ventana queda lista
+STARTUP_BUDGET_S = float(os.environ.get("HISTOPATH_STARTUP_BUDGET", "2.0"))
+# Módulos pesados que no deben cargarse antes de mostrar la ventana
+HEAVY_MODULES = ("matplotlib", "cv2", "sklearn", "scipy", "pandas")
+# Límites de zoom; el mínimo permite ajustar láminas completas de ~100k píxeles
+MIN_ZOOM = 0.001
+MAX_ZOOM = 20.0
+# Tamaño del panel de vista general (navegador)
+NAVIGATOR_WIDTH = 300
+NAVIGATOR_HEIGHT = 200
+# Lado máximo de la vista reducida usada para estimar parámetros de imágenes perezosas
+OVERVIEW_SIZE = 2048
+
+# Autoguardado: cada cuánto se compacta el diario de ediciones en el proyecto
+AUTOSAVE_INTERVAL_MS = 60000
+AUTOSAVE_MAX_EDITS = 500
+# Cada cuánto se leen los núcleos que envía el proceso de inferencia
+INFERENCE_POLL_MS = 50
+
+
+def prewarm_scientific_stack():
+    """Importa en segundo plano los módulos pesados que usan los análisis"""
+    for module in ("numpy.linalg", "matplotlib.figure", "matplotlib.backends.backend_agg",
+                   "mpl_toolkits.mplot3d", "cv2", "sklearn.cluster"):
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
 
 class HistoPathAnalyst:
     def __init__(self, root):
@@ -94,6 +139,32 @@ class HistoPathAnalyst:
         self.show_markers = tk.BooleanVar(value=True)
         self.auto_save = tk.BooleanVar(value=False)
         self.last_save_path = None
+        # Diario de ediciones del autoguardado
+        self.journal = None
+        self.journal_generation = 0
+        # Escrituras de proyecto en segundo plano: en curso y pendientes por archivo
+        self.write_task = None
+        self.pending_writes = {}
+        # Tareas en segundo plano que leen original_image (exportación, análisis)
+        self.image_tasks = []
+        self.stain_deconvolver = StainDeconvolver()
+        # Conteo automático: modelos elegidos, proceso de inferencia y trabajo en curso
+        self.model_paths = {}
+        self.inference_service = None
+        self.inference_job = None
+        self.inference_model_name = None
+        self.inference_poll_id = None
+        # Píxeles de imagen ya analizados por el conteo en curso
+        self.inference_area_px = 0
+        self.stain_reference_path = None
+        self.figure_renderer = FigureRenderer()
+        # Revisiones de datos: claves de la caché de gráficos
+        self.image_revision = 0
+        self.viewport_stain_sources = {}
+        self.navigator_photo = None
+        self.navigator_origin = (0, 0)
+        self.navigator_scale = 1.0
+        self.annotation_revision = 0
 
         # Crear interfaz
         self.create_menu()
@@ -105,6 +176,24 @@ class HistoPathAnalyst:
         # Inicializar estado del zoom
         self.zoom_state = "fit"  # fit, 100, custom
 
+        # Medir el arranque cuando la ventana queda inactiva por primera vez
+        self.startup_time = None
+        self.startup_heavy_modules = []
+        self.root.after_idle(self._on_startup_idle)
+        self.root.after(AUTOSAVE_INTERVAL_MS, self.autosave_tick)
+        self.root.protocol("WM_DELETE_WINDOW", self.quit_app)
+
+    def _on_startup_idle(self):
+        """Mide el arranque en frío y precalienta la pila científica en segundo plano"""
+        self.startup_time = time.perf_counter() - STARTUP_T0
+        self.startup_heavy_modules = [m for m in HEAVY_MODULES if m in sys.modules]
+        if self.startup_time > STARTUP_BUDGET_S:
+            print(f"[HistoPath] Arranque en frío de {self.startup_time:.2f} s, "
+                  f"supera el presupuesto de {STARTUP_BUDGET_S:.2f} s", file=sys.stderr)
+        self.status_bar.config(text=f"Listo (arranque en {self.startup_time:.2f} s)")
+        if os.environ.get("HISTOPATH_PREWARM", "1") != "0":
+            threading.Thread(target=prewarm_scientific_stack, daemon=True).start()
+
     def create_menu(self):
         menubar = tk.Menu(self.root)
 
@@ -112,7 +201,7 @@ class HistoPathAnalyst:
         file_menu = tk.Menu(menubar, tearoff=0)
         file_menu.add_command(label="Nuevo Proyecto", command=self.new_project, accelerator="Ctrl+N")
         file_menu.add_command(label="Abrir Imagen", command=self.open_image, accelerator="Ctrl+O")
-        file_menu.add_command(label="Abrir Proyecto (.hpa)", command=self.open_project)
+        file_menu.add_command(label="Abrir Proyecto (.hpz/.hpa)", command=self.open_project)
         file_menu.add_command(label="Cargar Anotaciones (JSON)", command=self.load_annotations, accelerator="Ctrl+L")
         file_menu.add_command(label="Guardar Anotaciones (JSON)", command=self.save_annotations, accelerator="Ctrl+J")
 
@@ -122,9 +211,13 @@ class HistoPathAnalyst:
         file_menu.add_command(label="Guardar Proyecto", command=self.save_project, accelerator="Ctrl+S")
         file_menu.add_command(label="Guardar Proyecto Como...", command=self.save_project_as, accelerator="Ctrl+Shift+S")
         file_menu.add_command(label="Exportar Imagen con Marcadores", command=self.export_results)
+        file_menu.add_command(label="Exportar Lote de Imágenes con Marcadores...", command=self.batch_export_results)
         file_menu.add_command(label="Exportar Métricas", command=self.calculate_metrics)
         file_menu.add_separator()
-        file_menu.add_command(label="Salir", command=self.root.quit)
+        file_menu.add_checkbutton(label="Autoguardado", variable=self.auto_save,
+                                  command=self.toggle_auto_save)
+        file_menu.add_separator()
+        file_menu.add_command(label="Salir", command=self.quit_app)
         menubar.add_cascade(label="Archivo", menu=file_menu)
 
         # Menú Editar
@@ -154,6 +247,13 @@ class HistoPathAnalyst:
         filter_menu.add_command(label="Detectar Bordes", command=lambda: self.apply_filter("EDGE"))
         filter_menu.add_command(label="Filtro Gaussiano", command=lambda: self.apply_filter("GAUSSIAN"))
         filter_menu.add_command(label="Realce de Bordes", command=lambda: self.apply_filter("EDGE_ENHANCE"))
+        filter_menu.add_separator()
+        filter_menu.add_command(label="Canal Hematoxilina (H)", command=lambda: self.apply_filter("HEMATOXYLIN"))
+        filter_menu.add_command(label="Canal DAB (Ki-67)", command=lambda: self.apply_filter("DAB"))
+        filter_menu.add_separator()
+        filter_menu.add_command(label="Normalizar Tinción (Macenko)", command=lambda: self.apply_filter("NORMALIZE_MACENKO"))
+        filter_menu.add_command(label="Normalizar Tinción (Reinhard)", command=lambda: self.apply_filter("NORMALIZE_REINHARD"))
+        filter_menu.add_command(label="Elegir Referencia de Tinción...", command=self.choose_stain_reference)
         image_menu.add_cascade(label="Filtros", menu=filter_menu)
         image_menu.add_command(label="Restablecer Imagen", command=self.reset_image)
         menubar.add_cascade(label="Imagen", menu=image_menu)
@@ -168,6 +268,8 @@ class HistoPathAnalyst:
         tools_menu.add_command(label="Análisis de Distribución", command=self.analyze_distribution)
         tools_menu.add_command(label="Análisis de Agrupamiento", command=self.analyze_clustering)
         tools_menu.add_command(label="Análisis de Color", command=self.analyze_color)
+        tools_menu.add_separator()
+        tools_menu.add_command(label="Vaciar Caché de Resultados", command=self.clear_result_cache)
         menubar.add_cascade(label="Herramientas", menu=tools_menu)
 
         # Menú Vista
@@ -329,6 +431,11 @@ class HistoPathAnalyst:
         # --- Herramientas de zoom ---
         zoom_lf = ttk.LabelFrame(control_frame, text="Zoom y Navegación", padding=(10, 5))
         zoom_lf.pack(fill=tk.X, pady=5)
+        self.navigator = tk.Canvas(zoom_lf, width=NAVIGATOR_WIDTH, height=NAVIGATOR_HEIGHT,
+                                   bg="#2c3e50", highlightthickness=0, cursor="hand2")
+        self.navigator.pack(pady=(0, 5))
+        self.navigator.bind("<ButtonPress-1>", self.navigator_jump)
+        self.navigator.bind("<B1-Motion>", self.navigator_jump)
         zoom_frame = ttk.Frame(zoom_lf)
         zoom_frame.pack(fill=tk.X, pady=5)
         ttk.Button(zoom_frame, text="+", width=3, command=lambda: self.adjust_zoom(1.25)).pack(side=tk.LEFT, padx=2)
@@ -437,11 +544,16 @@ class HistoPathAnalyst:
     def new_project(self):
         if self.image_path and messagebox.askyesno("Nuevo Proyecto",
                                                  "¿Está seguro que desea crear un nuevo proyecto?\nSe perderán los cambios no guardados."):
+            self.release_image()
             self.image_path = None
             self.original_image = None
+            self.last_save_path = None
             self.display_image = None
             self.tk_image = None
             self.canvas.delete("all")
+            self.refresh_navigator()
+            self.cancel_inference()
+            self.close_journal()
             self.clear_markers()
             self.zoom_factor = 1.0
             self.pan_x = 0
@@ -466,8 +578,14 @@ class HistoPathAnalyst:
         if not file_path:
             return
         try:
+            image = load_image(file_path)
+            self.release_image()
             self.image_path = file_path
-            self.original_image = Image.open(file_path)
+            self.original_image = image
+            self.last_save_path = None
+            self.image_revision += 1
+            self.cancel_inference()
+            self.close_journal()
             self.clear_markers()
             self.zoom_factor = 1.0
             self.pan_x = 0
@@ -479,11 +597,12 @@ class HistoPathAnalyst:
             self.brightness_factor = 1.0
             self.contrast_factor = 1.0
             self.gamma_factor = 1.0
-            if self.original_image.mode == 'RGBA':
-                self.original_image = self.original_image.convert('RGB')
-            self.display_image = self.original_image.copy()
+            self.reset_display_image()
+            self.apply_slide_calibration()
             self.current_project_name.set(os.path.splitext(os.path.basename(file_path))[0])
             self.show_image_info()
+            # Mostrar la vista general antes de renderizar la vista principal
+            self.root.update_idletasks()
             self.zoom_fit()
             self.status_bar.config(text=f"Imagen cargada: {os.path.basename(file_path)}")
             self.add_to_recent(file_path)
@@ -494,15 +613,15 @@ class HistoPathAnalyst:
     def open_project(self):
         file_path = filedialog.askopenfilename(
             title="Abrir proyecto HistoPath Analyst",
-            filetypes=[("HistoPath Analyst Project", "*.hpa"), ("Todos los archivos", "*.*")]
+            filetypes=[("HistoPath Analyst Project", " ".join(f"*{ext}" for ext in PROJECT_EXTENSIONS)),
+                       ("Todos los archivos", "*.*")]
         )
         if not file_path:
             return
         try:
-            with open(file_path, 'r') as f:
-                project_data = json.load(f)
+            project_data, xs, ys, labels = read_project(file_path)
             version = project_data.get("version", "1.0")
-            if version != "1.3":
+            if version != PROJECT_VERSION:
                 if not messagebox.askyesno("Versión de Proyecto",
                                           f"Este proyecto fue creado con la versión {version}. "
                                           "¿Desea intentar cargarlo de todos modos?"):
@@ -515,10 +634,13 @@ class HistoPathAnalyst:
                 )
                 if not image_path:
                     return
+            image = load_image(image_path)
+            self.release_image()
             self.image_path = image_path
-            self.original_image = Image.open(self.image_path)
-            if self.original_image.mode == 'RGBA':
-                self.original_image = self.original_image.convert('RGB')
+            self.original_image = image
+            self.image_revision += 1
+            self.cancel_inference()
+            self.close_journal()
             self.clear_markers()
             self.zoom_factor = 1.0
             self.pan_x = 0
@@ -530,25 +652,21 @@ class HistoPathAnalyst:
             self.contrast_factor = project_data.get("contrast", 1.0)
             self.gamma_factor = project_data.get("gamma", 1.0)
             self.filter_type = project_data.get("filter", "NONE")
-            self.display_image = self.original_image.copy()
-            self.apply_all_transforms()
+            self.stain_reference_path = project_data.get("stain_reference")
+            self.reset_display_image()
+            self.refresh_filter()
+            # Mostrar la vista general antes de cargar anotaciones y renderizar
+            self.root.update_idletasks()
             self.calibration_scale = project_data.get("calibration_scale", 0.25)
             self.current_project_name.set(project_data.get("project_name", "Sin título"))
             self.scale_label.config(text=f"Escala: {self.calibration_scale:.4f} µm/pixel")
-            annotations = project_data.get("annotations", [])
-            label_map = {
-                1: self.ki67_points,
-                2: self.negative_points,
-                3: self.mitosis_points
-            }
-            for ann in annotations:
-                x, y, label_id = ann.get('x'), ann.get('y'), ann.get('label_id')
-                if x is not None and y is not None and label_id in label_map:
-                    label_map[label_id].append((x, y, None))
+            self.set_points_from_columns(xs, ys, labels)
             self.zoom_fit()
             self.update_all_counts()
             self.redraw_markers()
             self.show_image_info()
+            self.last_save_path = file_path
+            self.resume_journal(file_path, project_data.get("journal_generation", 0))
             self.status_bar.config(text=f"Proyecto cargado: {os.path.basename(file_path)}")
             self.add_to_recent(file_path, is_image=False)
             self.update_quick_metrics()
@@ -561,28 +679,20 @@ class HistoPathAnalyst:
             return
         file_path = filedialog.askopenfilename(
             title="Cargar archivo de anotaciones JSON",
-            filetypes=[("JSON files", "*.json"), ("Todos los archivos", "*.*")]
+            filetypes=[("JSON files", "*.json"), ("JSON Lines", f"*{JSONL_EXTENSION}"),
+                       ("Todos los archivos", "*.*")]
         )
         if not file_path:
             return
         try:
-            with open(file_path, 'r') as f:
-                annotations = json.load(f)
-            if not isinstance(annotations, list):
-                raise ValueError("El archivo JSON debe contener una lista de anotaciones.")
+            xs, ys, labels = read_annotations(file_path)
             self.clear_markers()
-            label_map = {
-                1: self.ki67_points,
-                2: self.negative_points,
-                3: self.mitosis_points
-            }
-            for ann in annotations:
-                x, y, label_id = ann.get('x'), ann.get('y'), ann.get('label_id')
-                if x is not None and y is not None and label_id in label_map:
-                    label_map[label_id].append((x, y, None))
+            self.set_points_from_columns(xs, ys, labels)
+            self.journal_batch(xs, ys, labels)
             self.update_all_counts()
             self.redraw_markers()
-            self.status_bar.config(text=f"{len(annotations)} anotaciones cargadas desde {os.path.basename(file_path)}")
+            self.status_bar.config(text=f"{len(xs)} anotaciones cargadas desde {os.path.basename(file_path)}")
+            self.compact_project()
             self.add_to_recent(file_path, is_image=False)
             self.update_quick_metrics()
             messagebox.showinfo("Éxito", "Anotaciones cargadas correctamente.")
@@ -596,20 +706,13 @@ class HistoPathAnalyst:
         file_path = filedialog.asksaveasfilename(
             title="Guardar Anotaciones como JSON",
             defaultextension=".json",
-            filetypes=[("JSON files", "*.json"), ("Todos los archivos", "*.*")]
+            filetypes=[("JSON files", "*.json"), ("JSON Lines", f"*{JSONL_EXTENSION}"),
+                       ("Todos los archivos", "*.*")]
         )
         if not file_path:
             return
         try:
-            all_annotations = []
-            for x, y, _ in self.ki67_points:
-                all_annotations.append({"x": int(x), "y": int(y), "label_id": 1})
-            for x, y, _ in self.negative_points:
-                all_annotations.append({"x": int(x), "y": int(y), "label_id": 2})
-            for x, y, _ in self.mitosis_points:
-                all_annotations.append({"x": int(x), "y": int(y), "label_id": 3})
-            with open(file_path, 'w') as f:
-                json.dump(all_annotations, f, indent=4)
+            write_annotations(file_path, *points_to_columns(self.points_by_label()))
             self.status_bar.config(text=f"Anotaciones guardadas en: {file_path}")
             self.add_to_recent(file_path, is_image=False)
             messagebox.showinfo("Guardado Exitoso", "Las anotaciones se guardaron correctamente en formato JSON.")
@@ -620,88 +723,227 @@ class HistoPathAnalyst:
         if not self.image_path:
             self.save_project_as()
             return
-        self._save_project_to_file(self.image_path.replace(os.path.splitext(self.image_path)[1], ".hpa"))
+        if self.last_save_path:
+            self._save_project_to_file(self.last_save_path)
+            return
+        file_path = os.path.splitext(self.image_path)[0] + BINARY_EXTENSION
+        if project_path_in_use(file_path):
+            # No sobrescribir sin preguntar un proyecto que no se abrió en esta sesión
+            self.save_project_as()
+        else:
+            self._save_project_to_file(file_path)
 
     def save_project_as(self):
         if not self.image_path:
             messagebox.showwarning("Proyecto Vacío", "No hay un proyecto activo para guardar.")
             return
         file_path = filedialog.asksaveasfilename(
-            defaultextension=".hpa",
-            filetypes=[("HistoPath Analyst Project", "*.hpa"), ("Todos los archivos", "*.*")]
+            defaultextension=BINARY_EXTENSION,
+            filetypes=[("Proyecto HistoPath (binario)", f"*{BINARY_EXTENSION}"),
+                       ("Proyecto HistoPath (JSON)", f"*{JSON_EXTENSION}"),
+                       ("Todos los archivos", "*.*")]
         )
         if not file_path:
             return
         self._save_project_to_file(file_path)
 
+    def project_metadata(self):
+        """Metadatos del proyecto actual (todo menos las anotaciones)"""
+        return {
+            "version": PROJECT_VERSION,
+            "project_name": self.current_project_name.get(),
+            "image_path": self.image_path,
+            "calibration_scale": self.calibration_scale,
+            "rotation": self.rotation_angle,
+            "flip_h": self.flip_horizontal,
+            "flip_v": self.flip_vertical,
+            "brightness": self.brightness_factor,
+            "contrast": self.contrast_factor,
+            "gamma": self.gamma_factor,
+            "filter": self.filter_type,
+            "stain_reference": self.stain_reference_path,
+            "marker_size": self.marker_size.get(),
+            "timestamp": datetime.now().isoformat(),
+            "journal_generation": self.journal_generation
+        }
+
     def _save_project_to_file(self, file_path):
         try:
-            all_annotations = []
-            for x, y, _ in self.ki67_points:
-                all_annotations.append({"x": int(x), "y": int(y), "label_id": 1})
-            for x, y, _ in self.negative_points:
-                all_annotations.append({"x": int(x), "y": int(y), "label_id": 2})
-            for x, y, _ in self.mitosis_points:
-                all_annotations.append({"x": int(x), "y": int(y), "label_id": 3})
-            project_data = {
-                "version": "1.3",
-                "project_name": self.current_project_name.get(),
-                "image_path": self.image_path,
-                "calibration_scale": self.calibration_scale,
-                "rotation": self.rotation_angle,
-                "flip_h": self.flip_horizontal,
-                "flip_v": self.flip_vertical,
-                "brightness": self.brightness_factor,
-                "contrast": self.contrast_factor,
-                "gamma": self.gamma_factor,
-                "filter": self.filter_type,
-                "marker_size": self.marker_size.get(),
-                "annotations": all_annotations,
-                "timestamp": datetime.now().isoformat()
-            }
-            with open(file_path, 'w') as f:
-                json.dump(project_data, f, indent=4)
+            if file_path != self.last_save_path and pending_journal(file_path):
+                messagebox.showerror("Diario sin recuperar",
+                                     f"{os.path.basename(file_path)} tiene ediciones de autoguardado sin recuperar.\n"
+                                     "Ábralo para recuperarlas o guarde el proyecto con otro nombre.")
+                return
             self.last_save_path = file_path
-            self.status_bar.config(text=f"Proyecto guardado en: {file_path}")
-            self.add_to_recent(file_path, is_image=False)
-            messagebox.showinfo("Guardado Exitoso", "El proyecto se guardó correctamente.")
+            self.status_bar.config(text=f"Guardando proyecto en: {file_path}...")
+            self.queue_project_write(file_path, self.on_project_saved)
         except Exception as e:
             messagebox.showerror("Error al Guardar", f"No se pudo guardar el proyecto:\n{str(e)}")
 
+    def on_project_saved(self, file_path, error):
+        if error:
+            messagebox.showerror("Error al Guardar", f"No se pudo guardar el proyecto:\n{str(error)}")
+            return
+        self.status_bar.config(text=f"Proyecto guardado en: {file_path}")
+        self.add_to_recent(file_path, is_image=False)
+        messagebox.showinfo("Guardado Exitoso", "El proyecto se guardó correctamente.")
+
+    def queue_project_write(self, file_path, on_saved=None):
+        """Encola una escritura del proyecto en segundo plano
+
+        La instantánea de los marcadores se toma aquí, en el hilo de Tk; la
+        serialización y la escritura atómica ocurren en un hilo de trabajo.
+        Las peticiones que llegan mientras otra escritura está en curso se
+        fusionan por archivo: solo se escribe el estado más reciente y cada
+        callback distinto se llama una vez.
+        """
+        self.journal_generation += 1
+        if self.journal and self.journal.path == file_path + JOURNAL_SUFFIX:
+            self.journal.rotate(self.journal_generation)
+        else:
+            self.close_journal()
+            if self.auto_save.get():
+                self.journal = AnnotationJournal(file_path, self.journal_generation)
+        # Copia superficial: las tuplas de los marcadores no se modifican
+        snapshot = {label_id: list(points) for label_id, points in self.points_by_label().items()}
+        callbacks = self.pending_writes.pop(file_path, (None, None, []))[2]
+        if on_saved and on_saved not in callbacks:
+            callbacks.append(on_saved)
+        self.pending_writes[file_path] = (self.project_metadata(), snapshot, callbacks)
+        self.start_next_write()
+
+    def start_next_write(self):
+        if not self.pending_writes or (self.write_task and not self.write_task.finished):
+            return
+        file_path = next(iter(self.pending_writes))
+        metadata, snapshot, callbacks = self.pending_writes.pop(file_path)
+        journal = self.journal
+        generation = metadata["journal_generation"]
+
+        def worker(task):
+            write_project(file_path, metadata, *points_to_columns(snapshot))
+
+        def finish(error):
+            if journal and not error:
+                journal.finish_rotation(generation)
+            for callback in callbacks:
+                callback(file_path, error)
+            self.start_next_write()
+
+        self.write_task = BackgroundTask(self.root, worker, on_done=lambda: finish(None), on_error=finish)
+        self.write_task.start()
+
+    def flush_project_writes(self):
+        """Espera la escritura en curso y hace las pendientes antes de salir"""
+        if self.write_task and not self.write_task.finished:
+            self.write_task.join()
+        for file_path, (metadata, snapshot, _callbacks) in list(self.pending_writes.items()):
+            write_project(file_path, metadata, *points_to_columns(snapshot))
+        self.pending_writes.clear()
+        self.close_journal()
+
+    def quit_app(self):
+        try:
+            self.flush_project_writes()
+        except Exception as e:
+            messagebox.showerror("Error al Guardar", f"No se pudo terminar de guardar el proyecto:\n{str(e)}")
+        if self.inference_service:
+            self.inference_service.close()
+        self.root.quit()
+
     def export_results(self):
         if not self.original_image:
             messagebox.showwarning("Sin Imagen", "Por favor, cargue una imagen para exportar los resultados.")
             return
         file_path = filedialog.asksaveasfilename(
             title="Exportar Imagen con Marcadores",
-            defaultextension=".png",
+            defaultextension=".tif" if needs_tiled_export(self.original_image) else ".png",
             filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg"), ("TIFF files", "*.tif"), ("Todos los archivos", "*.*")]
         )
         if not file_path:
             return
-        try:
-            result_img = self.original_image.copy().convert("RGB")
-            draw = ImageDraw.Draw(result_img)
-            radius = max(8, self.marker_size.get())
-            width = max(2, int(radius / 4))
-
-            for x, y, _ in self.ki67_points:
-                draw.ellipse([x - radius, y - radius, x + radius, y + radius],
-                             outline=self.ki67_color.get(), width=width)
-            for x, y, _ in self.mitosis_points:
-                draw.ellipse([x - radius, y - radius, x + radius, y + radius],
-                             outline=self.mitosis_color.get(), width=width)
-            for x, y, _ in self.negative_points:
-                draw.ellipse([x - radius, y - radius, x + radius, y + radius],
-                             outline=self.negative_color.get(), width=width)
-
-            result_img = self.apply_transforms_to_image(result_img)
-            result_img.save(file_path)
+        image = self.original_image
+        if needs_tiled_export(image) and not is_tiff_path(file_path):
+            if not messagebox.askyesno("Imagen Grande",
+                                       "La imagen es demasiado grande para PNG/JPEG.\n"
+                                       "¿Desea exportarla como TIFF piramidal en mosaico?"):
+                return
+            file_path = os.path.splitext(file_path)[0] + ".tif"
+        radius = max(8, self.marker_size.get())
+        width = max(2, int(radius / 4))
+        layers = []
+        for points, color in [(self.ki67_points, self.ki67_color), (self.mitosis_points, self.mitosis_color),
+                              (self.negative_points, self.negative_color)]:
+            layers.append(([p[0] for p in points], [p[1] for p in points], color.get()))
+        # La media para el contraste se fija sobre toda la imagen, no por bloque
+        contrast_mean = self.export_contrast_mean() if needs_tiled_export(image) else None
+
+        def tile_transform(tile):
+            return self.apply_transforms_to_image(tile, viewport=True, contrast_mean=contrast_mean)
+
+        def worker(task):
+            export_overlay(image, file_path, layers, radius, width,
+                           transform=self.apply_transforms_to_image, tile_transform=tile_transform,
+                           microns_per_pixel=self.calibration_scale,
+                           progress=task.progress_range(0.0, 1.0, "Exportando imagen"))
+
+        def on_progress(fraction, text):
+            self.status_bar.config(text=f"{text}... {fraction:.0%}")
+
+        def on_done():
             self.status_bar.config(text=f"Resultados exportados a: {file_path}")
             messagebox.showinfo("Exportación Exitosa", f"La imagen con los marcadores se guardó correctamente en:\n{file_path}")
-        except Exception as e:
+
+        def on_error(e):
+            self.status_bar.config(text="Error de exportación.")
             messagebox.showerror("Error de Exportación", f"No se pudo guardar la imagen:\n{str(e)}")
 
+        self.image_tasks.append(BackgroundTask(self.root, worker, on_progress=on_progress, on_done=on_done,
+                                               on_error=on_error).start())
+
+    def batch_export_results(self):
+        """Exporta las superposiciones de un directorio de imágenes con sus anotaciones"""
+        directory = filedialog.askdirectory(title="Directorio con imágenes y anotaciones (.hpz/.hpa/.json)")
+        if not directory:
+            return
+        output_dir = filedialog.askdirectory(title="Directorio de salida")
+        if not output_dir:
+            return
+        radius = max(8, self.marker_size.get())
+        colors = {LABEL_IDS['ki67']: self.ki67_color.get(), LABEL_IDS['mitosis']: self.mitosis_color.get(),
+                  LABEL_IDS['negative']: self.negative_color.get()}
+        summary = {}
+
+        def worker(task):
+            def report(done, total):
+                task.progress(done / total if total else 1.0, f"Exportando lote ({done}/{total})")
+            summary.update(batch_export(directory, output_dir, radius, colors, progress=report))
+
+        def on_progress(fraction, text):
+            self.status_bar.config(text=f"{text}... {fraction:.0%}")
+
+        def on_done():
+            text = (f"Exportadas: {summary['exported']}\nYa al día: {summary['skipped']}\n"
+                    f"Con error: {len(summary['failed'])}")
+            if summary['failed']:
+                text += "\n\n" + "\n".join(f"{name}: {error}" for name, error in summary['failed'][:10])
+            self.status_bar.config(text=f"Lote exportado en: {output_dir}")
+            messagebox.showinfo("Exportación por Lotes", text)
+
+        def on_error(e):
+            self.status_bar.config(text="Error de exportación por lotes.")
+            messagebox.showerror("Error de Exportación", f"No se pudo exportar el lote:\n{str(e)}")
+
+        BackgroundTask(self.root, worker, on_progress=on_progress, on_done=on_done, on_error=on_error).start()
+
+    def export_contrast_mean(self):
+        """Media de gris tras el brillo, estimada sobre una vista reducida (como ImageEnhance.Contrast)"""
+        image = self.original_image
+        factor = reduction_factor(OVERVIEW_SIZE / max(image.size))
+        overview = Image.fromarray(region_reader(image)((0, 0, image.width, image.height), factor))
+        overview = ImageEnhance.Brightness(overview).enhance(self.brightness_factor)
+        return int(np.asarray(overview.convert("L")).mean() + 0.5)
+
     def display_image_on_canvas(self, fit_to_screen=False):
         if not self.original_image:
             return
@@ -710,8 +952,8 @@ class HistoPathAnalyst:
         canvas_width = max(1, self.canvas.winfo_width())
         canvas_height = max(1, self.canvas.winfo_height())
 
-        # Aplicar transformaciones a la imagen
-        img_to_display = self.apply_transforms_to_image(self.display_image)
+        # display_image ya contiene las transformaciones (apply_all_transforms)
+        img_to_display = self.display_image
         img_width, img_height = img_to_display.size
 
         if fit_to_screen:
@@ -724,19 +966,24 @@ class HistoPathAnalyst:
             self.zoom_state = "fit"
 
         # Asegurar que el zoom esté dentro de límites razonables
-        self.zoom_factor = max(0.01, min(self.zoom_factor, 20.0))
+        self.zoom_factor = max(MIN_ZOOM, min(self.zoom_factor, MAX_ZOOM))
 
         # Calcular nuevas dimensiones
         new_width = max(1, int(img_width * self.zoom_factor))
         new_height = max(1, int(img_height * self.zoom_factor))
 
-        # Redimensionar imagen para display
-        display_img = img_to_display.resize((new_width, new_height), Image.LANCZOS)
-        self.tk_image = ImageTk.PhotoImage(display_img)
+        # Redimensionar imagen para display; las imágenes perezosas solo decodifican la región visible
+        origin_x, origin_y = self.pan_x, self.pan_y
+        if is_lazy_image(img_to_display):
+            display_img, origin_x, origin_y = self.render_viewport(canvas_width, canvas_height)
+        else:
+            display_img = img_to_display.resize((new_width, new_height), Image.LANCZOS)
 
         # Limpiar canvas y mostrar imagen
         self.canvas.delete("all")
-        self.canvas.create_image(self.pan_x, self.pan_y, anchor=tk.NW, image=self.tk_image, tags="image")
+        if display_img is not None:
+            self.tk_image = ImageTk.PhotoImage(display_img)
+            self.canvas.create_image(origin_x, origin_y, anchor=tk.NW, image=self.tk_image, tags="image")
 
         # Configurar región de scroll
         self.canvas.config(scrollregion=(0, 0, new_width, new_height))
@@ -748,6 +995,42 @@ class HistoPathAnalyst:
             self.draw_scale_bar()
 
         self.update_zoom_label()
+        self.update_navigator_viewport()
+        self.update_inference_viewport()
+
+    def viewport_box(self):
+        """Región visible en coordenadas de la imagen original (x0, y0, x1, y1)"""
+        image = self.original_image
+        scale_x = self.zoom_factor * self.display_image.width / image.width
+        scale_y = self.zoom_factor * self.display_image.height / image.height
+        canvas_width = max(1, self.canvas.winfo_width())
+        canvas_height = max(1, self.canvas.winfo_height())
+        x0, x1 = (min(max(0.0, (c - self.pan_x) / scale_x), image.width) for c in (0, canvas_width))
+        y0, y1 = (min(max(0.0, (c - self.pan_y) / scale_y), image.height) for c in (0, canvas_height))
+        return x0, y0, x1, y1
+
+    def update_inference_viewport(self):
+        """Durante el conteo automático, prioriza las regiones que quedaron a la vista"""
+        if self.inference_job and self.inference_service:
+            self.inference_service.set_viewport(self.viewport_box())
+
+    def render_viewport(self, canvas_width, canvas_height):
+        """Región visible de una imagen perezosa al zoom actual y su posición en el canvas"""
+        image = self.original_image
+        zoom = self.zoom_factor
+        x0 = max(0, int((0 - self.pan_x) / zoom))
+        y0 = max(0, int((0 - self.pan_y) / zoom))
+        x1 = min(image.width, int((canvas_width - self.pan_x) / zoom) + 1)
+        y1 = min(image.height, int((canvas_height - self.pan_y) / zoom) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None, 0, 0
+
+        # Leer reducido por potencias de dos y ajustar el resto con el remuestreo habitual
+        region = image.region((x0, y0, x1, y1), reduction_factor(zoom))
+        size = (max(1, round((x1 - x0) * zoom)), max(1, round((y1 - y0) * zoom)))
+        region = region.resize(size, Image.LANCZOS)
+        region = self.apply_transforms_to_image(region, viewport=True)
+        return region, self.pan_x + x0 * zoom, self.pan_y + y0 * zoom
 
     def redraw_markers(self):
         if not self.display_image or not self.original_image:
@@ -757,7 +1040,10 @@ class HistoPathAnalyst:
 
         if not self.show_markers.get():
             return
+        self.draw_markers()
 
+    def draw_markers(self, starts=(0, 0, 0)):
+        """Dibuja los marcadores visibles de cada tipo (Ki-67, mitosis, negativos) desde los índices starts"""
         # Calcular factores de escala
         scale_x = self.display_image.width / self.original_image.width
         scale_y = self.display_image.height / self.original_image.height
@@ -766,12 +1052,12 @@ class HistoPathAnalyst:
         base_radius = self.marker_size.get()
         radius = max(3, min(20, int(base_radius / self.zoom_factor)))
 
-        for points_list, color, tag in [
+        for start, (points_list, color, tag) in zip(starts, [
             (self.ki67_points, self.ki67_color.get(), "ki67_marker"),
             (self.mitosis_points, self.mitosis_color.get(), "mitosis_marker"),
             (self.negative_points, self.negative_color.get(), "negative_marker")
-        ]:
-            for i, (x, y, _) in enumerate(points_list):
+        ]):
+            for i, (x, y, _) in enumerate(points_list[start:], start):
                 # Convertir coordenadas originales a coordenadas de display
                 display_x = x * self.zoom_factor * scale_x + self.pan_x
                 display_y = y * self.zoom_factor * scale_y + self.pan_y
@@ -787,7 +1073,7 @@ class HistoPathAnalyst:
                     points_list[i] = (x, y, marker_id)
 
     def draw_scale_bar(self):
-        if not self.original_image or self.zoom_factor < 0.01 or not self.show_scale_bar.get():
+        if not self.original_image or self.zoom_factor < MIN_ZOOM or not self.show_scale_bar.get():
             return
 
         self.canvas.delete("scale_bar")
@@ -920,7 +1206,7 @@ class HistoPathAnalyst:
         # Aplicar zoom
         old_zoom = self.zoom_factor
         self.zoom_factor *= factor
-        self.zoom_factor = max(0.01, min(self.zoom_factor, 20.0))
+        self.zoom_factor = max(MIN_ZOOM, min(self.zoom_factor, MAX_ZOOM))
 
         # Ajustar pan para mantener el punto bajo el mouse
         self.pan_x = canvas_x - img_x * self.zoom_factor * scale_x
@@ -983,6 +1269,7 @@ class HistoPathAnalyst:
         target_list.append(point_data)
         self.action_history.append(('add', marker_type, point_data))
         self.redo_stack = []
+        self.journal_edit('add', marker_type, point_data)
         self.update_all_counts()
         if self.show_markers.get():
             self.redraw_markers()
@@ -1012,6 +1299,7 @@ class HistoPathAnalyst:
             self.canvas.delete(closest_marker[2])
             self.action_history.append(('delete', marker_type_str, closest_marker))
             self.redo_stack = []
+            self.journal_edit('delete', marker_type_str, closest_marker)
             self.update_all_counts()
             self.status_bar.config(text=f"Marcador eliminado en ({int(closest_marker[0])}, {int(closest_marker[1])})")
             self.update_quick_metrics()
@@ -1030,10 +1318,12 @@ class HistoPathAnalyst:
                 if point[0] == data[0] and point[1] == data[1]:
                     del target_list[i]
                     break
+            self.journal_edit('delete', marker_type, data)
             self.status_bar.config(text=f"Deshecho: Añadir marcador '{marker_type}'")
         elif action == 'delete':
             target_list = getattr(self, f"{marker_type}_points")
             target_list.append(data)
+            self.journal_edit('add', marker_type, data)
             self.status_bar.config(text=f"Deshecho: Eliminar marcador '{marker_type}'")
 
         self.update_all_counts()
@@ -1052,6 +1342,7 @@ class HistoPathAnalyst:
         if action == 'add':
             target_list = getattr(self, f"{marker_type}_points")
             target_list.append(data)
+            self.journal_edit('add', marker_type, data)
             self.status_bar.config(text=f"Rehecho: Añadir marcadores '{marker_type}'")
         elif action == 'delete':
             target_list = getattr(self, f"{marker_type}_points")
@@ -1059,6 +1350,7 @@ class HistoPathAnalyst:
                 if point[0] == data[0] and point[1] == data[1]:
                     del target_list[i]
                     break
+            self.journal_edit('delete', marker_type, data)
             self.status_bar.config(text=f"Rehecho: Eliminar marcadores '{marker_type}'")
 
         self.update_all_counts()
@@ -1092,12 +1384,107 @@ class HistoPathAnalyst:
         self.negative_points.clear()
         self.action_history = []
         self.redo_stack = []
+        self.journal_edit('clear')
         self.update_all_counts()
         if self.original_image:
             self.status_bar.config(text="Marcadores eliminados.")
         self.update_quick_metrics()
 
+    # --- Autoguardado con diario de ediciones ---
+
+    def journal_edit(self, op, marker_type=None, point=None):
+        """Añade una edición al diario de autoguardado, si está activo"""
+        if not self.journal:
+            if op != 'clear' and self.auto_save.get():
+                # Primera edición sin diario: la compactación ya la incluye
+                self.compact_project()
+            return
+        if op == 'clear':
+            self.journal.record(op)
+        else:
+            self.journal.record(op, LABEL_IDS[marker_type], point[0], point[1])
+        if self.journal.pending >= AUTOSAVE_MAX_EDITS:
+            self.compact_project()
+
+    def journal_batch(self, xs, ys, labels):
+        """Añade al diario un alta en bloque (conteo automático, importación de anotaciones)"""
+        if not self.journal:
+            if len(xs) and self.auto_save.get():
+                self.compact_project()
+            return
+        self.journal.record_batch(xs, ys, labels)
+        if self.journal.pending >= AUTOSAVE_MAX_EDITS:
+            self.compact_project()
+
+    def close_journal(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def toggle_auto_save(self):
+        if self.auto_save.get():
+            # La primera compactación crea el proyecto y su diario
+            self.compact_project()
+        else:
+            # Las ediciones ya anotadas siguen en el diario y se recuperan al abrir
+            self.close_journal()
+            self.status_bar.config(text="Autoguardado desactivado")
+
+    def autosave_tick(self):
+        """Compacta periódicamente el diario si hay ediciones pendientes"""
+        if self.journal and self.journal.pending:
+            self.compact_project()
+        self.root.after(AUTOSAVE_INTERVAL_MS, self.autosave_tick)
+
+    def compact_project(self):
+        """Compacta el diario: escribe el proyecto completo y empieza un diario nuevo
+
+        Las ediciones hechas durante la escritura van al diario nuevo.
+        """
+        if not self.auto_save.get() or not self.image_path:
+            return
+        if not self.last_save_path:
+            # Un nombre libre: nunca sobrescribir un proyecto o diario que no es de esta sesión
+            self.last_save_path = free_project_path(os.path.splitext(self.image_path)[0])
+        self.queue_project_write(self.last_save_path, self.on_autosaved)
+
+    def on_autosaved(self, file_path, error):
+        if error:
+            # .prev se conserva: la próxima compactación o apertura lo recupera
+            self.status_bar.config(text=f"Error de autoguardado: {error}")
+        else:
+            self.status_bar.config(text=f"Autoguardado: {os.path.basename(file_path)}")
+
+    def resume_journal(self, file_path, generation):
+        """Recupera las ediciones del diario no compactadas y reanuda el autoguardado"""
+        records, max_generation = read_journal(file_path, generation)
+        self.journal_generation = generation
+        recovered = apply_journal(self.points_by_label(), records)
+        if recovered:
+            # Consolidar lo recuperado con una generación posterior a todos los diarios
+            self.journal_generation = max_generation + 1
+            write_project(file_path, self.project_metadata(), *points_to_columns(self.points_by_label()))
+            discard_journal(file_path)
+            self.update_all_counts()
+            self.redraw_markers()
+            self.update_quick_metrics()
+            messagebox.showinfo("Autoguardado", f"Recuperadas {recovered} ediciones del diario no guardadas.")
+        if self.auto_save.get():
+            self.journal = AnnotationJournal(file_path, self.journal_generation)
+
+    def points_by_label(self):
+        """Listas de marcadores indexadas por el label_id de los archivos"""
+        return {LABEL_IDS['ki67']: self.ki67_points,
+                LABEL_IDS['negative']: self.negative_points,
+                LABEL_IDS['mitosis']: self.mitosis_points}
+
+    def set_points_from_columns(self, xs, ys, labels):
+        """Reemplaza los marcadores por los de unas columnas (x, y, label_id)"""
+        for label_id, points in columns_to_points(xs, ys, labels).items():
+            self.points_by_label()[label_id].extend(points)
+
     def update_all_counts(self):
+        self.annotation_revision += 1
         n_ki67 = len(self.ki67_points)
         n_mitosis = len(self.mitosis_points)
         n_negative = len(self.negative_points)
@@ -1119,9 +1506,12 @@ class HistoPathAnalyst:
         total_negative = len(self.negative_points)
         total_nuclei = total_ki67 + total_mitosis + total_negative
 
-        # Calcular área en mm²
+        # Calcular área en mm²; durante el conteo automático, solo la ya analizada
         img_width, img_height = self.original_image.size
-        area_mm2 = (img_width * self.calibration_scale) * (img_height * self.calibration_scale) / 1e6
+        area_px = img_width * img_height
+        if self.inference_job and self.inference_area_px:
+            area_px = self.inference_area_px
+        area_mm2 = area_px * self.calibration_scale ** 2 / 1e6
 
         if area_mm2 > 0:
             density = total_nuclei / area_mm2
@@ -1150,6 +1540,8 @@ class HistoPathAnalyst:
             info_text += f"Área: {area_mm2:.2f} mm²\n"
             info_text += f"Archivo: {os.path.basename(self.image_path)}\n"
             info_text += f"Tamaño: {(os.path.getsize(self.image_path) / 1024 / 1024):.2f} MB\n"
+            if is_lazy_image(self.original_image) and self.original_image.level_count > 1:
+                info_text += f"Niveles de pirámide: {self.original_image.level_count}\n"
 
             if self.rotation_angle != 0:
                 info_text += f"Rotación: {self.rotation_angle}°\n"
@@ -1233,6 +1625,8 @@ class HistoPathAnalyst:
             self.show_image_info()
 
     def rotate_image(self, angle):
+        if not self.geometry_supported():
+            return
         self.rotation_angle = (self.rotation_angle + angle) % 360
         self.apply_all_transforms()
         self.display_image_on_canvas()
@@ -1240,6 +1634,8 @@ class HistoPathAnalyst:
         self.show_image_info()
 
     def flip_image_horizontal(self):
+        if not self.geometry_supported():
+            return
         self.flip_horizontal = not self.flip_horizontal
         self.apply_all_transforms()
         self.display_image_on_canvas()
@@ -1247,6 +1643,8 @@ class HistoPathAnalyst:
         self.show_image_info()
 
     def flip_image_vertical(self):
+        if not self.geometry_supported():
+            return
         self.flip_vertical = not self.flip_vertical
         self.apply_all_transforms()
         self.display_image_on_canvas()
@@ -1254,12 +1652,57 @@ class HistoPathAnalyst:
         self.show_image_info()
 
     def apply_filter(self, filter_type):
+        if filter_type in NORMALIZE_FILTERS and not self.stain_reference_path:
+            if not self.choose_stain_reference():
+                return
+        previous_filter = self.filter_type
         self.filter_type = filter_type
-        self.apply_all_transforms()
-        self.display_image_on_canvas()
+        if not self.refresh_filter(previous_filter):
+            return
         self.status_bar.config(text=f"Filtro aplicado: {filter_type}")
         self.show_image_info()
 
+    def choose_stain_reference(self):
+        """Selecciona la imagen de referencia para la normalización de tinción"""
+        file_path = filedialog.askopenfilename(
+            title="Seleccione la imagen de referencia de tinción",
+            filetypes=[("Imágenes", "*.tif *.tiff *.jpg *.jpeg *.png *.bmp"), ("Todos los archivos", "*.*")]
+        )
+        if not file_path:
+            return False
+        previous_reference = self.stain_reference_path
+        self.stain_reference_path = file_path
+        if self.filter_type in NORMALIZE_FILTERS and self.original_image:
+            previous_filter = self.filter_type
+            if not self.refresh_filter():
+                # Volver a la referencia anterior, que sí se podía aplicar
+                self.stain_reference_path = previous_reference
+                if previous_reference:
+                    self.filter_type = previous_filter
+                    self.refresh_filter()
+                return False
+        self.status_bar.config(text=f"Referencia de tinción: {os.path.basename(file_path)}")
+        return True
+
+    def refresh_filter(self, fallback="NONE"):
+        """Aplica las transformaciones y redibuja -> False si la normalización de tinción falló
+
+        Si la estimación falla (poco tejido, referencia ilegible) se avisa y se
+        vuelve al filtro fallback, para que los redibujados siguientes no fallen.
+        """
+        try:
+            self.apply_all_transforms()
+            self.display_image_on_canvas()
+            return True
+        except (ValueError, OSError) as e:
+            if self.filter_type not in NORMALIZE_FILTERS:
+                raise
+            self.filter_type = fallback
+            self.apply_all_transforms()
+            self.display_image_on_canvas()
+            messagebox.showerror("Error de Normalización", f"No se pudo normalizar la tinción:\n{str(e)}")
+            return False
+
     def reset_image(self):
         self.brightness_factor = 1.0
         self.contrast_factor = 1.0
@@ -1269,58 +1712,119 @@ class HistoPathAnalyst:
         self.flip_vertical = False
         self.filter_type = "NONE"
         if self.original_image:
-            self.display_image = self.original_image.copy()
+            self.reset_display_image()
             self.display_image_on_canvas()
             self.status_bar.config(text="Imagen restablecida a su estado original")
             self.show_image_info()
 
+    def apply_slide_calibration(self):
+        """Usa la escala µm/píxel registrada en la lámina, si existe"""
+        mpp = getattr(self.original_image, "microns_per_pixel", None)
+        if mpp:
+            self.calibration_scale = mpp
+            self.scale_label.config(text=f"Escala: {self.calibration_scale:.4f} µm/pixel")
+
+    def reset_display_image(self):
+        """Imagen de trabajo sin transformaciones; las vistas perezosas no se copian"""
+        if is_lazy_image(self.original_image):
+            self.display_image = self.original_image
+        else:
+            self.display_image = self.original_image.copy()
+        self.refresh_navigator()
+
+    def refresh_navigator(self):
+        """Dibuja la vista general desde la miniatura en caché y el rectángulo visible"""
+        self.navigator.delete("all")
+        self.navigator_photo = None
+        if not self.original_image or not self.display_image:
+            return
+        try:
+            thumb = cached_thumbnail(self.image_path, self.original_image)
+        except Exception as e:
+            self.status_bar.config(text=f"No se pudo generar la vista general: {e}")
+            return
+        thumb = self.apply_transforms_to_image(thumb, viewport=is_lazy_image(self.original_image))
+        thumb.thumbnail((NAVIGATOR_WIDTH, NAVIGATOR_HEIGHT), Image.LANCZOS)
+        self.navigator_photo = ImageTk.PhotoImage(thumb)
+        self.navigator_origin = ((NAVIGATOR_WIDTH - thumb.width) / 2, (NAVIGATOR_HEIGHT - thumb.height) / 2)
+        self.navigator_scale = thumb.width / self.display_image.width
+        self.navigator.create_image(*self.navigator_origin, anchor=tk.NW, image=self.navigator_photo)
+        self.update_navigator_viewport()
+
+    def update_navigator_viewport(self):
+        """Actualiza el rectángulo de la región visible en la vista general"""
+        self.navigator.delete("viewport")
+        if not self.navigator_photo:
+            return
+        ox, oy = self.navigator_origin
+        scale = self.navigator_scale / self.zoom_factor
+        right = ox + self.navigator_photo.width()
+        bottom = oy + self.navigator_photo.height()
+        x0 = max(ox, ox - self.pan_x * scale)
+        y0 = max(oy, oy - self.pan_y * scale)
+        x1 = min(right, ox + (self.canvas.winfo_width() - self.pan_x) * scale)
+        y1 = min(bottom, oy + (self.canvas.winfo_height() - self.pan_y) * scale)
+        if x1 > x0 and y1 > y0:
+            self.navigator.create_rectangle(x0, y0, x1, y1, outline=self.accent_color,
+                                            width=2, tags="viewport")
+
+    def navigator_jump(self, event):
+        """Centra la vista principal en el punto pulsado de la vista general"""
+        if not self.navigator_photo:
+            return
+        ox, oy = self.navigator_origin
+        img_x = (event.x - ox) / self.navigator_scale
+        img_y = (event.y - oy) / self.navigator_scale
+        self.pan_x = self.canvas.winfo_width() / 2 - img_x * self.zoom_factor
+        self.pan_y = self.canvas.winfo_height() / 2 - img_y * self.zoom_factor
+        self.display_image_on_canvas()
+
     def apply_all_transforms(self):
         if not self.original_image:
             return
-        img = self.original_image.copy()
-        if self.rotation_angle != 0:
-            img = img.rotate(-self.rotation_angle, expand=True)
-        if self.flip_horizontal:
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_vertical:
-            img = img.transpose(Image.FLIP_TOP_BOTTOM)
-        enhancer = ImageEnhance.Brightness(img)
-        img = enhancer.enhance(self.brightness_factor)
-        enhancer = ImageEnhance.Contrast(img)
-        img = enhancer.enhance(self.contrast_factor)
-        if self.gamma_factor != 1.0:
-            img = self.apply_gamma(img, self.gamma_factor)
-        if self.filter_type == "BLUR":
-            img = img.filter(ImageFilter.BLUR)
-        elif self.filter_type == "SHARPEN":
-            img = img.filter(ImageFilter.SHARPEN)
-        elif self.filter_type == "EDGE":
-            img = img.filter(ImageFilter.FIND_EDGES)
-        elif self.filter_type == "GAUSSIAN":
-            img = img.filter(ImageFilter.GaussianBlur(radius=2))
-        elif self.filter_type == "EDGE_ENHANCE":
-            img = img.filter(ImageFilter.EDGE_ENHANCE)
-        self.display_image = img
+        if is_lazy_image(self.original_image):
+            # En imágenes perezosas las transformaciones se aplican a la región visible
+            self.display_image = self.original_image
+        else:
+            self.display_image = self.apply_transforms_to_image(self.original_image)
+        self.refresh_navigator()
         self.show_image_info()
 
+    def geometry_supported(self):
+        """Rotar o voltear requiere la imagen completa; no disponible en imágenes perezosas"""
+        if is_lazy_image(self.original_image):
+            self.status_bar.config(text="Rotar y voltear no está disponible en imágenes grandes")
+            return False
+        return True
+
     def apply_gamma(self, image, gamma):
         np_img = np.array(image)
         np_img = np.power(np_img / 255.0, gamma) * 255.0
         np_img = np.clip(np_img, 0, 255).astype(np.uint8)
         return Image.fromarray(np_img)
 
-    def apply_transforms_to_image(self, image):
+    def apply_transforms_to_image(self, image, viewport=False, contrast_mean=None):
+        """Aplica las transformaciones activas; con viewport=True solo las de color a una región visible
+
+        contrast_mean fija la media de gris del contraste, para que los bloques
+        de una misma imagen usen la de la imagen completa.
+        """
         img = image.copy()
-        if self.rotation_angle != 0:
-            img = img.rotate(-self.rotation_angle, expand=True)
-        if self.flip_horizontal:
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_vertical:
-            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        if not viewport:
+            if self.rotation_angle != 0:
+                img = img.rotate(-self.rotation_angle, expand=True)
+            if self.flip_horizontal:
+                img = img.transpose(Image.FLIP_LEFT_RIGHT)
+            if self.flip_vertical:
+                img = img.transpose(Image.FLIP_TOP_BOTTOM)
         enhancer = ImageEnhance.Brightness(img)
         img = enhancer.enhance(self.brightness_factor)
-        enhancer = ImageEnhance.Contrast(img)
-        img = enhancer.enhance(self.contrast_factor)
+        if contrast_mean is None:
+            enhancer = ImageEnhance.Contrast(img)
+            img = enhancer.enhance(self.contrast_factor)
+        else:
+            degenerate = Image.new("L", img.size, contrast_mean).convert(img.mode)
+            img = Image.blend(degenerate, img, self.contrast_factor)
         if self.gamma_factor != 1.0:
             img = self.apply_gamma(img, self.gamma_factor)
         if self.filter_type == "BLUR":
@@ -1333,56 +1837,163 @@ class HistoPathAnalyst:
             img = img.filter(ImageFilter.GaussianBlur(radius=2))
         elif self.filter_type == "EDGE_ENHANCE":
             img = img.filter(ImageFilter.EDGE_ENHANCE)
+        elif self.filter_type in STAIN_FILTERS:
+            img = self.stain_deconvolver.channel_image(img, STAIN_FILTERS[self.filter_type])
+        elif self.filter_type in NORMALIZE_FILTERS and self.stain_reference_path and viewport:
+            # Tinción de origen estimada una vez sobre la imagen completa reducida
+            method = NORMALIZE_FILTERS[self.filter_type]
+            normalizer = get_normalizer(self.stain_reference_path, method)
+            img = normalizer.transform(img, source=self.viewport_stain_source(normalizer))
+        elif self.filter_type in NORMALIZE_FILTERS and self.stain_reference_path:
+            img = normalize_image(img, self.stain_reference_path, NORMALIZE_FILTERS[self.filter_type])
         return img
 
+    def viewport_stain_source(self, normalizer):
+        """Parámetros de tinción de la imagen (perezosa o no), estimados sobre una vista reducida"""
+        key = (self.image_revision, normalizer.method)
+        if key not in self.viewport_stain_sources:
+            image = self.original_image
+            factor = reduction_factor(OVERVIEW_SIZE / max(image.size))
+            overview = Image.fromarray(region_reader(image)((0, 0, image.width, image.height), factor))
+            try:
+                self.viewport_stain_sources[key] = normalizer.estimate(overview)
+            except ValueError as e:
+                # Se guarda el fallo: la estimación no se repite en cada cuadro
+                self.viewport_stain_sources[key] = e
+        source = self.viewport_stain_sources[key]
+        if isinstance(source, ValueError):
+            raise ValueError(str(source))
+        return source
+
     def run_pathonet(self, model_type):
+        """Conteo automático con el modelo PathoNet en CPU
+
+        El modelo vive en un proceso de inferencia aparte (histopath_service)
+        que se mantiene cargado entre conteos; los núcleos llegan región por
+        región y se dibujan a medida que llegan, empezando por la región
+        visible y siguiendo por sus vecinas; al desplazar o cambiar el zoom
+        se priorizan las regiones que quedan a la vista.
+        """
         if not self.original_image:
             messagebox.showwarning("Sin imagen", "Por favor cargue una imagen primero.")
             return
+        if not self.image_path or not os.path.isfile(self.image_path):
+            messagebox.showwarning("Sin archivo", "El conteo automático necesita la imagen guardada en disco.")
+            return
+        model_name = 'Ki-67 IHC' if model_type == 'ki67' else 'H&E Mitosis'
+        model_path = self.model_paths.get(model_type) or find_model(model_type)
+        if not model_path:
+            model_path = filedialog.askopenfilename(
+                title=f"Seleccione el modelo PathoNet ({model_name})",
+                filetypes=[("Modelos PathoNet", "*.onnx *.keras *.h5 *.hdf5"), ("Todos los archivos", "*.*")]
+            )
+            if not model_path:
+                return
+        self.model_paths[model_type] = model_path
         if not messagebox.askyesno("Confirmar Auto-Conteo",
-                                  "Esto limpiará todos los marcadores actuales y los reemplazará con los resultados simulados. ¿Desea continuar?"):
+                                  "Esto limpiará todos los marcadores actuales y los reemplazará con los detectados por el modelo. ¿Desea continuar?"):
             return
-        self.status_bar.config(text="Ejecutando simulación de Auto-Conteo...")
-        self.root.update_idletasks()
-        self.root.after(1500, lambda: self.simulate_pathonet_results(model_type))
 
-    def simulate_pathonet_results(self, model_type):
+        service = self.inference_service
+        if service is None or service.model_path != model_path or not service.alive:
+            if service is not None:
+                service.close()
+            self.status_bar.config(text="Cargando modelo de Auto-Conteo...")
+            service = self.inference_service = InferenceService(model_path)
         self.clear_markers()
-        img_width, img_height = self.original_image.size
+        self.inference_model_name = model_name
+        self.inference_area_px = 0
+        self.inference_job = service.submit(self.image_path, region_grid(*self.original_image.size),
+                                            self.viewport_box())
+        self.status_bar.config(text="Ejecutando Auto-Conteo...")
+        if self.inference_poll_id is None:
+            self.poll_inference()
+
+    def poll_inference(self):
+        """Recibe los núcleos del proceso de inferencia mientras haya un trabajo activo"""
+        self.inference_poll_id = None
+        service = self.inference_service
+        if service is None:
+            return
+        for kind, job, data in service.poll():
+            if kind == "failed":
+                self.inference_job = None
+                self.inference_service = None
+                service.close()
+                self.status_bar.config(text="Error de auto-conteo.")
+                messagebox.showerror("Error de Auto-Conteo", data)
+                return
+            if job != self.inference_job:
+                # Mensajes de un trabajo ya descartado
+                continue
+            if kind == "points":
+                done, total, (x0, y0, x1, y1), columns = data
+                self.inference_area_px += (x1 - x0) * (y1 - y0)
+                self.add_detections(*columns)
+                area_fraction = self.inference_area_px / (self.original_image.width * self.original_image.height)
+                self.status_bar.config(text=f"Auto-conteo... región {done}/{total} ({area_fraction:.0%} del área)")
+            elif kind == "done":
+                self.inference_job = None
+                self.compact_project()
+                total_detected = len(self.ki67_points) + len(self.mitosis_points) + len(self.negative_points)
+                self.status_bar.config(text=f"Auto-conteo completado: {total_detected} núcleos detectados.")
+                messagebox.showinfo("Auto-Conteo Completado",
+                                   f"PathoNet ha finalizado, detectando {total_detected} núcleos.\n\n"
+                                   f"Modelo usado: {self.inference_model_name}")
+            elif kind == "error":
+                self.inference_job = None
+                self.status_bar.config(text="Error de auto-conteo.")
+                messagebox.showerror("Error de Auto-Conteo", f"No se pudo ejecutar el modelo:\n{data}")
+        if self.inference_job and not service.alive:
+            self.inference_job = None
+            self.inference_service = None
+            messagebox.showerror("Error de Auto-Conteo", "El proceso de inferencia terminó inesperadamente.")
+        elif self.inference_job:
+            self.inference_poll_id = self.root.after(INFERENCE_POLL_MS, self.poll_inference)
+
+    def add_detections(self, xs, ys, labels):
+        """Añade los núcleos detectados en una región a los marcadores; solo dibuja los nuevos"""
+        starts = (len(self.ki67_points), len(self.mitosis_points), len(self.negative_points))
+        self.set_points_from_columns(xs, ys, labels)
+        self.journal_batch(xs, ys, labels)
+        self.update_all_counts()
+        if self.display_image and self.show_markers.get():
+            self.draw_markers(starts)
+        self.update_quick_metrics()
 
-        # Simular resultados más realistas basados en el tipo de modelo
-        if model_type == "ki67":
-            # Para Ki-67, más células positivas y negativas, pocas mitosis
-            for _ in range(np.random.randint(80, 200)):
-                self.add_marker(np.random.randint(0.05 * img_width, 0.95 * img_width),
-                               np.random.randint(0.05 * img_height, 0.95 * img_height), 'ki67')
-            for _ in range(np.random.randint(200, 400)):
-                self.add_marker(np.random.randint(0.05 * img_width, 0.95 * img_width),
-                               np.random.randint(0.05 * img_height, 0.95 * img_height), 'negative')
-            for _ in range(np.random.randint(3, 8)):
-                self.add_marker(np.random.randint(0.05 * img_width, 0.95 * img_width),
-                               np.random.randint(0.05 * img_height, 0.95 * img_height), 'mitosis')
-        elif model_type == "mitosis":
-            # Para mitosis, más figuras mitóticas
-            for _ in range(np.random.randint(30, 80)):
-                self.add_marker(np.random.randint(0.05 * img_width, 0.95 * img_width),
-                               np.random.randint(0.05 * img_height, 0.95 * img_height), 'ki67')
-            for _ in range(np.random.randint(60, 150)):
-                self.add_marker(np.random.randint(0.05 * img_width, 0.95 * img_width),
-                               np.random.randint(0.05 * img_height, 0.95 * img_height), 'negative')
-            for _ in range(np.random.randint(15, 40)):
-                self.add_marker(np.random.randint(0.05 * img_width, 0.95 * img_width),
-                               np.random.randint(0.05 * img_height, 0.95 * img_height), 'mitosis')
+    def release_image(self):
+        """Suelta la imagen actual antes de reemplazarla: cancela las tareas que la leen y cierra la perezosa
 
-        self.action_history = []
-        total_detected = len(self.ki67_points) + len(self.mitosis_points) + len(self.negative_points)
-        self.status_bar.config(text=f"Simulación completada: {total_detected} núcleos detectados.")
-        messagebox.showinfo("Auto-Conteo Completado",
-                           f"La simulación de PathoNet ha finalizado, detectando {total_detected} núcleos.\n\n"
-                           f"Modelo usado: {'Ki-67 IHC' if model_type == 'ki67' else 'H&E Mitosis'}")
+        El archivo, el mmap y sus bloques en caché se liberan cuando esas
+        tareas se detienen (en su próximo bloque).
+        """
+        tasks = [task for task in self.image_tasks if not task.finished]
+        self.image_tasks = []
+        for task in tasks:
+            task.cancel()
+        if is_lazy_image(self.original_image):
+            self.close_when_finished(self.original_image, tasks)
+
+    def close_when_finished(self, image, tasks):
+        if any(not task.finished for task in tasks):
+            self.root.after(BackgroundTask.POLL_MS, lambda: self.close_when_finished(image, tasks))
+        else:
+            image.close()
+
+    def cancel_inference(self):
+        """Descarta el conteo automático en curso (p. ej. al abrir otra imagen)"""
+        if self.inference_job and self.inference_service:
+            self.inference_service.cancel()
+            self.status_bar.config(text="Auto-conteo cancelado.")
+        self.inference_job = None
 
     def calculate_metrics(self):
-        """Calcula y muestra métricas detalladas"""
+        """Calcula y muestra métricas detalladas
+
+        La ventana se abre de inmediato con las métricas básicas; las métricas
+        costosas (tinción, distancias, agrupamiento) se calculan en un hilo de
+        trabajo y cada pestaña se completa cuando llega su resultado.
+        """
         if not self.original_image:
             messagebox.showwarning("Sin Imagen", "Por favor, cargue una imagen para calcular métricas.")
             return
@@ -1396,28 +2007,33 @@ class HistoPathAnalyst:
             messagebox.showwarning("Sin Datos", "No hay marcadores para calcular métricas.")
             return
 
-        # Calcular área en mm²
+        # Métricas básicas (mismo motor que el CLI de histopath_metrics); escala y tamaño
+        # se fijan aquí, en el hilo de Tk, por si la imagen o la calibración cambian durante el cálculo
         img_width, img_height = self.original_image.size
-        area_mm2 = (img_width * self.calibration_scale) * (img_height * self.calibration_scale) / 1e6
-
-        # Métricas básicas
-        ki67_base_count = total_ki67 + total_negative
-        ki67_index = (total_ki67 / ki67_base_count) * 100 if ki67_base_count > 0 else 0
-        mitosis_per_mm2 = total_mitosis / area_mm2 if area_mm2 > 0 else 0
-        density_total = total_nuclei / area_mm2 if area_mm2 > 0 else 0
-        density_ki67 = total_ki67 / area_mm2 if area_mm2 > 0 else 0
-        density_negative = total_negative / area_mm2 if area_mm2 > 0 else 0
-
-        # Métricas avanzadas de distribución
-        distribution_metrics = self.calculate_distribution_metrics()
-        clustering_metrics = self.calculate_clustering_metrics()
+        scale = self.calibration_scale
+        basic = basic_metrics(total_ki67, total_negative, total_mitosis, img_width, img_height, scale)
+        area_mm2 = basic['area_mm2']
+        ki67_index = basic['ki67_index']
+        mitosis_per_mm2 = basic['mitosis_per_mm2']
+        density_total = basic['density_total']
+        density_ki67 = basic['density_ki67']
+        density_negative = basic['density_negative']
+
+        # Copia de los marcadores: el hilo de trabajo no debe leer listas que la interfaz modifica
+        ki67_points = list(self.ki67_points)
+        mitosis_points = list(self.mitosis_points)
+        negative_points = list(self.negative_points)
+        point_lists = [ki67_points, mitosis_points, negative_points]
+        image = self.original_image
+        image_path = self.image_path
+        marker_colors = [self.ki67_color.get(), self.negative_color.get(), self.mitosis_color.get()]
+        revision = (self.annotation_revision, scale, tuple(marker_colors))
 
         # Crear ventana de resultados
         result_window = tk.Toplevel(self.root)
         result_window.title("Resultados del Análisis - Métricas Detalladas")
         result_window.geometry("800x700")
         result_window.transient(self.root)
-        result_window.grab_set()
 
         # Notebook para pestañas
         notebook = ttk.Notebook(result_window)
@@ -1444,7 +2060,7 @@ class HistoPathAnalyst:
             ("Conteo TIL/Otros", f"{mitosis_per_mm2:.2f} mitosis/mm²"),
             ("", ""),
             ("Área Analizada", f"{area_mm2:.2f} mm²"),
-            ("Escala", f"{self.calibration_scale:.4f} µm/pixel"),
+            ("Escala", f"{scale:.4f} µm/pixel"),
             ("Resolución", f"{img_width} × {img_height} px")
         ]
 
@@ -1455,134 +2071,243 @@ class HistoPathAnalyst:
                 ttk.Label(metrics_frame, text=label, font=("Segoe UI", 9, "bold")).grid(row=i, column=0, sticky=tk.W, pady=2)
                 ttk.Label(metrics_frame, text=value, font=("Segoe UI", 9)).grid(row=i, column=1, sticky=tk.W, pady=2, padx=10)
 
+        # Métricas de tinción (se completan en segundo plano)
+        stain_frame = ttk.LabelFrame(summary_frame, text="Métricas de Tinción (H-DAB)", padding=10)
+        stain_frame.pack(fill=tk.X, pady=5)
+        stain_placeholder = ttk.Label(stain_frame, text="Calculando deconvolución H-DAB...",
+                                      font=("Segoe UI", 9, "italic"))
+        stain_placeholder.grid(row=0, column=0, sticky=tk.W)
+
         # Pestaña de distribución
-        if total_nuclei > 0:
-            dist_frame = ttk.Frame(notebook, padding=10)
-            notebook.add(dist_frame, text="Distribución")
-
-            # Gráfico de distribución
-            fig1 = plt.Figure(figsize=(6, 4), dpi=100)
-            ax1 = fig1.add_subplot(111)
-            categories = ['Ki-67 Positivo (+)', 'Ki-67 Negativo (-)', 'Otros']
-            counts = [total_ki67, total_negative, total_mitosis]
-            colors = [self.ki67_color.get(), self.negative_color.get(), self.mitosis_color.get()]
-            bars = ax1.bar(categories, counts, color=colors)
-            ax1.set_title('Distribución de Núcleos Identificados')
-            ax1.set_ylabel('Cantidad')
-
-            # Añadir valores en las barras
-            for bar, count in zip(bars, counts):
-                height = bar.get_height()
-                ax1.text(bar.get_x() + bar.get_width()/2., height,
-                        f'{count}', ha='center', va='bottom')
-
-            canvas1 = FigureCanvasTkAgg(fig1, master=dist_frame)
-            canvas1.draw()
-            canvas1.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-            # Métricas de distribución
-            dist_metrics_frame = ttk.LabelFrame(dist_frame, text="Métricas de Distribución", padding=10)
-            dist_metrics_frame.pack(fill=tk.X, pady=10)
-
-            dist_metrics = [
-                ("Distancia Mínima entre Núcleos", f"{distribution_metrics['min_distance']:.1f} µm"),
-                ("Distancia Máxima entre Núcleos", f"{distribution_metrics['max_distance']:.1f} µm"),
-                ("Distancia Promedio entre Núcleos", f"{distribution_metrics['avg_distance']:.1f} µm"),
-                ("Desviación Estándar de Distancias", f"{distribution_metrics['std_distance']:.1f} µm"),
-                ("Coeficiente de Variación", f"{distribution_metrics['cv_distance']:.2f}"),
-            ]
-
-            for i, (label, value) in enumerate(dist_metrics):
-                ttk.Label(dist_metrics_frame, text=label, font=("Segoe UI", 9)).grid(row=i, column=0, sticky=tk.W, pady=1)
-                ttk.Label(dist_metrics_frame, text=value, font=("Segoe UI", 9, "bold")).grid(row=i, column=1, sticky=tk.W, pady=1, padx=10)
+        dist_frame = ttk.Frame(notebook, padding=10)
+        notebook.add(dist_frame, text="Distribución")
+
+        # El gráfico de barras solo depende de los conteos: está listo de inmediato
+        dist_figure_frame = ttk.Frame(dist_frame)
+        dist_figure_frame.pack(fill=tk.BOTH, expand=True)
+        self._register_lazy_figure(notebook, dist_frame, ("count_distribution", revision),
+                                   build_count_distribution,
+                                   ([total_ki67, total_negative, total_mitosis], marker_colors),
+                                   figsize=(6, 4), target=dist_figure_frame)
+
+        dist_metrics_frame = ttk.LabelFrame(dist_frame, text="Métricas de Distribución", padding=10)
+        dist_metrics_frame.pack(fill=tk.X, pady=10)
+        dist_placeholder = ttk.Label(dist_metrics_frame, text="Calculando distancias entre núcleos...",
+                                     font=("Segoe UI", 9, "italic"))
+        dist_placeholder.grid(row=0, column=0, sticky=tk.W)
 
         # Pestaña de agrupamiento
+        cluster_frame = None
         if total_nuclei > 10:  # Solo mostrar si hay suficientes puntos
             cluster_frame = ttk.Frame(notebook, padding=10)
             notebook.add(cluster_frame, text="Agrupamiento")
-
-            # Gráfico de dispersión
-            fig2 = plt.Figure(figsize=(6, 5), dpi=100)
-            ax2 = fig2.add_subplot(111)
-
-            # Preparar datos para el scatter plot
-            all_points = []
-            colors = []
-            labels = []
-
-            for points, color, label in [
-                (self.ki67_points, self.ki67_color.get(), 'Ki-67 Positivo (+)'),
-                (self.negative_points, self.negative_color.get(), 'Ki-67 Negativo (-)'),
-                (self.mitosis_points, self.mitosis_color.get(), 'Otros')
-            ]:
-                for x, y, _ in points:
-                    all_points.append([x * self.calibration_scale, y * self.calibration_scale])
-                    colors.append(color)
-                    labels.append(label)
-
-            if all_points:
-                points_array = np.array(all_points)
-                ax2.scatter(points_array[:, 0], points_array[:, 1], c=colors, alpha=0.6, s=20)
-                ax2.set_xlabel('Coordenada X (µm)')
-                ax2.set_ylabel('Coordenada Y (µm)')
-                ax2.set_title('Distribución Espacial de Núcleos')
-                ax2.grid(True, alpha=0.3)
-
-                # Añadir leyenda
-                from matplotlib.patches import Patch
-                legend_elements = [
-                    Patch(facecolor=self.ki67_color.get(), label='Ki-67 Positivo (+)'),
-                    Patch(facecolor=self.negative_color.get(), label='Ki-67 Negativo (-)'),
-                    Patch(facecolor=self.mitosis_color.get(), label='Otros')
-                ]
-                ax2.legend(handles=legend_elements)
-
-            canvas2 = FigureCanvasTkAgg(fig2, master=cluster_frame)
-            canvas2.draw()
-            canvas2.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-            # Métricas de agrupamiento
-            cluster_metrics_frame = ttk.LabelFrame(cluster_frame, text="Métricas de Agrupamiento", padding=10)
-            cluster_metrics_frame.pack(fill=tk.X, pady=10)
-
-            cluster_metrics = [
-                ("Índice de Agrupamiento", f"{clustering_metrics['clustering_index']:.3f}"),
-                ("Número de Grupos Detectados", f"{clustering_metrics['num_clusters']}"),
-                ("Tamaño Promedio de Grupo", f"{clustering_metrics['avg_cluster_size']:.1f} núcleos"),
-                ("Densidad de Grupos", f"{clustering_metrics['cluster_density']:.2f} grupos/mm²"),
-            ]
-
-            for i, (label, value) in enumerate(cluster_metrics):
-                ttk.Label(cluster_metrics_frame, text=label, font=("Segoe UI", 9)).grid(row=i, column=0, sticky=tk.W, pady=1)
-                ttk.Label(cluster_metrics_frame, text=value, font=("Segoe UI", 9, "bold")).grid(row=i, column=1, sticky=tk.W, pady=1, padx=10)
+            cluster_placeholder = ttk.Label(cluster_frame, text="Calculando agrupamiento...",
+                                            font=("Segoe UI", 9, "italic"))
+            cluster_placeholder.pack(anchor=tk.W)
+
+        # Progreso y cancelación
+        progress_frame = ttk.Frame(result_window)
+        progress_frame.pack(fill=tk.X, padx=10)
+        progress_bar = ttk.Progressbar(progress_frame, maximum=1.0, mode='determinate')
+        progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        progress_label = ttk.Label(progress_frame, text="Iniciando...", width=28)
+        progress_label.pack(side=tk.LEFT, padx=5)
+        cancel_button = ttk.Button(progress_frame, text="Cancelar")
+        cancel_button.pack(side=tk.RIGHT, padx=5)
+
+        # Resultados disponibles para exportación (se completan al llegar)
+        results = {'distribution': None, 'clustering': None}
 
         # Botones de exportación
         export_frame = ttk.Frame(result_window)
         export_frame.pack(fill=tk.X, padx=10, pady=5)
 
         ttk.Button(export_frame, text="Exportar a CSV",
-                  command=lambda: self.export_metrics_to_csv(metrics, distribution_metrics, clustering_metrics)).pack(side=tk.LEFT, padx=5)
+                  command=lambda: self.export_metrics_to_csv(metrics, results['distribution'], results['clustering'])).pack(side=tk.LEFT, padx=5)
         ttk.Button(export_frame, text="Exportar Reporte PDF",
-                  command=lambda: self.export_pdf_report(metrics, distribution_metrics, clustering_metrics)).pack(side=tk.LEFT, padx=5)
+                  command=lambda: self.export_pdf_report(metrics, results['distribution'], results['clustering'])).pack(side=tk.LEFT, padx=5)
         ttk.Button(export_frame, text="Copiar al Portapapeles",
                   command=lambda: self.copy_metrics_to_clipboard(metrics)).pack(side=tk.LEFT, padx=5)
-        ttk.Button(export_frame, text="Cerrar",
-                  command=result_window.destroy).pack(side=tk.RIGHT, padx=5)
 
-        self.status_bar.config(text="Métricas calculadas y mostradas.")
+        def worker(task):
+            # Los resultados ya calculados para este contenido salen de la caché
+            task.progress(0.0, "Identificando imagen")
+            image_key = self.image_content_key(image_path)
+            task.emit("stain", stain_statistics(image, image_key, self.stain_deconvolver, result_cache,
+                                                progress=task.progress_range(0.0, 0.4, "Tinción H-DAB")))
+            task.emit("distribution", self.calculate_distribution_metrics(
+                point_lists, progress=task.progress_range(0.4, 0.7, "Distancias"), cache=result_cache,
+                scale=scale))
+            if cluster_frame is not None:
+                clustering = self.calculate_clustering_metrics(
+                    point_lists, progress=task.progress_range(0.7, 1.0, "Agrupamiento"), cache=result_cache,
+                    scale=scale, size=(img_width, img_height))
+                # Coordenadas en µm por clase para el gráfico de dispersión
+                points_by_class = [
+                    np.array([(x, y) for x, y, _ in points], dtype=float).reshape(-1, 2) * scale
+                    for points in (ki67_points, negative_points, mitosis_points)
+                ]
+                task.emit("clustering", (clustering, points_by_class))
+
+        def on_result(key, value):
+            if not result_window.winfo_exists():
+                return
+            if key == "stain":
+                stain_placeholder.destroy()
+                stain_metrics = [
+                    ("OD Media Hematoxilina", f"{value['mean_od_h']:.3f}"),
+                    ("OD Media DAB", f"{value['mean_od_dab']:.3f}"),
+                    ("Área DAB+", f"{value['dab_area_fraction'] * 100:.2f}%"),
+                    ("Índice de Área DAB", f"{value['dab_area_index'] * 100:.2f}%"),
+                ]
+                for i, (label, text) in enumerate(stain_metrics):
+                    ttk.Label(stain_frame, text=label, font=("Segoe UI", 9, "bold")).grid(row=i, column=0, sticky=tk.W, pady=2)
+                    ttk.Label(stain_frame, text=text, font=("Segoe UI", 9)).grid(row=i, column=1, sticky=tk.W, pady=2, padx=10)
+                # Para exportar, la sección de tinción va tras los conteos, antes de la de área
+                stain_index = next(i for i, (label, _) in enumerate(metrics) if label == "Área Analizada")
+                metrics[stain_index:stain_index] = stain_metrics + [("", "")]
+            elif key == "distribution":
+                results['distribution'] = value
+                dist_placeholder.destroy()
+                dist_metrics = [
+                    ("Distancia Mínima entre Núcleos", f"{value['min_distance']:.1f} µm"),
+                    ("Distancia Máxima entre Núcleos", f"{value['max_distance']:.1f} µm"),
+                    ("Distancia Promedio entre Núcleos", f"{value['avg_distance']:.1f} µm"),
+                    ("Desviación Estándar de Distancias", f"{value['std_distance']:.1f} µm"),
+                    ("Coeficiente de Variación", f"{value['cv_distance']:.2f}"),
+                ]
+                for i, (label, text) in enumerate(dist_metrics):
+                    ttk.Label(dist_metrics_frame, text=label, font=("Segoe UI", 9)).grid(row=i, column=0, sticky=tk.W, pady=1)
+                    ttk.Label(dist_metrics_frame, text=text, font=("Segoe UI", 9, "bold")).grid(row=i, column=1, sticky=tk.W, pady=1, padx=10)
+            elif key == "clustering":
+                value, points_by_class = value
+                results['clustering'] = value
+                cluster_placeholder.destroy()
+                cluster_figure_frame = ttk.Frame(cluster_frame)
+                cluster_figure_frame.pack(fill=tk.BOTH, expand=True)
+                self._register_lazy_figure(notebook, cluster_frame, ("spatial_scatter", revision),
+                                           build_spatial_scatter, (points_by_class, marker_colors),
+                                           figsize=(6, 5), target=cluster_figure_frame)
+
+                cluster_metrics_frame = ttk.LabelFrame(cluster_frame, text="Métricas de Agrupamiento", padding=10)
+                cluster_metrics_frame.pack(fill=tk.X, pady=10)
+                cluster_metrics = [
+                    ("Índice de Agrupamiento", f"{value['clustering_index']:.3f}"),
+                    ("Número de Grupos Detectados", f"{value['num_clusters']}"),
+                    ("Tamaño Promedio de Grupo", f"{value['avg_cluster_size']:.1f} núcleos"),
+                    ("Densidad de Grupos", f"{value['cluster_density']:.2f} grupos/mm²"),
+                ]
+                for i, (label, text) in enumerate(cluster_metrics):
+                    ttk.Label(cluster_metrics_frame, text=label, font=("Segoe UI", 9)).grid(row=i, column=0, sticky=tk.W, pady=1)
+                    ttk.Label(cluster_metrics_frame, text=text, font=("Segoe UI", 9, "bold")).grid(row=i, column=1, sticky=tk.W, pady=1, padx=10)
+
+        self._start_analysis_task(result_window, worker, on_result, progress_bar, progress_label,
+                                  cancel_button, export_frame, done_text="Métricas calculadas y mostradas.")
+
+    def _start_analysis_task(self, window, worker, on_result, progress_bar, progress_label,
+                             cancel_button, button_frame, done_text):
+        """Lanza el cálculo de una ventana de análisis en segundo plano
+
+        Conecta la barra de progreso, el botón de cancelar y el cierre de la
+        ventana con la tarea; cerrar la ventana también detiene el cálculo.
+        """
+        def on_progress(fraction, text):
+            if window.winfo_exists():
+                progress_bar['value'] = fraction
+                progress_label.config(text=f"{text} ({fraction:.0%})")
+
+        def finish(text):
+            if window.winfo_exists():
+                progress_label.config(text=text)
+                cancel_button.config(state=tk.DISABLED)
+
+        def on_done():
+            if window.winfo_exists():
+                progress_bar['value'] = 1.0
+            finish("Completado")
+            self.status_bar.config(text=done_text)
+
+        def on_cancel():
+            finish("Cancelado")
+            self.status_bar.config(text="Análisis cancelado.")
+
+        def on_error(error):
+            finish("Error")
+            if window.winfo_exists():
+                messagebox.showerror("Error de Análisis", f"No se pudo completar el análisis:\n{str(error)}",
+                                     parent=window)
+
+        def close():
+            task.cancel()
+            window.destroy()
+
+        task = BackgroundTask(self.root, worker, on_result=on_result, on_progress=on_progress,
+                              on_done=on_done, on_error=on_error, on_cancel=on_cancel)
+        cancel_button.config(command=task.cancel)
+        ttk.Button(button_frame, text="Cerrar", command=close).pack(side=tk.RIGHT, padx=5)
+        window.protocol("WM_DELETE_WINDOW", close)
+        self.status_bar.config(text="Calculando análisis en segundo plano...")
+        self.image_tasks.append(task)
+        return task.start()
+
+    def _register_lazy_figure(self, notebook, tab, key, build, args=(), figsize=(8, 6), target=None):
+        """Asocia un gráfico a una pestaña; se rasteriza al seleccionarla por primera vez
+
+        El gráfico se dibuja fuera de pantalla (Agg) en el hilo del renderizador
+        y se guarda en caché con la clave (análisis, revisión de datos).
+        """
+        if not hasattr(notebook, "lazy_figures"):
+            notebook.lazy_figures = {}
+            notebook.bind("<<NotebookTabChanged>>", lambda e: self._render_selected_tab(notebook))
+        notebook.lazy_figures[str(tab)] = (target or tab, key, build, args, figsize)
+        self._render_selected_tab(notebook)
+
+    def _render_selected_tab(self, notebook):
+        spec = notebook.lazy_figures.pop(notebook.select(), None)
+        if spec is None:
+            return
+        frame, key, build, args, figsize = spec
+        loading = ttk.Label(frame, text="Generando gráfico...", font=("Segoe UI", 9, "italic"))
+        loading.pack(anchor=tk.W)
+        future = self.figure_renderer.submit(key, build, args, figsize)
+
+        def poll():
+            if not frame.winfo_exists():
+                return
+            if not future.done():
+                self.root.after(50, poll)
+                return
+            loading.destroy()
+            try:
+                bitmap = future.result()
+            except Exception as e:
+                ttk.Label(frame, text=f"No se pudo generar el gráfico: {str(e)}").pack(anchor=tk.W)
+                return
+            photo = ImageTk.PhotoImage(bitmap)
+            figure_label = ttk.Label(frame, image=photo, anchor=tk.CENTER)
+            figure_label.image = photo
+            figure_label.pack(fill=tk.BOTH, expand=True)
+        poll()
 
     def analyze_color(self):
-        """Análisis avanzado de color de la imagen"""
+        """Análisis avanzado de color de la imagen
+
+        La ventana se abre de inmediato; las estadísticas se calculan en un
+        hilo de trabajo y cada pestaña se completa cuando llega su resultado.
+        """
         if not self.original_image:
             messagebox.showwarning("Sin Imagen", "Cargue una imagen primero.")
             return
 
+        image = self.original_image
+        image_path = self.image_path
+        revision = self.image_revision
+
         # Crear ventana de análisis de color
         color_window = tk.Toplevel(self.root)
         color_window.title("Análisis de Color - Distribución de Tinciones")
         color_window.geometry("1000x800")
         color_window.transient(self.root)
-        color_window.grab_set()
 
         # Notebook para pestañas
         notebook = ttk.Notebook(color_window)
@@ -1604,213 +2329,18 @@ class HistoPathAnalyst:
         pca_frame = ttk.Frame(notebook, padding=10)
         notebook.add(pca_frame, text="Análisis PCA")
 
-        # Convertir imagen a numpy array
-        img_array = np.array(self.original_image)
-
-        # Si la imagen tiene canal alpha, quitarlo
-        if img_array.shape[2] == 4:
-            img_array = img_array[:,:,:3]
-
-        # Redimensionar imagen para análisis (para mejorar rendimiento)
-        max_size = 500
-        h, w = img_array.shape[:2]
-        if max(h, w) > max_size:
-            scale = max_size / max(h, w)
-            new_h, new_w = int(h * scale), int(w * scale)
-            img_resized = cv2.resize(img_array, (new_w, new_h))
-        else:
-            img_resized = img_array
-
-        # Aplanar la imagen a una lista de píxeles
-        pixels = img_resized.reshape(-1, 3)
-
-        # Muestrear píxeles para análisis (máximo 10000 píxeles)
-        n_samples = min(10000, len(pixels))
-        indices = np.random.choice(len(pixels), n_samples, replace=False)
-        sample_pixels = pixels[indices]
-
-        # 1. Diagrama de dispersión de colores
-        fig_scatter = plt.Figure(figsize=(8, 6), dpi=100)
-        ax_scatter = fig_scatter.add_subplot(111, projection='3d')
-
-        # Normalizar colores para visualización
-        norm_pixels = sample_pixels / 255.0
-
-        # Crear scatter plot 3D
-        scatter = ax_scatter.scatter(
-            sample_pixels[:, 0],  # Rojo
-            sample_pixels[:, 1],  # Verde
-            sample_pixels[:, 2],  # Azul
-            c=norm_pixels,
-            marker='o',
-            alpha=0.6,
-            s=10
-        )
-
-        ax_scatter.set_xlabel('Canal Rojo')
-        ax_scatter.set_ylabel('Canal Verde')
-        ax_scatter.set_zlabel('Canal Azul')
-        ax_scatter.set_title('Espacio de Color RGB - Distribución de Píxeles')
-
-        canvas_scatter = FigureCanvasTkAgg(fig_scatter, master=scatter_frame)
-        canvas_scatter.draw()
-        canvas_scatter.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-        # 2. Histogramas de color
-        fig_hist = plt.Figure(figsize=(10, 6), dpi=100)
-        ax_hist1 = fig_hist.add_subplot(211)
-        ax_hist2 = fig_hist.add_subplot(212)
-
-        # Histograma RGB
-        colors = ['red', 'green', 'blue']
-        channels = ['Rojo', 'Verde', 'Azul']
-        for i, color in enumerate(colors):
-            ax_hist1.hist(sample_pixels[:, i], bins=50, alpha=0.7, color=color,
-                         label=channels[i], density=True)
-        ax_hist1.set_title('Distribución de Canales RGB')
-        ax_hist1.set_xlabel('Intensidad')
-        ax_hist1.set_ylabel('Densidad')
-        ax_hist1.legend()
-        ax_hist1.grid(True, alpha=0.3)
-
-        # Convertir a HSV para análisis de tinción
-        img_hsv = cv2.cvtColor(img_resized, cv2.COLOR_RGB2HSV)
-        hsv_pixels = img_hsv.reshape(-1, 3)
-        sample_hsv = hsv_pixels[indices]
-
-        # Histograma HSV
-        hsv_channels = ['Matiz (Hue)', 'Saturación (Sat)', 'Valor (Val)']
-        hsv_colors = ['magenta', 'cyan', 'yellow']
-        for i in range(3):
-            ax_hist2.hist(sample_hsv[:, i], bins=50, alpha=0.7, color=hsv_colors[i],
-                         label=hsv_channels[i], density=True)
-        ax_hist2.set_title('Distribución de Canales HSV')
-        ax_hist2.set_xlabel('Valor')
-        ax_hist2.set_ylabel('Densidad')
-        ax_hist2.legend()
-        ax_hist2.grid(True, alpha=0.3)
-
-        fig_hist.tight_layout()
-        canvas_hist = FigureCanvasTkAgg(fig_hist, master=hist_frame)
-        canvas_hist.draw()
-        canvas_hist.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-        # 3. Paleta de colores dominantes
-        fig_palette = plt.Figure(figsize=(10, 4), dpi=100)
-        ax_palette = fig_palette.add_subplot(111)
-
-        # Encontrar colores dominantes usando k-means
-        n_colors = 8
-        kmeans = KMeans(n_clusters=n_colors, random_state=42)
-        kmeans.fit(sample_pixels)
-        dominant_colors = kmeans.cluster_centers_.astype(int)
-
-        # Contar frecuencia de cada color
-        labels = kmeans.labels_
-        color_counts = Counter(labels)
-        total_pixels = len(labels)
-
-        # Crear paleta de colores
-        palette = []
-        color_info = []
-        for i, color in enumerate(dominant_colors):
-            count = color_counts[i]
-            percentage = (count / total_pixels) * 100
-            palette.append(color / 255.0)
-            color_info.append(f"RGB{tuple(color)} ({percentage:.1f}%)")
-
-        # Mostrar paleta
-        ax_palette.imshow([palette], aspect='auto', extent=[0, n_colors, 0, 1])
-        ax_palette.set_title(f'Paleta de {n_colors} Colores Dominantes')
-        ax_palette.set_xlabel('Colores')
-        ax_palette.set_ylabel('')
-        ax_palette.set_yticks([])
-        ax_palette.set_xticks(np.arange(n_colors) + 0.5)
-        ax_palette.set_xticklabels([f'Color {i+1}' for i in range(n_colors)], rotation=45)
-
-        # Añadir información de porcentajes
-        for i, info in enumerate(color_info):
-            ax_palette.text(i + 0.5, 0.5, f'{info.split("(")[1][:-1]}',
-                          ha='center', va='center', fontsize=8,
-                          bbox=dict(boxstyle="round,pad=0.3", facecolor="white", alpha=0.8))
-
-        canvas_palette = FigureCanvasTkAgg(fig_palette, master=palette_frame)
-        canvas_palette.draw()
-        canvas_palette.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-        # 4. Análisis PCA de colores
-        fig_pca = plt.Figure(figsize=(10, 8), dpi=100)
-        ax_pca1 = fig_pca.add_subplot(221)
-        ax_pca2 = fig_pca.add_subplot(222)
-        ax_pca3 = fig_pca.add_subplot(223)
-        ax_pca4 = fig_pca.add_subplot(224, projection='3d')
-
-        # Aplicar PCA
-        pca = PCA(n_components=3)
-        pca_result = pca.fit_transform(sample_pixels)
-
-        # Gráfico 2D - PC1 vs PC2
-        scatter1 = ax_pca1.scatter(pca_result[:, 0], pca_result[:, 1],
-                                 c=norm_pixels, alpha=0.6, s=10)
-        ax_pca1.set_xlabel(f'PC1 ({pca.explained_variance_ratio_[0]:.2%} var.)')
-        ax_pca1.set_ylabel(f'PC2 ({pca.explained_variance_ratio_[1]:.2%} var.)')
-        ax_pca1.set_title('PCA: Componente 1 vs Componente 2')
-        ax_pca1.grid(True, alpha=0.3)
-
-        # Gráfico 2D - PC1 vs PC3
-        scatter2 = ax_pca2.scatter(pca_result[:, 0], pca_result[:, 2],
-                                 c=norm_pixels, alpha=0.6, s=10)
-        ax_pca2.set_xlabel(f'PC1 ({pca.explained_variance_ratio_[0]:.2%} var.)')
-        ax_pca2.set_ylabel(f'PC3 ({pca.explained_variance_ratio_[2]:.2%} var.)')
-        ax_pca2.set_title('PCA: Componente 1 vs Componente 3')
-        ax_pca2.grid(True, alpha=0.3)
-
-        # Gráfico 2D - PC2 vs PC3
-        scatter3 = ax_pca3.scatter(pca_result[:, 1], pca_result[:, 2],
-                                 c=norm_pixels, alpha=0.6, s=10)
-        ax_pca3.set_xlabel(f'PC2 ({pca.explained_variance_ratio_[1]:.2%} var.)')
-        ax_pca3.set_ylabel(f'PC3 ({pca.explained_variance_ratio_[2]:.2%} var.)')
-        ax_pca3.set_title('PCA: Componente 2 vs Componente 3')
-        ax_pca3.grid(True, alpha=0.3)
-
-        # Gráfico 3D
-        scatter4 = ax_pca4.scatter(pca_result[:, 0], pca_result[:, 1], pca_result[:, 2],
-                                 c=norm_pixels, alpha=0.6, s=10)
-        ax_pca4.set_xlabel('PC1')
-        ax_pca4.set_ylabel('PC2')
-        ax_pca4.set_zlabel('PC3')
-        ax_pca4.set_title('PCA 3D - Espacio de Color Reducido')
-
-        fig_pca.tight_layout()
-        canvas_pca = FigureCanvasTkAgg(fig_pca, master=pca_frame)
-        canvas_pca.draw()
-        canvas_pca.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-        # Información estadística
-        stats_text = f"""
-        ESTADÍSTICAS DE COLOR:
-        - Total de píxeles analizados: {n_samples:,}
-        - Dimensión original: {img_array.shape[1]} × {img_array.shape[0]} píxeles
-        - Dimensión para análisis: {img_resized.shape[1]} × {img_resized.shape[0]} píxeles
-
-        ANÁLISIS PCA:
-        - Varianza explicada PC1: {pca.explained_variance_ratio_[0]:.2%}
-        - Varianza explicada PC2: {pca.explained_variance_ratio_[1]:.2%}
-        - Varianza explicada PC3: {pca.explained_variance_ratio_[2]:.2%}
-        - Varianza total explicada: {sum(pca.explained_variance_ratio_):.2%}
-
-        COLORES DOMINANTES:
-        """
-
-        for i, (color, info) in enumerate(zip(dominant_colors, color_info)):
-            stats_text += f"- Color {i+1}: {info}\n"
+        placeholders = {}
+        for key, frame in [("scatter", scatter_frame), ("hist", hist_frame),
+                           ("palette", palette_frame), ("pca", pca_frame)]:
+            placeholders[key] = ttk.Label(frame, text="Calculando...", font=("Segoe UI", 9, "italic"))
+            placeholders[key].pack(anchor=tk.W)
 
         # Frame para estadísticas
         stats_frame = ttk.Frame(color_window)
         stats_frame.pack(fill=tk.X, padx=10, pady=5)
 
         stats_label = tk.Text(stats_frame, height=12, width=80, font=("Courier", 9))
-        stats_label.insert(tk.END, stats_text)
+        stats_label.insert(tk.END, "Calculando estadísticas de color sobre la imagen completa...")
         stats_label.config(state=tk.DISABLED)
         stats_label.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
@@ -1819,16 +2349,105 @@ class HistoPathAnalyst:
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         stats_label.config(yscrollcommand=scrollbar.set)
 
+        # Progreso y cancelación
+        progress_frame = ttk.Frame(color_window)
+        progress_frame.pack(fill=tk.X, padx=10)
+        progress_bar = ttk.Progressbar(progress_frame, maximum=1.0, mode='determinate')
+        progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        progress_label = ttk.Label(progress_frame, text="Iniciando...", width=28)
+        progress_label.pack(side=tk.LEFT, padx=5)
+        cancel_button = ttk.Button(progress_frame, text="Cancelar")
+        cancel_button.pack(side=tk.RIGHT, padx=5)
+
         # Botones de exportación
         export_frame = ttk.Frame(color_window)
         export_frame.pack(fill=tk.X, padx=10, pady=5)
 
-        ttk.Button(export_frame, text="Exportar Reporte de Color",
-                  command=lambda: self.export_color_analysis(stats_text, dominant_colors)).pack(side=tk.LEFT, padx=5)
-        ttk.Button(export_frame, text="Cerrar",
-                  command=color_window.destroy).pack(side=tk.RIGHT, padx=5)
+        report = {}
+        export_button = ttk.Button(export_frame, text="Exportar Reporte de Color", state=tk.DISABLED,
+                                   command=lambda: self.export_color_analysis(report['text'], report['colors']))
+        export_button.pack(side=tk.LEFT, padx=5)
+
+        def worker(task):
+            task.progress(0.0, "Identificando imagen")
+            image_key = self.image_content_key(image_path)
+
+            def compute():
+                return ColorStatistics.from_image(
+                    image, seed=42, progress=task.progress_range(0.0, 0.85, "Estadísticas de color"))
+
+            color_stats = cached_result(result_cache if image_key else None,
+                                        ("color_statistics", image_key, 42), compute)
+            task.emit("stats", color_stats)
+            task.progress(0.9, "Colores dominantes")
+            task.emit("palette", find_dominant_colors(color_stats.color_hist, n_colors=8))
+            task.progress(0.95, "Análisis PCA")
+            _, _, explained_ratio = color_stats.pca()
+            task.emit("pca", (explained_ratio, color_stats.project(color_stats.sample)))
+
+        def on_result(key, value):
+            if not color_window.winfo_exists():
+                return
+            if key == "stats":
+                report['stats'] = value
+                placeholders.pop("scatter").destroy()
+                placeholders.pop("hist").destroy()
+                self._register_lazy_figure(notebook, scatter_frame, ("color_scatter", revision),
+                                           build_color_scatter, (value.sample,), figsize=(8, 6))
+                self._register_lazy_figure(notebook, hist_frame, ("color_histograms", revision),
+                                           build_color_histograms,
+                                           (value.rgb_hist, value.hsv_hist, value.total), figsize=(10, 6))
+            elif key == "palette":
+                dominant_colors, color_fractions = value
+                report['colors'] = dominant_colors
+                report['color_info'] = [f"RGB{tuple(color.tolist())} ({fraction * 100:.1f}%)"
+                                        for color, fraction in zip(dominant_colors, color_fractions)]
+                placeholders.pop("palette").destroy()
+                self._register_lazy_figure(notebook, palette_frame, ("color_palette", revision),
+                                           build_color_palette, (dominant_colors, color_fractions),
+                                           figsize=(10, 4))
+            elif key == "pca":
+                explained_ratio, pca_result = value
+                placeholders.pop("pca").destroy()
+                self._register_lazy_figure(notebook, pca_frame, ("color_pca", revision), build_color_pca,
+                                           (report['stats'].sample, explained_ratio, pca_result),
+                                           figsize=(10, 8))
+                report['text'] = self._color_stats_text(image, report['stats'], explained_ratio,
+                                                        report['color_info'])
+                stats_label.config(state=tk.NORMAL)
+                stats_label.delete("1.0", tk.END)
+                stats_label.insert(tk.END, report['text'])
+                stats_label.config(state=tk.DISABLED)
+                export_button.config(state=tk.NORMAL)
+
+        self._start_analysis_task(color_window, worker, on_result, progress_bar, progress_label,
+                                  cancel_button, export_frame, done_text="Análisis de color completado.")
+
+    def _color_stats_text(self, image, color_stats, explained_ratio, color_info):
+        """Texto del reporte de estadísticas de color"""
+        stats_text = f"""
+        ESTADÍSTICAS DE COLOR:
+        - Total de píxeles analizados: {color_stats.total:,}
+        - Dimensión original: {image.width} × {image.height} píxeles
+        - Muestra para gráficos: {len(color_stats.sample):,} píxeles (semilla 42)
+        - Media RGB: {tuple(np.round(color_stats.mean, 1).tolist())}
+        - Desv. estándar RGB: {tuple(np.round(color_stats.std, 1).tolist())}
+        - Percentil 5 RGB: {tuple(color_stats.percentile(5).tolist())}
+        - Mediana RGB: {tuple(color_stats.percentile(50).tolist())}
+        - Percentil 95 RGB: {tuple(color_stats.percentile(95).tolist())}
+
+        ANÁLISIS PCA:
+        - Varianza explicada PC1: {explained_ratio[0]:.2%}
+        - Varianza explicada PC2: {explained_ratio[1]:.2%}
+        - Varianza explicada PC3: {explained_ratio[2]:.2%}
+        - Varianza total explicada: {sum(explained_ratio):.2%}
+
+        COLORES DOMINANTES:
+        """
 
-        self.status_bar.config(text="Análisis de color completado.")
+        for i, info in enumerate(color_info):
+            stats_text += f"- Color {i+1}: {info}\n"
+        return stats_text
 
     def export_color_analysis(self, stats_text, dominant_colors):
         """Exporta el análisis de color a un archivo de texto"""
@@ -1856,106 +2475,47 @@ class HistoPathAnalyst:
         except Exception as e:
             messagebox.showerror("Error de Exportación", f"No se pudo exportar el reporte:\n{str(e)}")
 
-    def calculate_distribution_metrics(self):
-        """Calcula métricas de distribución espacial"""
-        all_points = []
-        for points_list in [self.ki67_points, self.mitosis_points, self.negative_points]:
-            for x, y, _ in points_list:
-                all_points.append((x * self.calibration_scale, y * self.calibration_scale))
-
-        if len(all_points) < 2:
-            return {
-                'min_distance': 0,
-                'max_distance': 0,
-                'avg_distance': 0,
-                'std_distance': 0,
-                'cv_distance': 0
-            }
-
-        # Calcular distancias entre todos los puntos
-        distances = []
-        for i in range(len(all_points)):
-            for j in range(i + 1, len(all_points)):
-                dist = sqrt((all_points[i][0] - all_points[j][0])**2 +
-                           (all_points[i][1] - all_points[j][1])**2)
-                distances.append(dist)
-
-        if distances:
-            return {
-                'min_distance': min(distances),
-                'max_distance': max(distances),
-                'avg_distance': np.mean(distances),
-                'std_distance': np.std(distances),
-                'cv_distance': np.std(distances) / np.mean(distances) if np.mean(distances) > 0 else 0
-            }
-        else:
-            return {
-                'min_distance': 0,
-                'max_distance': 0,
-                'avg_distance': 0,
-                'std_distance': 0,
-                'cv_distance': 0
-            }
-
-    def calculate_clustering_metrics(self):
-        """Calcula métricas de agrupamiento usando un algoritmo simple"""
-        all_points = []
-        for points_list in [self.ki67_points, self.mitosis_points, self.negative_points]:
-            for x, y, _ in points_list:
-                all_points.append([x * self.calibration_scale, y * self.calibration_scale])
-
-        if len(all_points) < 3:
-            return {
-                'clustering_index': 0,
-                'num_clusters': 0,
-                'avg_cluster_size': 0,
-                'cluster_density': 0
-            }
-
-        # Algoritmo simple de agrupamiento por distancia
-        points_array = np.array(all_points)
-        clusters = []
-        visited = set()
-        cluster_distance = 50  # µm - distancia máxima para considerar agrupamiento
-
-        for i, point in enumerate(points_array):
-            if i not in visited:
-                cluster = [i]
-                visited.add(i)
-                queue = [i]
-
-                while queue:
-                    current = queue.pop(0)
-                    for j, other_point in enumerate(points_array):
-                        if j not in visited:
-                            distance = np.linalg.norm(points_array[current] - other_point)
-                            if distance < cluster_distance:
-                                cluster.append(j)
-                                visited.add(j)
-                                queue.append(j)
-
-                if len(cluster) > 1:  # Solo grupos con al menos 2 puntos
-                    clusters.append(cluster)
-
-        # Calcular métricas de agrupamiento
-        if clusters:
-            cluster_sizes = [len(cluster) for cluster in clusters]
-            img_area_mm2 = (self.original_image.width * self.calibration_scale) * \
-                          (self.original_image.height * self.calibration_scale) / 1e6
-
-            return {
-                'clustering_index': len(clusters) / len(all_points) if all_points else 0,
-                'num_clusters': len(clusters),
-                'avg_cluster_size': np.mean(cluster_sizes),
-                'cluster_density': len(clusters) / img_area_mm2 if img_area_mm2 > 0 else 0
-            }
-        else:
-            return {
-                'clustering_index': 0,
-                'num_clusters': 0,
-                'avg_cluster_size': 0,
-                'cluster_density': 0
-            }
+    def calculate_distribution_metrics(self, point_lists=None, progress=None, cache=None, scale=None):
+        """Calcula métricas de distribución espacial (histopath_metrics)
+
+        point_lists y scale permiten trabajar sobre una copia de los
+        marcadores y de la escala (hilo de trabajo); progress(hecho, total)
+        se llama periódicamente.
+        """
+        if point_lists is None:
+            point_lists = [self.ki67_points, self.mitosis_points, self.negative_points]
+        scale = self.calibration_scale if scale is None else scale
+        return distribution_metrics(points_to_um(point_lists, scale), progress, cache)
+
+    def calculate_clustering_metrics(self, point_lists=None, progress=None, cache=None, scale=None, size=None):
+        """Calcula métricas de agrupamiento por distancia (histopath_metrics)
+
+        scale y size (ancho, alto) son copias tomadas en el hilo de Tk;
+        sin ellas se usan las de la imagen actual.
+        """
+        if point_lists is None:
+            point_lists = [self.ki67_points, self.mitosis_points, self.negative_points]
+        scale = self.calibration_scale if scale is None else scale
+        width, height = self.original_image.size if size is None else size
+        area = compute_area_mm2(width, height, scale)
+        return clustering_metrics(points_to_um(point_lists, scale), area, progress=progress, cache=cache)
+
+    def image_content_key(self, image_path):
+        """Hash del archivo de imagen para la caché de resultados; None si no está en disco
+
+        Se llama desde el hilo de trabajo: el hash se memoriza mientras el
+        archivo no cambie, así que solo la primera vez lee la imagen completa.
+        """
+        if image_path and os.path.isfile(image_path):
+            return stat_file_digest(image_path)
+        return None
+
+    def clear_result_cache(self):
+        """Borra los resultados de análisis guardados en disco"""
+        if messagebox.askyesno("Vaciar Caché", "¿Borrar los resultados de análisis guardados en caché?\n"
+                                               "Se volverán a calcular al abrir cada análisis."):
+            result_cache.clear()
+            self.status_bar.config(text="Caché de resultados vaciada.")
 
     def analyze_density(self):
         """Análisis avanzado de densidad"""
@@ -2069,9 +2629,9 @@ class HistoPathAnalyst:
 
     def add_to_recent(self, path, is_image=True):
         ext = os.path.splitext(path)[1].lower()
-        if ext == '.hpa':
+        if ext in PROJECT_EXTENSIONS:
             project_type = 'project'
-        elif ext == '.json':
+        elif ext in ('.json', JSONL_EXTENSION):
             project_type = 'annotation'
         else:
             project_type = 'image'
@@ -2098,8 +2658,7 @@ class HistoPathAnalyst:
 
     def open_project_file(self, path):
         try:
-            with open(path, 'r') as f:
-                project_data = json.load(f)
+            project_data, xs, ys, labels = read_project(path)
             image_path = project_data.get("image_path")
             if not image_path or not os.path.exists(image_path):
                 image_path = filedialog.askopenfilename(
@@ -2108,10 +2667,13 @@ class HistoPathAnalyst:
                 )
                 if not image_path:
                     return
+            image = load_image(image_path)
+            self.release_image()
             self.image_path = image_path
-            self.original_image = Image.open(self.image_path)
-            if self.original_image.mode == 'RGBA':
-                self.original_image = self.original_image.convert('RGB')
+            self.original_image = image
+            self.image_revision += 1
+            self.cancel_inference()
+            self.close_journal()
             self.clear_markers()
             self.zoom_factor = 1.0
             self.pan_x = 0
@@ -2123,26 +2685,22 @@ class HistoPathAnalyst:
             self.contrast_factor = project_data.get("contrast", 1.0)
             self.gamma_factor = project_data.get("gamma", 1.0)
             self.filter_type = project_data.get("filter", "NONE")
+            self.stain_reference_path = project_data.get("stain_reference")
             self.marker_size.set(project_data.get("marker_size", 8))
-            self.display_image = self.original_image.copy()
-            self.apply_all_transforms()
+            self.reset_display_image()
+            self.refresh_filter()
+            # Mostrar la vista general antes de cargar anotaciones y renderizar
+            self.root.update_idletasks()
             self.calibration_scale = project_data.get("calibration_scale", 0.25)
             self.current_project_name.set(project_data.get("project_name", "Sin título"))
             self.scale_label.config(text=f"Escala: {self.calibration_scale:.4f} µm/pixel")
-            annotations = project_data.get("annotations", [])
-            label_map = {
-                1: self.ki67_points,
-                2: self.negative_points,
-                3: self.mitosis_points
-            }
-            for ann in annotations:
-                x, y, label_id = ann.get('x'), ann.get('y'), ann.get('label_id')
-                if x is not None and y is not None and label_id in label_map:
-                    label_map[label_id].append((x, y, None))
+            self.set_points_from_columns(xs, ys, labels)
             self.zoom_fit()
             self.update_all_counts()
             self.redraw_markers()
             self.show_image_info()
+            self.last_save_path = path
+            self.resume_journal(path, project_data.get("journal_generation", 0))
             self.status_bar.config(text=f"Proyecto reciente cargado: {os.path.basename(path)}")
             self.update_quick_metrics()
         except Exception as e:
@@ -2155,23 +2713,14 @@ class HistoPathAnalyst:
             messagebox.showwarning("Sin Imagen", "Por favor, cargue una imagen antes de cargar anotaciones.")
             return
         try:
-            with open(path, 'r') as f:
-                annotations = json.load(f)
-            if not isinstance(annotations, list):
-                raise ValueError("El archivo JSON debe contener una lista de anotaciones.")
+            xs, ys, labels = read_annotations(path)
             self.clear_markers()
-            label_map = {
-                1: self.ki67_points,
-                2: self.negative_points,
-                3: self.mitosis_points
-            }
-            for ann in annotations:
-                x, y, label_id = ann.get('x'), ann.get('y'), ann.get('label_id')
-                if x is not None and y is not None and label_id in label_map:
-                    label_map[label_id].append((x, y, None))
+            self.set_points_from_columns(xs, ys, labels)
+            self.journal_batch(xs, ys, labels)
             self.update_all_counts()
             self.redraw_markers()
             self.status_bar.config(text=f"Anotaciones recientes cargadas: {os.path.basename(path)}")
+            self.compact_project()
             self.update_quick_metrics()
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo cargar las anotaciones:\n{str(e)}")
@@ -2180,8 +2729,14 @@ class HistoPathAnalyst:
 
     def open_image_file(self, path):
         try:
+            image = load_image(path)
+            self.release_image()
             self.image_path = path
-            self.original_image = Image.open(self.image_path)
+            self.original_image = image
+            self.last_save_path = None
+            self.image_revision += 1
+            self.cancel_inference()
+            self.close_journal()
             self.clear_markers()
             self.zoom_factor = 1.0
             self.pan_x = 0
@@ -2193,11 +2748,12 @@ class HistoPathAnalyst:
             self.brightness_factor = 1.0
             self.contrast_factor = 1.0
             self.gamma_factor = 1.0
-            if self.original_image.mode == 'RGBA':
-                self.original_image = self.original_image.convert('RGB')
-            self.display_image = self.original_image.copy()
+            self.reset_display_image()
+            self.apply_slide_calibration()
             self.current_project_name.set(os.path.splitext(os.path.basename(path))[0])
             self.show_image_info()
+            # Mostrar la vista general antes de renderizar la vista principal
+            self.root.update_idletasks()
             self.zoom_fit()
             self.status_bar.config(text=f"Imagen reciente cargada: {os.path.basename(path)}")
             self.add_to_recent(path)
@@ -2270,7 +2826,21 @@ class HistoPathAnalyst:
         )
         messagebox.showinfo("Acerca de HistoPath Analyst", about_text, parent=self.root)
 
+def startup_check(root, app):
+    """Informa del arranque en frío y cierra: falla si supera el presupuesto o carga módulos pesados"""
+    ok = app.startup_time <= STARTUP_BUDGET_S and not app.startup_heavy_modules
+    print(f"Arranque en frío: {app.startup_time:.3f} s (presupuesto {STARTUP_BUDGET_S:.2f} s)")
+    if app.startup_heavy_modules:
+        print(f"Módulos pesados cargados al inicio: {', '.join(app.startup_heavy_modules)}")
+    root.destroy()
+    sys.exit(0 if ok else 1)
+
+
 if __name__ == "__main__":
+    if "--startup-check" in sys.argv:
+        os.environ["HISTOPATH_PREWARM"] = "0"
     root = tk.Tk()
     app = HistoPathAnalyst(root)
+    if "--startup-check" in sys.argv:
+        root.after_idle(lambda: startup_check(root, app))
     root.mainloop()
@@ -0,0 +1,201 @@
+"""
+Caché en disco de HistoPath Analyst.
+
+Claves por contenido (hash de archivo o de píxeles) y rutas dentro del
+directorio de caché, configurable con la variable HISTOPATH_CACHE.
+ResultCache guarda resultados de análisis bajo esas claves, con un tamaño
+máximo en disco y expulsión de los menos usados (LRU).
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+CACHE_DIR = os.environ.get("HISTOPATH_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".histopath_cache"))
+HASH_CHUNK = 1 << 20
+STRIP_ROWS = 256
+# Tamaño máximo de la caché de resultados (MB)
+RESULT_CACHE_MB = int(os.environ.get("HISTOPATH_RESULT_CACHE_MB", 1024))
+RESULT_SUFFIX = ".pkl"
+
+# Hashes de archivo ya calculados: (ruta, tamaño, fecha) -> hash
+_file_digests = {}
+
+
+def file_digest(path):
+    """Hash del contenido de un archivo, leído por bloques"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def stat_file_digest(path):
+    """file_digest memorizado mientras el archivo no cambie de tamaño ni de fecha"""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in _file_digests:
+        _file_digests[key] = file_digest(path)
+    return _file_digests[key]
+
+
+def array_digest(*arrays):
+    """Hash del contenido completo de varios arreglos numpy (repr los trunca)"""
+    import numpy as np
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def image_digest(image):
+    """Hash de los píxeles de una imagen PIL, leída por franjas horizontales"""
+    h = hashlib.blake2b(digest_size=16)
+    width, height = image.size
+    h.update(f"{image.mode}:{width}x{height}".encode())
+    for y in range(0, height, STRIP_ROWS):
+        h.update(image.crop((0, y, width, min(y + STRIP_ROWS, height))).tobytes())
+    return h.hexdigest()
+
+
+def key_digest(*parts):
+    """Combina varias partes de una clave en un único hash corto"""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(repr(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def cache_path(namespace, name):
+    """Ruta de un archivo de caché, creando el subdirectorio si no existe"""
+    directory = os.path.join(CACHE_DIR, namespace)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+class ResultCache:
+    """Resultados de análisis en disco, por clave de contenido, con expulsión LRU
+
+    Cada resultado es un archivo pickle cuyo nombre es la clave; leerlo
+    actualiza su fecha de modificación, que ordena la expulsión cuando el
+    directorio supera max_bytes. Las escrituras son atómicas, así que varios
+    procesos de un lote pueden compartir el mismo directorio.
+    """
+
+    def __init__(self, namespace="results", max_bytes=RESULT_CACHE_MB << 20):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        return os.path.join(CACHE_DIR, self.namespace)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + RESULT_SUFFIX)
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+        except Exception:
+            # Archivo truncado o de una versión incompatible: se descarta
+            self.misses += 1
+            self._remove(path)
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            # Al reescribir una clave, el archivo anterior deja de ocupar espacio
+            path = self._path(key)
+            try:
+                size -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def get_or_compute(self, key, compute):
+        """Valor de la clave; si no está, compute() se calcula y se guarda"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def _scan(self):
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(RESULT_SUFFIX):
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return entries, sum(size for _, size, _ in entries)
+
+    def _evict(self):
+        """Borra los resultados usados hace más tiempo hasta quedar bajo max_bytes
+
+        Se vuelve a leer el directorio: otros procesos pueden haber escrito en él.
+        """
+        entries, total = self._scan()
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        for _, _, path in self._scan()[0]:
+            self._remove(path)
+        self._size = 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Caché de resultados compartida por la interfaz y los lotes
+result_cache = ResultCache()
@@ -0,0 +1,550 @@
+"""
+Motor de color de HistoPath Analyst.
+
+Deconvolución de color H-DAB (Ruifrok & Johnston), normalización de
+tinción (Macenko / Reinhard), cuantización de colores dominantes y
+estadísticas de color en una sola pasada, procesadas por bloques, con tablas de consulta float32 para la densidad
+óptica, de modo que una imagen completa nunca se copia en float64.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from histopath_cache import cache_path, file_digest, image_digest, key_digest
+
+TILE_SIZE = 1024
+
+# Vectores de tinción (filas): Hematoxilina, DAB y residuo (Ruifrok & Johnston, 2001)
+HDAB_STAINS = np.array([
+    [0.650, 0.704, 0.286],
+    [0.268, 0.570, 0.776],
+    [0.000, 0.000, 0.000],
+], dtype=np.float32)
+
+# Densidad óptica por nivel de intensidad: OD = -log10(I / 255), con I >= 1
+OD_LUT = (-np.log10(np.maximum(np.arange(256), 1) / 255.0)).astype(np.float32)
+
+# OD que se asigna al nivel 255 al cuantizar un canal para visualización
+OD_DISPLAY_MAX = 1.5
+
+STAIN_CHANNELS = {"H": 0, "DAB": 1}
+
+# filter_type del visor -> canal de tinción
+STAIN_FILTERS = {"HEMATOXYLIN": "H", "DAB": "DAB"}
+
+# filter_type del visor -> método de normalización
+NORMALIZE_FILTERS = {"NORMALIZE_MACENKO": "macenko", "NORMALIZE_REINHARD": "reinhard"}
+
+# Parámetros de Macenko: umbral de OD de fondo y percentil de los ángulos extremos
+MACENKO_BETA = 0.15
+MACENKO_ALPHA = 1.0
+MAX_FIT_SAMPLES = 250000
+
+# Bits por canal del histograma de color (5 bits -> 32³ bins)
+HIST_BITS = 5
+
+# Píxeles de muestra que se conservan para los gráficos de dispersión y PCA
+PLOT_SAMPLES = 10000
+
+
+def normalize_stains(stains):
+    """Normaliza los vectores de tinción y completa el residuo si falta"""
+    stains = np.array(stains, dtype=np.float32).reshape(3, 3)
+    if not np.any(stains[2]):
+        stains[2] = np.cross(stains[0], stains[1])
+    norms = np.linalg.norm(stains, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (stains / norms).astype(np.float32)
+
+
+def tile_count(image, tile_size=TILE_SIZE):
+    """Número de bloques que recorre iter_tiles"""
+    width, height = image.size
+    return (-(-width // tile_size)) * (-(-height // tile_size))
+
+
+def iter_tiles(image, tile_size=TILE_SIZE):
+    """Recorre la imagen por bloques, devolviendo (x, y, bloque RGB uint8)"""
+    if hasattr(image, "iter_tiles"):
+        yield from image.iter_tiles(tile_size)
+        return
+    needs_convert = image.mode != "RGB"
+    width, height = image.size
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            box = (x, y, min(x + tile_size, width), min(y + tile_size, height))
+            tile = image.crop(box)
+            if needs_convert:
+                tile = tile.convert("RGB")
+            yield x, y, np.asarray(tile)
+
+
+class StainDeconvolver:
+    """Separa una imagen IHC en canales de concentración H y DAB"""
+
+    def __init__(self, stains=HDAB_STAINS, tile_size=TILE_SIZE):
+        self.stains = normalize_stains(stains)
+        self.inverse = np.linalg.inv(self.stains).astype(np.float32)
+        self.tile_size = tile_size
+
+        # Tablas de visualización: nivel de OD cuantizado -> color de la tinción pura
+        levels = np.linspace(0, OD_DISPLAY_MAX, 256, dtype=np.float32)
+        self.display_luts = {}
+        for name, idx in STAIN_CHANNELS.items():
+            rgb = 255.0 * np.power(10.0, -levels[:, None] * self.stains[idx][None, :])
+            self.display_luts[name] = np.clip(rgb, 0, 255).astype(np.uint8)
+
+    def optical_density(self, tile):
+        """Densidad óptica float32 de un bloque RGB uint8"""
+        return OD_LUT[tile]
+
+    def concentrations(self, tile):
+        """Concentraciones (H, DAB, residuo) por píxel de un bloque RGB uint8"""
+        h, w = tile.shape[:2]
+        od = OD_LUT[tile].reshape(-1, 3)
+        conc = od @ self.inverse
+        np.maximum(conc, 0, out=conc)
+        return conc.reshape(h, w, 3)
+
+    def channel(self, tile, name):
+        """Concentración float32 de un solo canal ('H' o 'DAB') de un bloque"""
+        idx = STAIN_CHANNELS[name]
+        h, w = tile.shape[:2]
+        od = OD_LUT[tile].reshape(-1, 3)
+        conc = od @ self.inverse[:, idx]
+        np.maximum(conc, 0, out=conc)
+        return conc.reshape(h, w)
+
+    def channel_image(self, image, name):
+        """Imagen RGB con solo la tinción indicada, como la vería un microscopio"""
+        lut = self.display_luts[name]
+        scale = np.float32(255.0 / OD_DISPLAY_MAX)
+        out = np.empty((image.size[1], image.size[0], 3), dtype=np.uint8)
+        for x, y, tile in iter_tiles(image, self.tile_size):
+            conc = self.channel(tile, name)
+            conc *= scale
+            levels = np.clip(conc, 0, 255).astype(np.uint8)
+            out[y:y + tile.shape[0], x:x + tile.shape[1]] = lut[levels]
+        return Image.fromarray(out)
+
+    def statistics(self, image, dab_threshold=0.3, h_threshold=0.05, progress=None):
+        """Estadísticas de tinción sobre la imagen completa, sin cargarla en float
+
+        progress(hecho, total), si se entrega, se llama tras cada bloque.
+        """
+        n_tiles = tile_count(image, self.tile_size)
+        total = 0
+        sum_h = 0.0
+        sum_dab = 0.0
+        dab_pixels = 0
+        h_pixels = 0
+        for i, (_, _, tile) in enumerate(iter_tiles(image, self.tile_size)):
+            conc = self.concentrations(tile)
+            h_ch = conc[..., 0]
+            dab_ch = conc[..., 1]
+            total += h_ch.size
+            sum_h += float(h_ch.sum(dtype=np.float64))
+            sum_dab += float(dab_ch.sum(dtype=np.float64))
+            dab_pixels += int(np.count_nonzero(dab_ch > dab_threshold))
+            h_pixels += int(np.count_nonzero(h_ch > h_threshold))
+            if progress:
+                progress(i + 1, n_tiles)
+
+        if total == 0:
+            return {'mean_od_h': 0, 'mean_od_dab': 0, 'dab_area_fraction': 0,
+                    'h_area_fraction': 0, 'dab_area_index': 0}
+        # Índice de área DAB: análogo por píxeles al índice Ki-67 por núcleos
+        stained = dab_pixels + h_pixels
+        return {
+            'mean_od_h': sum_h / total,
+            'mean_od_dab': sum_dab / total,
+            'dab_area_fraction': dab_pixels / total,
+            'h_area_fraction': h_pixels / total,
+            'dab_area_index': dab_pixels / stained if stained > 0 else 0
+        }
+
+
+class ColorHistogram:
+    """Histograma RGB 3D (32³ bins) acumulado sobre todos los píxeles por bloques"""
+
+    def __init__(self, bits=HIST_BITS):
+        self.bits = bits
+        self.n_bins = 1 << (3 * bits)
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        # Suma de colores por bin, para obtener el color medio exacto de cada bin
+        self.sums = np.zeros((self.n_bins, 3), dtype=np.float64)
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def bin_index(self, tile):
+        """Índice de bin por píxel de un bloque RGB uint8"""
+        shift = 8 - self.bits
+        q = (tile.reshape(-1, 3) >> shift).astype(np.int32)
+        return (q[:, 0] << (2 * self.bits)) | (q[:, 1] << self.bits) | q[:, 2]
+
+    def update(self, tile):
+        idx = self.bin_index(tile)
+        pixels = tile.reshape(-1, 3)
+        self.counts += np.bincount(idx, minlength=self.n_bins)
+        for c in range(3):
+            self.sums[:, c] += np.bincount(idx, weights=pixels[:, c], minlength=self.n_bins)
+
+    @classmethod
+    def from_image(cls, image, tile_size=TILE_SIZE, bits=HIST_BITS):
+        hist = cls(bits)
+        for _, _, tile in iter_tiles(image, tile_size):
+            hist.update(tile)
+        return hist
+
+    def occupied(self):
+        """Bins no vacíos: (color medio de cada bin, número de píxeles, índices)"""
+        nz = np.flatnonzero(self.counts)
+        counts = self.counts[nz]
+        return self.sums[nz] / counts[:, None], counts, nz
+
+
+def dominant_colors(hist, n_colors=8, seed=42):
+    """Colores dominantes y su fracción exacta de píxeles a partir del histograma
+
+    Agrupa los bins ocupados con MiniBatchKMeans ponderado por número de
+    píxeles; cada color es la media exacta de los píxeles de su grupo.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    bin_colors, counts, _ = hist.occupied()
+    total = counts.sum()
+    if total == 0:
+        return np.zeros((0, 3), dtype=int), np.zeros(0)
+
+    if len(bin_colors) <= n_colors:
+        labels = np.arange(len(bin_colors))
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=n_colors, random_state=seed, n_init=3,
+                                 batch_size=4096)
+        kmeans.fit(bin_colors, sample_weight=counts)
+        labels = kmeans.predict(bin_colors)
+
+    n_found = labels.max() + 1
+    cluster_counts = np.bincount(labels, weights=counts, minlength=n_found)
+    cluster_sums = np.stack([np.bincount(labels, weights=bin_colors[:, c] * counts, minlength=n_found)
+                             for c in range(3)], axis=1)
+    keep = cluster_counts > 0
+    colors = cluster_sums[keep] / cluster_counts[keep, None]
+    fractions = cluster_counts[keep] / total
+
+    order = np.argsort(-fractions)
+    return np.rint(colors[order]).astype(int), fractions[order]
+
+
+class ColorStatistics:
+    """Estadísticas exactas de color acumuladas por bloques en una sola pasada
+
+    Histogramas RGB/HSV por canal, medias, covarianza (para PCA), percentiles
+    y el histograma 3D de colores dominantes, con memoria constante. Además
+    conserva una muestra uniforme de píxeles (reservorio con semilla) para
+    los gráficos de dispersión, de modo que el resultado es reproducible.
+    """
+
+    def __init__(self, n_samples=PLOT_SAMPLES, seed=42, color_hist=True):
+        self.total = 0
+        self.rgb_hist = np.zeros((3, 256), dtype=np.int64)
+        self.hsv_hist = np.zeros((3, 256), dtype=np.int64)
+        self._sum = np.zeros(3, dtype=np.float64)
+        self._outer = np.zeros((3, 3), dtype=np.float64)
+        self.color_hist = ColorHistogram() if color_hist else None
+
+        self.n_samples = n_samples
+        self._rng = np.random.default_rng(seed)
+        self._keys = np.empty(0, dtype=np.float64)
+        self.sample = np.empty((0, 3), dtype=np.uint8)
+        self.sample_hsv = np.empty((0, 3), dtype=np.uint8)
+
+    def update(self, tile):
+        import cv2
+        pixels = tile.reshape(-1, 3)
+        hsv = cv2.cvtColor(np.ascontiguousarray(tile), cv2.COLOR_RGB2HSV).reshape(-1, 3)
+        self.total += len(pixels)
+        for c in range(3):
+            self.rgb_hist[c] += np.bincount(pixels[:, c], minlength=256)
+            self.hsv_hist[c] += np.bincount(hsv[:, c], minlength=256)
+
+        # Momentos de primer y segundo orden (centrados en 128 para estabilidad numérica)
+        centered = pixels - 128.0
+        self._sum += centered.sum(axis=0)
+        self._outer += centered.T @ centered
+
+        if self.color_hist is not None:
+            self.color_hist.update(tile)
+        self._update_sample(pixels, hsv)
+
+    def _update_sample(self, pixels, hsv):
+        """Muestreo uniforme sin reemplazo: conserva las n claves aleatorias menores"""
+        keys = self._rng.random(len(pixels))
+        if len(keys) > self.n_samples:
+            part = np.argpartition(keys, self.n_samples)[:self.n_samples]
+            keys, pixels, hsv = keys[part], pixels[part], hsv[part]
+        keys = np.concatenate([self._keys, keys])
+        sample = np.concatenate([self.sample, pixels])
+        sample_hsv = np.concatenate([self.sample_hsv, hsv])
+        if len(keys) > self.n_samples:
+            keep = np.argpartition(keys, self.n_samples)[:self.n_samples]
+            keys, sample, sample_hsv = keys[keep], sample[keep], sample_hsv[keep]
+        self._keys, self.sample, self.sample_hsv = keys, sample, sample_hsv
+
+    @classmethod
+    def from_image(cls, image, tile_size=TILE_SIZE, progress=None, **kwargs):
+        stats = cls(**kwargs)
+        n_tiles = tile_count(image, tile_size)
+        for i, (_, _, tile) in enumerate(iter_tiles(image, tile_size)):
+            stats.update(tile)
+            if progress:
+                progress(i + 1, n_tiles)
+        return stats
+
+    @property
+    def mean(self):
+        return self._sum / max(self.total, 1) + 128.0
+
+    @property
+    def covariance(self):
+        n = max(self.total, 1)
+        centered_mean = self._sum / n
+        return self._outer / n - np.outer(centered_mean, centered_mean)
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(np.diag(self.covariance), 0))
+
+    def percentile(self, q, space="rgb"):
+        """Percentil exacto por canal a partir del histograma de 256 niveles"""
+        hist = self.rgb_hist if space == "rgb" else self.hsv_hist
+        cdf = np.cumsum(hist, axis=1)
+        target = np.ceil(q / 100.0 * cdf[:, -1:]).clip(min=1)
+        return (cdf < target).sum(axis=1)
+
+    def pca(self):
+        """Componentes principales a partir de la covarianza exacta
+
+        Devuelve (componentes por filas, varianza explicada, proporción de varianza).
+        """
+        eigvals, eigvecs = np.linalg.eigh(self.covariance)
+        order = np.argsort(eigvals)[::-1]
+        eigvals = np.maximum(eigvals[order], 0)
+        components = eigvecs[:, order].T
+        # Signo determinista: componente con mayor peso positivo
+        signs = np.sign(components[np.arange(3), np.abs(components).argmax(axis=1)])
+        components *= signs[:, None]
+        total_var = eigvals.sum()
+        ratio = eigvals / total_var if total_var > 0 else np.zeros(3)
+        return components, eigvals, ratio
+
+    def project(self, pixels):
+        """Proyecta píxeles RGB sobre las componentes principales"""
+        components, _, _ = self.pca()
+        return (pixels.astype(np.float64) - self.mean) @ components.T
+
+
+def _fit_stride(image, max_samples):
+    """Paso de submuestreo determinista para acotar los píxeles de ajuste"""
+    width, height = image.size
+    return max(1, int(np.ceil(width * height / max_samples)))
+
+
+class StainNormalizer:
+    """Normaliza la tinción de una imagen hacia la de una imagen de referencia"""
+
+    METHODS = ("macenko", "reinhard")
+
+    def __init__(self, method="macenko", tile_size=TILE_SIZE):
+        if method not in self.METHODS:
+            raise ValueError(f"Método de normalización desconocido: {method}")
+        self.method = method
+        self.tile_size = tile_size
+        self.target = None
+
+    # --- Ajuste de parámetros ---
+    def estimate(self, image):
+        """Estima los parámetros de tinción de una imagen (Macenko o Reinhard)"""
+        if self.method == "macenko":
+            return self._estimate_macenko(image)
+        return self._estimate_reinhard(image)
+
+    def fit(self, reference):
+        """Fija la referencia objetivo a partir de una imagen"""
+        self.target = self.estimate(reference)
+        return self
+
+    def _estimate_macenko(self, image):
+        stride = _fit_stride(image, MAX_FIT_SAMPLES)
+        samples = []
+        for _, _, tile in iter_tiles(image, self.tile_size):
+            od = OD_LUT[tile].reshape(-1, 3)[::stride]
+            samples.append(od[np.all(od > MACENKO_BETA, axis=1)])
+        od = np.concatenate(samples) if samples else np.empty((0, 3), np.float32)
+        if len(od) < 10:
+            raise ValueError("La imagen no tiene suficiente tejido teñido para estimar la tinción.")
+
+        # Plano de los dos autovectores principales de la OD
+        _, eigvecs = np.linalg.eigh(np.cov(od, rowvar=False))
+        plane = eigvecs[:, 1:3].astype(np.float32)
+        proj = od @ plane
+        phi = np.arctan2(proj[:, 1], proj[:, 0])
+        min_phi = np.percentile(phi, MACENKO_ALPHA)
+        max_phi = np.percentile(phi, 100 - MACENKO_ALPHA)
+        v_min = plane @ np.array([np.cos(min_phi), np.sin(min_phi)], dtype=np.float32)
+        v_max = plane @ np.array([np.cos(max_phi), np.sin(max_phi)], dtype=np.float32)
+
+        # Hematoxilina primero: mayor componente en el canal rojo
+        stains = np.array([v_min, v_max] if v_min[0] > v_max[0] else [v_max, v_min], dtype=np.float32)
+        stains *= np.sign(stains.sum(axis=1, keepdims=True))
+        stains /= np.linalg.norm(stains, axis=1, keepdims=True)
+
+        conc = od @ np.linalg.pinv(stains).astype(np.float32)
+        max_conc = np.percentile(conc, 99, axis=0).astype(np.float32)
+        return {'stains': stains.tolist(), 'max_conc': max_conc.tolist()}
+
+    def _estimate_reinhard(self, image):
+        import cv2
+        total = 0
+        sums = np.zeros(3, dtype=np.float64)
+        sq_sums = np.zeros(3, dtype=np.float64)
+        for _, _, tile in iter_tiles(image, self.tile_size):
+            lab = cv2.cvtColor(np.ascontiguousarray(tile), cv2.COLOR_RGB2LAB).reshape(-1, 3)
+            lab = lab.astype(np.float32)
+            total += len(lab)
+            sums += lab.sum(axis=0, dtype=np.float64)
+            sq_sums += np.square(lab).sum(axis=0, dtype=np.float64)
+        mean = sums / max(total, 1)
+        std = np.sqrt(np.maximum(sq_sums / max(total, 1) - mean ** 2, 1e-6))
+        return {'mean': mean.tolist(), 'std': std.tolist()}
+
+    # --- Aplicación ---
+    def transform(self, image, source=None):
+        """Normaliza una imagen PIL completa, bloque a bloque"""
+        if self.target is None:
+            raise ValueError("El normalizador no tiene referencia; llame a fit() primero.")
+        source = source or self.estimate(image)
+        if self.method == "macenko":
+            apply_tile = self._macenko_tile_fn(source)
+        else:
+            apply_tile = self._reinhard_tile_fn(source)
+
+        out = np.empty((image.size[1], image.size[0], 3), dtype=np.uint8)
+        for x, y, tile in iter_tiles(image, self.tile_size):
+            out[y:y + tile.shape[0], x:x + tile.shape[1]] = apply_tile(tile)
+        return Image.fromarray(out)
+
+    def _macenko_tile_fn(self, source):
+        src_pinv = np.linalg.pinv(np.array(source['stains'], dtype=np.float32)).astype(np.float32)
+        tgt_stains = np.array(self.target['stains'], dtype=np.float32)
+        scale = (np.array(self.target['max_conc'], dtype=np.float32) /
+                 np.maximum(np.array(source['max_conc'], dtype=np.float32), 1e-6))
+        # Proyección combinada OD origen -> OD destino (3x3)
+        mapping = (src_pinv * scale[None, :]) @ tgt_stains
+        log_255 = np.float32(np.log(255.0))
+        ln10 = np.float32(np.log(10.0))
+
+        def apply_tile(tile):
+            h, w = tile.shape[:2]
+            od = OD_LUT[tile].reshape(-1, 3) @ mapping
+            np.maximum(od, 0, out=od)
+            # I = 255 * 10^(-OD), evaluado en float32
+            od *= -ln10
+            od += log_255
+            np.exp(od, out=od)
+            return np.clip(od, 0, 255).astype(np.uint8).reshape(h, w, 3)
+        return apply_tile
+
+    def _reinhard_tile_fn(self, source):
+        import cv2
+        src_mean = np.array(source['mean'], dtype=np.float32)
+        gain = np.array(self.target['std'], dtype=np.float32) / np.array(source['std'], dtype=np.float32)
+        offset = np.array(self.target['mean'], dtype=np.float32) - src_mean * gain
+
+        def apply_tile(tile):
+            lab = cv2.cvtColor(np.ascontiguousarray(tile), cv2.COLOR_RGB2LAB).astype(np.float32)
+            lab *= gain
+            lab += offset
+            lab = np.clip(lab, 0, 255).astype(np.uint8)
+            return cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+        return apply_tile
+
+
+# Referencias ya ajustadas en esta sesión: (hash de referencia, método) -> normalizador
+_fitted_normalizers = {}
+
+
+def get_normalizer(reference_path, method="macenko"):
+    """Normalizador ajustado a una referencia, ajustado una sola vez y guardado en disco"""
+    ref_digest = file_digest(reference_path)
+    key = (ref_digest, method)
+    if key in _fitted_normalizers:
+        return _fitted_normalizers[key]
+
+    normalizer = StainNormalizer(method)
+    target_file = cache_path("stain_targets", f"{method}-{ref_digest}.json")
+    if os.path.exists(target_file):
+        with open(target_file, 'r') as f:
+            normalizer.target = json.load(f)
+    else:
+        with Image.open(reference_path) as ref:
+            normalizer.fit(ref.convert("RGB"))
+        with open(target_file, 'w') as f:
+            json.dump(normalizer.target, f)
+    normalizer.reference_digest = ref_digest
+    _fitted_normalizers[key] = normalizer
+    return normalizer
+
+
+def normalize_image(image, reference_path, method="macenko", source_digest=None):
+    """Normaliza una imagen usando la caché en disco (hash origen, referencia, método)"""
+    normalizer = get_normalizer(reference_path, method)
+    if source_digest is None:
+        source_digest = image_digest(image)
+    cached = cache_path("normalized",
+                        key_digest(source_digest, normalizer.reference_digest, method) + ".png")
+    if os.path.exists(cached):
+        with Image.open(cached) as img:
+            return img.convert("RGB")
+    result = normalizer.transform(image if image.mode == "RGB" else image.convert("RGB"))
+    tmp_path = cached + ".tmp.png"
+    result.save(tmp_path)
+    os.replace(tmp_path, cached)
+    return result
+
+
+def normalize_files(paths, reference_path, method="macenko", output_dir=None):
+    """Preprocesamiento por lotes: normaliza una lista de imágenes en disco"""
+    results = []
+    for path in paths:
+        with Image.open(path) as img:
+            normalized = normalize_image(img.convert("RGB"), reference_path, method,
+                                         source_digest=file_digest(path))
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            out_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".png")
+            normalized.save(out_path)
+            results.append(out_path)
+        else:
+            results.append(normalized)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Normalización de tinción por lotes (HistoPath Analyst)")
+    parser.add_argument("images", nargs="+", help="Imágenes a normalizar")
+    parser.add_argument("--reference", required=True, help="Imagen de referencia de tinción")
+    parser.add_argument("--method", choices=StainNormalizer.METHODS, default="macenko")
+    parser.add_argument("--output", required=True, help="Directorio de salida")
+    args = parser.parse_args(argv)
+    for out_path in normalize_files(args.images, args.reference, args.method, args.output):
+        print(out_path)
+
+
+if __name__ == "__main__":
+    main()
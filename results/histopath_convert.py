@@ -0,0 +1,258 @@
+"""
+Conversión del modelo PathoNet para la inferencia en CPU de HistoPath Analyst.
+
+El modelo Keras del entrenamiento se exporta a un grafo ONNX (tf2onnx),
+que onnxruntime evalúa sin TensorFlow. Opcionalmente el grafo se cuantiza
+a int8 (pesos por canal, activaciones calibradas con parches de imágenes
+de referencia) y una comprobación de paridad compara, imagen por imagen,
+los conteos del modelo cuantizado con los del modelo en float sobre
+imágenes distintas de las de calibración: si alguno se aparta más de la
+tolerancia, el modelo cuantizado se descarta.
+
+    python histopath_convert.py export pathonet_ki67.h5
+    python histopath_convert.py quantize pathonet_ki67.onnx --reference cal/*.jpg --holdout val/*.jpg
+    python histopath_convert.py parity pathonet_ki67.onnx pathonet_ki67.int8.onnx ref/*.jpg -o paridad.csv
+"""
+import argparse
+import os
+import shutil
+
+import numpy as np
+
+from histopath_inference import (INFERENCE_CPUS, INFERENCE_THREADS, NMS_RADIUS, PATCH_SIZE, PathoNetEngine,
+                                 model_stem)
+from histopath_io import is_lazy_image, load_image
+from histopath_project import LABEL_IDS
+
+ONNX_OPSET = 13
+# Parches de referencia para calibrar las activaciones int8
+CALIBRATION_PATCHES = 256
+# Diferencia relativa de conteo admitida por clase e imagen
+PARITY_TOLERANCE = 0.05
+# Conteo mínimo del denominador, para que pocas diferencias en conteos bajos no pesen de más
+PARITY_MIN_COUNT = 20
+
+
+def copy_config(model_path, exported_path):
+    """Copia el .json de parámetros del modelo junto a su versión exportada, si son distintos"""
+    source, target = model_stem(model_path) + ".json", model_stem(exported_path) + ".json"
+    if os.path.exists(source) and os.path.abspath(source) != os.path.abspath(target):
+        shutil.copyfile(source, target)
+
+
+def discard_model(model_path, source_path):
+    """Borra un modelo exportado y el .json que copy_config dejó junto a él (no el del modelo de origen)"""
+    os.remove(model_path)
+    config, source_config = model_stem(model_path) + ".json", model_stem(source_path) + ".json"
+    if os.path.exists(config) and os.path.abspath(config) != os.path.abspath(source_config):
+        os.remove(config)
+
+
+def split_references(images):
+    """Reparte imágenes de referencia en (calibración, paridad), alternando en orden de ruta
+
+    La paridad se comprueba sobre imágenes que la calibración no vio.
+    """
+    images = sorted(images)
+    if len(images) < 2:
+        raise ValueError("Se necesitan al menos dos imágenes de referencia para separar calibración y paridad")
+    return images[0::2], images[1::2]
+
+
+def export_onnx(model_path, onnx_path=None, opset=ONNX_OPSET):
+    """Exporta el modelo Keras a ONNX con lotes de tamaño variable -> ruta del .onnx"""
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+    import tensorflow as tf
+    import tf2onnx
+
+    onnx_path = onnx_path or model_stem(model_path) + ".onnx"
+    model = tf.keras.models.load_model(model_path, compile=False)
+    spec = (tf.TensorSpec((None, PATCH_SIZE, PATCH_SIZE, 3), tf.float32, name="input"),)
+    tmp_path = onnx_path + ".tmp"
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=opset, output_path=tmp_path)
+    os.replace(tmp_path, onnx_path)
+    copy_config(model_path, onnx_path)
+    return onnx_path
+
+
+def calibration_patches(images, max_patches=CALIBRATION_PATCHES):
+    """Parches float32 repartidos de forma pareja entre las imágenes de referencia"""
+    engine = PathoNetEngine(model=None, batch_size=1)
+    per_image = max(1, max_patches // max(1, len(images)))
+    for path in images:
+        image = load_image(path)
+        try:
+            boxes = engine.patch_boxes(*image.size)
+            step = max(1, len(boxes) // per_image)
+            for patches, _ in engine.iter_batches(image, boxes[::step][:per_image]):
+                yield patches
+        finally:
+            if is_lazy_image(image):
+                image.close()
+
+
+def quantize_onnx(onnx_path, output_path, reference_images, max_patches=CALIBRATION_PATCHES):
+    """Cuantización estática int8 (QDQ): pesos por canal, activaciones calibradas con las referencias"""
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class PatchReader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.patches = calibration_patches(reference_images, max_patches)
+
+        def get_next(self):
+            patch = next(self.patches, None)
+            return None if patch is None else {self.input_name: patch}
+
+    import onnxruntime as ort
+    input_name = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    prepared = output_path + ".prep.onnx"
+    try:
+        quant_pre_process(onnx_path, prepared)
+        quantize_static(prepared, output_path, PatchReader(input_name), quant_format=QuantFormat.QDQ,
+                        per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    finally:
+        if os.path.exists(prepared):
+            os.remove(prepared)
+    copy_config(onnx_path, output_path)
+    return output_path
+
+
+def _matched_fraction(reference, candidate, radius=NMS_RADIUS):
+    """Fracción de núcleos de referencia con un núcleo de la misma clase a menos de radius"""
+    from scipy.spatial import cKDTree
+
+    ref_x, ref_y, ref_labels = reference
+    cand_x, cand_y, cand_labels = candidate
+    if not len(ref_x):
+        return 1.0
+    matched = 0
+    for label_id in np.unique(ref_labels):
+        ref_mask, cand_mask = ref_labels == label_id, cand_labels == label_id
+        if not cand_mask.any():
+            continue
+        tree = cKDTree(np.column_stack([cand_x[cand_mask], cand_y[cand_mask]]))
+        distances, _ = tree.query(np.column_stack([ref_x[ref_mask], ref_y[ref_mask]]),
+                                  distance_upper_bound=radius)
+        matched += int(np.count_nonzero(np.isfinite(distances)))
+    return matched / len(ref_x)
+
+
+def parity_check(reference_model, candidate_model, images, tolerance=PARITY_TOLERANCE,
+                 threads=INFERENCE_THREADS, cpus=INFERENCE_CPUS, progress=None):
+    """Compara los conteos por clase de dos modelos sobre imágenes de referencia -> (filas, aprobado)
+
+    Una imagen aprueba si en cada clase |conteo candidato - conteo referencia|
+    / max(conteo referencia, PARITY_MIN_COUNT) no supera tolerance.
+    """
+    reference = PathoNetEngine.from_file(reference_model, threads, cpus)
+    candidate = PathoNetEngine.from_file(candidate_model, threads, cpus)
+    rows = []
+    for i, path in enumerate(images):
+        image = load_image(path)
+        try:
+            ref_points = reference.detect(image)
+            cand_points = candidate.detect(image)
+        finally:
+            if is_lazy_image(image):
+                image.close()
+        row = {'image': path}
+        worst = 0.0
+        for name, label_id in LABEL_IDS.items():
+            n_ref = int(np.count_nonzero(ref_points[2] == label_id))
+            n_cand = int(np.count_nonzero(cand_points[2] == label_id))
+            row[f'n_{name}_reference'] = n_ref
+            row[f'n_{name}_candidate'] = n_cand
+            worst = max(worst, abs(n_cand - n_ref) / max(n_ref, PARITY_MIN_COUNT))
+        row['max_count_difference'] = worst
+        row['matched_fraction'] = _matched_fraction(ref_points, cand_points)
+        row['passed'] = worst <= tolerance
+        rows.append(row)
+        if progress:
+            progress(i + 1, len(images))
+    return rows, all(row['passed'] for row in rows)
+
+
+def _print_parity(rows, tolerance):
+    for row in rows:
+        status = "ok" if row['passed'] else "FUERA DE TOLERANCIA"
+        print(f"  {os.path.basename(row['image'])}: diferencia máx. {row['max_count_difference']:.1%}, "
+              f"coincidencia {row['matched_fraction']:.1%} [{status}]")
+    passed = sum(row['passed'] for row in rows)
+    print(f"{passed}/{len(rows)} imágenes dentro de la tolerancia ({tolerance:.0%})")
+
+
+def main(argv=None):
+    """python histopath_convert.py {export,quantize,parity} ..."""
+    parser = argparse.ArgumentParser(description="Exportación y cuantización del modelo PathoNet para CPU")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Keras (.keras/.h5) -> ONNX")
+    export.add_argument("model", help="Modelo Keras entrenado")
+    export.add_argument("-o", "--output", default=None, help="Grafo ONNX (por defecto junto al modelo)")
+    export.add_argument("--opset", type=int, default=ONNX_OPSET, help="Versión de operadores ONNX")
+
+    quantize = commands.add_parser("quantize", help="ONNX float -> ONNX int8, con comprobación de paridad")
+    quantize.add_argument("model", help="Grafo ONNX en float")
+    quantize.add_argument("--reference", nargs="+", required=True,
+                          help="Imágenes de referencia para calibrar las activaciones")
+    quantize.add_argument("--holdout", nargs="+", default=None,
+                          help="Imágenes para la comprobación de paridad, distintas de las de calibración "
+                               "(por defecto se separan las de --reference, alternando)")
+    quantize.add_argument("-o", "--output", default=None, help="Grafo int8 (por defecto <modelo>.int8.onnx)")
+    quantize.add_argument("--patches", type=int, default=CALIBRATION_PATCHES, help="Parches de calibración")
+    quantize.add_argument("--tolerance", type=float, default=PARITY_TOLERANCE,
+                          help="Diferencia relativa de conteo admitida")
+
+    parity = commands.add_parser("parity", help="Compara los conteos de dos modelos")
+    parity.add_argument("reference", help="Modelo de referencia (float)")
+    parity.add_argument("candidate", help="Modelo a comprobar (p. ej. int8)")
+    parity.add_argument("images", nargs="+", help="Imágenes de referencia")
+    parity.add_argument("--tolerance", type=float, default=PARITY_TOLERANCE,
+                        help="Diferencia relativa de conteo admitida")
+    parity.add_argument("-o", "--output", default=None, help="Tabla con los conteos (.csv o .parquet)")
+    for command in (quantize, parity):
+        command.add_argument("--threads", type=int, default=INFERENCE_THREADS, help="Lotes evaluados en paralelo")
+        command.add_argument("--cpus", type=int, default=INFERENCE_CPUS, help="Núcleos totales para la inferencia")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        print(f"Exportado: {export_onnx(args.model, args.output, args.opset)}")
+        return 0
+
+    if args.command == "quantize":
+        output = args.output or model_stem(args.model) + ".int8.onnx"
+        if args.holdout:
+            calibration, holdout = args.reference, args.holdout
+            if set(map(os.path.abspath, calibration)) & set(map(os.path.abspath, holdout)):
+                parser.error("--holdout no debe repetir imágenes de --reference")
+        else:
+            try:
+                calibration, holdout = split_references(args.reference)
+            except ValueError as e:
+                parser.error(str(e))
+        quantize_onnx(args.model, output, calibration, args.patches)
+        rows, passed = parity_check(args.model, output, holdout, args.tolerance, args.threads, args.cpus)
+        _print_parity(rows, args.tolerance)
+        if not passed:
+            # Un modelo fuera de tolerancia no debe quedar donde find_model lo preferiría
+            discard_model(output, args.model)
+            print(f"Modelo cuantizado descartado: {output}")
+            return 1
+        print(f"Cuantizado: {output}")
+        return 0
+
+    rows, passed = parity_check(args.reference, args.candidate, args.images, args.tolerance,
+                                args.threads, args.cpus)
+    _print_parity(rows, args.tolerance)
+    if args.output:
+        from histopath_metrics import write_table
+        write_table(rows, args.output)
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
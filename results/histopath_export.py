@@ -0,0 +1,371 @@
+"""
+Exportación de imágenes con marcadores de HistoPath Analyst.
+
+Los marcadores no se dibujan uno a uno: cada clase tiene un anillo
+precalculado (sprite) cuyos desplazamientos se estampan de una vez, con
+indexado vectorizado, en cada bloque que se escribe. MarkerOverlay es una
+vista perezosa de la imagen con los marcadores aplicados, con la interfaz
+read_region que usa write_pyramid; así una imagen grande se exporta como
+TIFF piramidal en mosaico sin tener nunca una copia RGB completa en memoria.
+
+batch_export recorre un directorio de imágenes con sus anotaciones y
+exporta las superposiciones en paralelo en un grupo de procesos, cada uno
+con un presupuesto de memoria acotado; un manifiesto en el directorio de
+salida permite saltar las que ya están al día. También como CLI:
+
+    python histopath_export.py imagenes/ -o superposiciones/ --jobs 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+import histopath_io
+from histopath_cache import file_digest, key_digest
+from histopath_io import (IMAGE_EXTENSIONS, LAZY_MIN_PIXELS, TIFF_EXTENSIONS, is_lazy_image, load_image,
+                          region_reader, write_pyramid)
+from histopath_project import ANNOTATION_EXTENSIONS, atomic_write, read_points
+
+# Píxeles de contexto que se leen alrededor de cada bloque para que los
+# filtros de vecindad (desenfoque, realce) no marquen las uniones
+EXPORT_MARGIN = 8
+
+# Colores por label_id en el orden de dibujo de export_results (Ki-67+, mitosis, Ki-67-)
+LABEL_COLORS = {1: "#ff4d4d", 3: "#4dff4d", 2: "#4d4dff"}
+MARKER_RADIUS = 8
+OVERLAY_SUFFIX = "_overlay"
+MANIFEST_NAME = ".histopath_export.json"
+# El manifiesto se guarda cada tantas imágenes, para poder reanudar un lote interrumpido
+MANIFEST_SAVE_EVERY = 32
+# Memoria por proceso de exportación (MB); limita la caché de bloques y
+# decide a partir de qué tamaño las imágenes se leen de forma perezosa
+WORKER_MEMORY_MB = int(os.environ.get("HISTOPATH_EXPORT_WORKER_MB", "1024"))
+
+
+def ring_sprite(radius, width, narrow_x=False, narrow_y=False):
+    """Desplazamientos (dy, dx) de los píxeles de un anillo, igual que ImageDraw.ellipse(outline)
+
+    narrow_x / narrow_y acortan la caja un píxel por la izquierda / arriba,
+    como le ocurre a ImageDraw cuando ese borde cae en una coordenada
+    negativa no entera y se trunca hacia cero.
+    """
+    size = 2 * radius + 1
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse([int(narrow_x), int(narrow_y), 2 * radius, 2 * radius], outline=255, width=width)
+    dy, dx = np.nonzero(np.asarray(mask))
+    return dy - radius, dx - radius
+
+
+def needs_tiled_export(image):
+    """Las imágenes perezosas se exportan por bloques a TIFF; las que ya están en memoria, con PIL"""
+    return is_lazy_image(image)
+
+
+def is_tiff_path(path):
+    return os.path.splitext(path)[1].lower() in TIFF_EXTENSIONS
+
+
+class MarkerOverlay:
+    """Vista perezosa de una imagen con anillos estampados en las coordenadas de los marcadores
+
+    layers es una lista de (xs, ys, color) en orden de dibujo; las
+    coordenadas son las del nivel 0 y pueden tener decimales: como en
+    ImageDraw.ellipse, cada borde de la caja del anillo se trunca hacia cero,
+    así que a tamaño completo el resultado es idéntico al de dibujar con
+    ImageDraw. Las lecturas reducidas estampan un anillo reducido en la
+    misma proporción. transform(PIL) -> PIL se aplica
+    a cada bloque ya marcado, con un margen de contexto alrededor.
+    """
+
+    mode = "RGB"
+
+    def __init__(self, image, layers, radius, width, transform=None, margin=0):
+        self.image = image
+        self.size = image.size
+        self.width, self.height = image.size
+        self.radius = radius
+        self.line_width = width
+        self.transform = transform
+        self.margin = margin if transform else 0
+        self._read = region_reader(image)
+        self._sprites = {}
+        self._layers = []
+        for xs, ys, color in layers:
+            xs = np.asarray(xs, dtype=np.float64)
+            ys = np.asarray(ys, dtype=np.float64)
+            # Centro desde el borde derecho / inferior truncado; kind marca los
+            # anillos cuyo borde izquierdo (bit 0) o superior (bit 1) quedó un píxel más adentro
+            cx = np.trunc(xs + radius).astype(np.int64) - radius
+            cy = np.trunc(ys + radius).astype(np.int64) - radius
+            kind = ((np.trunc(xs - radius).astype(np.int64) - (cx - radius)) +
+                    2 * (np.trunc(ys - radius).astype(np.int64) - (cy - radius)))
+            # Ordenadas por y: cada bloque busca su franja con searchsorted
+            order = np.argsort(cy, kind="stable")
+            rgb = np.array(ImageColor.getrgb(color)[:3], dtype=np.uint8)
+            self._layers.append((cx[order], cy[order], kind[order], rgb))
+
+    def sprite(self, factor, kind=0):
+        """Anillo para un factor de reducción (al menos un píxel de radio y de grosor)"""
+        if (factor, kind) not in self._sprites:
+            radius = max(1, int(round(self.radius / factor)))
+            width = max(1, int(round(self.line_width / factor)))
+            self._sprites[factor, kind] = (radius, ring_sprite(radius, width, kind & 1, kind >> 1))
+        return self._sprites[factor, kind]
+
+    def stamp(self, block, origin, factor=1):
+        """Estampa los anillos en block (H×W×3, escribible); origin es su esquina en el nivel 0"""
+        x0, y0 = origin
+        h, w = block.shape[:2]
+        radius = self.sprite(factor)[0]
+        reach = (radius + 1) * factor
+        for xs, ys, kinds, rgb in self._layers:
+            start, stop = np.searchsorted(ys, [y0 - reach, y0 + h * factor + reach])
+            band_x, band_y = xs[start:stop], ys[start:stop]
+            inside = (band_x >= x0 - reach) & (band_x < x0 + w * factor + reach)
+            if not inside.any():
+                continue
+            cx = (band_x[inside] - x0) // factor
+            cy = (band_y[inside] - y0) // factor
+            # Los anillos recortados solo importan a tamaño completo
+            band_kinds = kinds[start:stop][inside] if factor == 1 else np.zeros(len(cx), dtype=np.int64)
+            for kind in np.unique(band_kinds):
+                dy, dx = self.sprite(factor, int(kind))[1]
+                selected = band_kinds == kind
+                px = (cx[selected, None] + dx[None, :]).ravel()
+                py = (cy[selected, None] + dy[None, :]).ravel()
+                valid = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+                block[py[valid], px[valid]] = rgb
+        return block
+
+    def read_region(self, box, factor=1):
+        """Región reducida por factor, con marcadores y transformación, como arreglo RGB uint8"""
+        x0, y0, x1, y1 = box
+        pad = self.margin * factor
+        outer = (max(0, x0 - pad), max(0, y0 - pad),
+                 min(self.width, x1 + pad), min(self.height, y1 + pad))
+        block = np.array(self._read(outer, factor), dtype=np.uint8)
+        self.stamp(block, outer[:2], factor)
+        if self.transform:
+            block = np.asarray(self.transform(Image.fromarray(block)).convert("RGB"))
+        left, top = (x0 - outer[0]) // factor, (y0 - outer[1]) // factor
+        return block[top:top + -(-(y1 - y0) // factor), left:left + -(-(x1 - x0) // factor)]
+
+    def region(self, box, factor=1):
+        return Image.fromarray(self.read_region(box, factor))
+
+    def to_image(self):
+        """Imagen completa con los marcadores; solo para imágenes que caben en memoria"""
+        return self.region((0, 0, self.width, self.height))
+
+
+def export_overlay(image, path, layers, radius, width, transform=None, tile_transform=None,
+                   microns_per_pixel=None, progress=None):
+    """Guarda la imagen con los marcadores estampados
+
+    Las imágenes perezosas se escriben por bloques como TIFF
+    piramidal comprimido, aplicando tile_transform a cada bloque; las demás
+    se materializan, se les aplica transform completa y se guardan con PIL.
+    """
+    if needs_tiled_export(image):
+        if not is_tiff_path(path):
+            raise ValueError("Las imágenes grandes solo se pueden exportar como TIFF (.tif)")
+        overlay = MarkerOverlay(image, layers, radius, width, tile_transform, EXPORT_MARGIN)
+        return write_pyramid(overlay, path, microns_per_pixel=microns_per_pixel, progress=progress)
+    result = MarkerOverlay(image, layers, radius, width).to_image()
+    if transform:
+        result = transform(result)
+    image_format = Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+    with atomic_write(path, 'wb') as f:
+        result.save(f, format=image_format)
+    if progress:
+        progress(1, 1)
+    return path
+
+
+# --- Exportación por lotes ---
+
+def marker_width(radius):
+    return max(2, int(radius / 4))
+
+
+def layers_from_columns(xs, ys, labels, colors=LABEL_COLORS):
+    """Capas (xs, ys, color) de export_overlay a partir de columnas (x, y, label_id)"""
+    labels = np.asarray(labels)
+    return [(np.asarray(xs)[labels == label_id], np.asarray(ys)[labels == label_id], color)
+            for label_id, color in colors.items()]
+
+
+def find_annotated_images(directory):
+    """Pares (imagen, anotaciones) de un directorio, emparejados por nombre base"""
+    names = set(os.listdir(directory))
+    pairs = []
+    for name in sorted(names):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTENSIONS or stem.endswith(OVERLAY_SUFFIX):
+            continue
+        for annotation_ext in ANNOTATION_EXTENSIONS:
+            if stem + annotation_ext in names:
+                pairs.append((os.path.join(directory, name), os.path.join(directory, stem + annotation_ext)))
+                break
+    return pairs
+
+
+def overlay_path(image_path, output_dir):
+    """Salida de una imagen: TIFF si la entrada es TIFF, PNG en otro caso"""
+    stem, ext = os.path.splitext(os.path.basename(image_path))
+    out_ext = ".tif" if ext.lower() in TIFF_EXTENSIONS else ".png"
+    return os.path.join(output_dir, stem + OVERLAY_SUFFIX + out_ext)
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _init_worker(memory_mb):
+    """Acota la memoria de un proceso: un cuarto para la caché de bloques"""
+    histopath_io.tile_cache.max_bytes = (memory_mb << 20) // 4
+    Image.MAX_IMAGE_PIXELS = None
+
+
+def export_job(image_path, annotation_path, output_path, radius, colors, content_key, memory_mb):
+    """Exporta una superposición en un proceso del grupo -> (salida, clave de contenido, exportada)
+
+    Si el contenido de las entradas coincide con content_key (solo cambió
+    la fecha de modificación), no se vuelve a renderizar.
+    """
+    key = key_digest(file_digest(image_path), file_digest(annotation_path), radius, colors)
+    if content_key == key and os.path.exists(output_path):
+        return output_path, key, False
+    # Por encima de lo que cabe holgadamente en el presupuesto, lectura perezosa
+    lazy_min_pixels = min(LAZY_MIN_PIXELS, (memory_mb << 20) // 12)
+    image = load_image(image_path, lazy_min_pixels=lazy_min_pixels)
+    try:
+        if needs_tiled_export(image) and not is_tiff_path(output_path):
+            output_path = os.path.splitext(output_path)[0] + ".tif"
+        xs, ys, labels = read_points(annotation_path)
+        layers = layers_from_columns(xs, ys, labels, {int(k): v for k, v in colors.items()})
+        export_overlay(image, output_path, layers, radius, marker_width(radius),
+                       microns_per_pixel=getattr(image, "microns_per_pixel", None))
+    finally:
+        if is_lazy_image(image):
+            image.close()
+    return output_path, key, True
+
+
+def default_jobs(memory_mb=WORKER_MEMORY_MB):
+    """Procesos según los núcleos y la memoria física disponible"""
+    jobs = os.cpu_count() or 1
+    try:
+        physical_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') >> 20
+        jobs = min(jobs, max(1, physical_mb // (2 * memory_mb)))
+    except (ValueError, OSError, AttributeError):
+        pass
+    return jobs
+
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    with atomic_write(path) as f:
+        json.dump(manifest, f, indent=1)
+
+
+def batch_export(directory, output_dir, radius=MARKER_RADIUS, colors=LABEL_COLORS, jobs=None,
+                 memory_mb=WORKER_MEMORY_MB, force=False, progress=None, pairs=None,
+                 manifest_name=MANIFEST_NAME):
+    """Exporta las superposiciones de todas las imágenes anotadas de un directorio
+
+    Una imagen se salta si su salida existe y el manifiesto registra el
+    mismo tamaño y fecha de sus entradas y los mismos parámetros; si solo
+    cambió la fecha, el proceso compara el hash del contenido antes de
+    renderizar. pairs y manifest_name permiten exportar solo una parte del
+    directorio con su propio manifiesto (histopath_slurm).
+    progress(hecho, total) informa avance.
+    Devuelve {"exported": n, "skipped": n, "failed": [(imagen, error), ...]}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, manifest_name)
+    manifest = {} if force else read_manifest(manifest_path)
+    colors = {str(k): v for k, v in colors.items()}
+    summary = {"exported": 0, "skipped": 0, "failed": []}
+    pending = []
+    if pairs is None:
+        pairs = find_annotated_images(directory)
+    for image_path, annotation_path in pairs:
+        name = os.path.basename(image_path)
+        entry = manifest.get(name, {})
+        stat_key = key_digest(_stat_key(image_path), _stat_key(annotation_path), radius, colors)
+        output_path = os.path.join(output_dir, entry["output"]) if "output" in entry else \
+            overlay_path(image_path, output_dir)
+        if entry.get("stat") == stat_key and os.path.exists(output_path):
+            summary["skipped"] += 1
+            continue
+        pending.append((name, stat_key, (image_path, annotation_path, output_path, radius, colors,
+                                         entry.get("content"), memory_mb)))
+
+    total, done = len(pending) + summary["skipped"], summary["skipped"]
+    if progress:
+        progress(done, total)
+    if pending:
+        # spawn: los procesos no heredan hilos ni el estado de Tk del proceso principal
+        context = multiprocessing.get_context("spawn")
+        executor = ProcessPoolExecutor(max_workers=min(jobs or default_jobs(memory_mb), len(pending)),
+                                       mp_context=context, initializer=_init_worker, initargs=(memory_mb,))
+        try:
+            futures = {executor.submit(export_job, *args): (name, stat_key) for name, stat_key, args in pending}
+            for future in as_completed(futures):
+                name, stat_key = futures[future]
+                try:
+                    output_path, content_key, exported = future.result()
+                except Exception as e:
+                    summary["failed"].append((name, str(e)))
+                else:
+                    manifest[name] = {"output": os.path.basename(output_path), "stat": stat_key,
+                                      "content": content_key}
+                    summary["exported" if exported else "skipped"] += 1
+                done += 1
+                if done % MANIFEST_SAVE_EVERY == 0:
+                    write_manifest(manifest_path, manifest)
+                if progress:
+                    progress(done, total)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            write_manifest(manifest_path, manifest)
+    return summary
+
+
+def main(argv=None):
+    """Exporta superposiciones por lotes: python histopath_export.py carpeta -o salida/"""
+    parser = argparse.ArgumentParser(description="Exporta por lotes imágenes con sus marcadores (HistoPath Analyst)")
+    parser.add_argument("directory", help="Directorio con imágenes y anotaciones (.hpz/.hpa/.json/.jsonl)")
+    parser.add_argument("-o", "--output-dir", required=True, help="Directorio de salida")
+    parser.add_argument("--radius", type=int, default=MARKER_RADIUS, help="Radio de los marcadores en píxeles")
+    parser.add_argument("--jobs", type=int, default=None, help="Procesos en paralelo")
+    parser.add_argument("--memory-mb", type=int, default=WORKER_MEMORY_MB, help="Memoria por proceso (MB)")
+    parser.add_argument("--force", action="store_true", help="Exporta también las que ya están al día")
+    args = parser.parse_args(argv)
+
+    def report(done, total):
+        print(f"\r{done}/{total}", end="", flush=True)
+
+    summary = batch_export(args.directory, args.output_dir, args.radius, jobs=args.jobs,
+                           memory_mb=args.memory_mb, force=args.force, progress=report)
+    print(f"\nExportadas: {summary['exported']}, al día: {summary['skipped']}, "
+          f"con error: {len(summary['failed'])}")
+    for name, error in summary["failed"]:
+        print(f"  {name}: {error}")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,487 @@
+"""
+Inferencia de PathoNet en CPU para HistoPath Analyst.
+
+El modelo entrenado (entrada 256×256×3, salida de un mapa de densidad por
+clase: inmunopositivo, inmunonegativo y linfocito) se aplica a la imagen
+por parches solapados. Los parches se leen por lotes desde la imagen (PIL
+o perezosa) y cada lote se evalúa en un grupo de hilos; los núcleos son
+los máximos locales de cada mapa que superan el umbral de su clase, sin
+duplicados en las costuras entre parches.
+
+Los modelos se buscan en HISTOPATH_MODELS: primero el grafo ONNX
+cuantizado (pathonet_ki67.int8.onnx, ver histopath_convert), luego el
+ONNX en float y por último el modelo Keras (.keras, .h5), que necesita
+TensorFlow. Junto al modelo puede haber un .json con "thresholds", "labels",
+"min_distance", "batch_size", "overlap" y "nms_radius" que reemplazan los
+valores por defecto.
+
+    python histopath_inference.py modelo.h5 imagenes/*.jpg -o anotaciones/
+"""
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from histopath_io import is_lazy_image, load_image, region_reader
+from histopath_project import COORD_DTYPE, LABEL_DTYPE, LABEL_IDS
+
+MODEL_DIR = os.environ.get("HISTOPATH_MODELS",
+                           os.path.join(os.path.expanduser("~"), ".histopath_models"))
+MODEL_NAMES = {"ki67": "pathonet_ki67", "mitosis": "pathonet_mitosis"}
+# En orden de preferencia: onnxruntime es mucho más liviano que TensorFlow en CPU
+MODEL_EXTENSIONS = (".int8.onnx", ".onnx", ".keras", ".h5", ".hdf5")
+KERAS_EXTENSIONS = (".keras", ".h5", ".hdf5")
+# Ruta especial: modelo de prueba sin red neuronal (StubModel)
+STUB_MODEL = "stub"
+# Tamaño de entrada de la red (píxeles por lado) y solape entre parches vecinos
+PATCH_SIZE = 256
+PATCH_OVERLAP = 32
+# Canales de salida de PathoNet -> label_id de las anotaciones
+CHANNEL_LABELS = (LABEL_IDS['ki67'], LABEL_IDS['negative'], LABEL_IDS['mitosis'])
+# Umbrales por canal sobre la densidad escalada a 0-255 (valores de PathoNet)
+THRESHOLDS = (120, 180, 60)
+# Radio (píxeles) de la ventana en la que un pico debe ser el máximo
+MIN_DISTANCE = 4
+# Distancia (píxeles) bajo la cual dos detecciones son el mismo núcleo
+NMS_RADIUS = 6
+BATCH_SIZE = 8
+INFERENCE_THREADS = int(os.environ.get("HISTOPATH_INFERENCE_THREADS", 0)) or min(4, os.cpu_count() or 1)
+# Núcleos para la inferencia, repartidos entre los lotes en paralelo
+INFERENCE_CPUS = int(os.environ.get("HISTOPATH_INFERENCE_CPUS", 0)) or os.cpu_count() or 1
+
+
+def find_model(model_type, directory=MODEL_DIR):
+    """Ruta del modelo de un tipo de conteo en el directorio de modelos, o None"""
+    for ext in MODEL_EXTENSIONS:
+        path = os.path.join(directory, MODEL_NAMES[model_type] + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def model_stem(path):
+    """Ruta del modelo sin su extensión (.int8.onnx cuenta como una sola)"""
+    lower = path.lower()
+    for ext in MODEL_EXTENSIONS:
+        if lower.endswith(ext):
+            return path[:-len(ext)]
+    return os.path.splitext(path)[0]
+
+
+def model_config(path):
+    """Parámetros del .json junto al modelo (vacío si no existe); lo comparten sus versiones exportadas"""
+    config_path = model_stem(path) + ".json"
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class KerasModel:
+    """Modelo Keras (TensorFlow) evaluado solo en CPU
+
+    intra_threads fija los hilos de TensorFlow por evaluación, para que
+    varios lotes en paralelo no compitan por los mismos núcleos.
+    """
+
+    def __init__(self, path, intra_threads=None):
+        # Debe fijarse antes de importar TensorFlow
+        os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+        os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+        import tensorflow as tf
+        try:
+            tf.config.set_visible_devices([], 'GPU')
+            if intra_threads:
+                tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+        except RuntimeError:
+            # TensorFlow ya estaba inicializado en este proceso
+            pass
+        self.path = path
+        self.model = tf.keras.models.load_model(path, compile=False)
+
+    def predict(self, batch):
+        """Lote N×256×256×3 float32 en [0, 1] -> mapas de densidad N×256×256×C"""
+        return np.asarray(self.model(batch, training=False))
+
+
+class OnnxModel:
+    """Grafo ONNX (float o cuantizado int8) en onnxruntime, solo CPU
+
+    intra_threads fija los hilos de cada evaluación; una sesión admite
+    llamadas simultáneas desde varios hilos.
+    """
+
+    def __init__(self, path, intra_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if intra_threads:
+            options.intra_op_num_threads = intra_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch):
+        """Lote N×256×256×3 float32 en [0, 1] -> mapas de densidad N×256×256×C"""
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class StubModel:
+    """Modelo de prueba sin red: densidades a partir del color de cada píxel
+
+    Los píxeles marrones (DAB) van al primer canal, los azules
+    (hematoxilina) al segundo y los casi negros al tercero, suavizados
+    como una densidad. Permite probar el conteo automático sin TensorFlow
+    ni onnxruntime.
+    """
+
+    path = STUB_MODEL
+
+    def predict(self, batch):
+        from scipy import ndimage
+
+        r, g, b = batch[..., 0], batch[..., 1], batch[..., 2]
+        brightest = batch.max(axis=-1)
+        masks = np.stack([(r > b + 0.2) & (r > g + 0.1) & (brightest < 0.85),
+                          (b > r + 0.2) & (b > g + 0.1),
+                          brightest < 0.2], axis=-1)
+        return ndimage.uniform_filter(masks.astype(np.float32), size=(1, 5, 5, 1))
+
+
+def load_model(path, threads=INFERENCE_THREADS, cpus=INFERENCE_CPUS):
+    """Carga un modelo según su extensión, con cpus núcleos repartidos entre threads lotes"""
+    if path == STUB_MODEL:
+        return StubModel()
+    intra_threads = max(1, cpus // threads)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".onnx":
+        return OnnxModel(path, intra_threads)
+    if ext in KERAS_EXTENSIONS:
+        return KerasModel(path, intra_threads)
+    raise ValueError(f"Formato de modelo no soportado: {ext}")
+
+
+def density_peaks(density, thresholds=THRESHOLDS, labels=CHANNEL_LABELS, min_distance=MIN_DISTANCE):
+    """Máximos locales de los mapas de densidad de un lote (N×H×W×C) sobre el umbral de cada canal
+
+    Un filtro de máximo de (2·min_distance + 1)² píxeles, aplicado a la vez
+    a todos los parches y canales, marca los máximos locales; las mesetas
+    (varios píxeles vecinos con el mismo máximo) cuentan como un solo pico,
+    en su centro. -> (parche, x, y, label_id, puntaje) como arreglos.
+    """
+    from scipy import ndimage
+
+    density = np.asarray(density, dtype=np.float32)
+    if density.ndim == 3:
+        density = density[None]
+    size = 2 * min_distance + 1
+    local_max = ndimage.maximum_filter(density, size=(1, size, size, 1), mode='nearest')
+    # Umbrales de PathoNet en la escala 0-255 de la densidad
+    cut = np.asarray(thresholds, dtype=np.float32)[:density.shape[-1]] / 255
+    patch, ys, xs, channel = np.nonzero((density == local_max) & (density > cut))
+    scores = density[patch, ys, xs, channel] * 255
+    xs, ys = xs.astype(np.float64), ys.astype(np.float64)
+    if len(xs) > 1:
+        patch, xs, ys, channel, scores = _merge_plateaus(patch, xs, ys, channel, scores)
+    return patch, xs, ys, np.asarray(labels, dtype=LABEL_DTYPE)[channel], scores
+
+
+def _merge_plateaus(patch, xs, ys, channel, scores):
+    """Une los píxeles de pico vecinos (misma meseta, mismo parche y canal) en su centro"""
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    # Parches y canales distintos quedan lejos entre sí en este espacio
+    far = 4.0 * (xs.max() + ys.max() + 2)
+    coords = np.column_stack([xs, ys, patch * far, channel * far])
+    pairs = cKDTree(coords).query_pairs(1.5, output_type='ndarray')
+    if not len(pairs):
+        return patch, xs, ys, channel, scores
+    n = len(xs)
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, component = connected_components(graph, directed=False)
+    counts = np.bincount(component)
+    first = np.unique(component, return_index=True)[1]
+    return (patch[first], np.bincount(component, xs) / counts, np.bincount(component, ys) / counts,
+            channel[first], scores[first])
+
+
+def tile_starts(length, size, overlap):
+    """Inicios de los parches a lo largo de un eje: paso size - overlap, el último ajustado al borde"""
+    if length <= size:
+        return [0]
+    stride = size - overlap
+    starts = list(range(0, length - size, stride))
+    return starts + [length - size]
+
+
+def owned_ranges(starts, size, length):
+    """Tramo [inicio, fin) de cada parche a lo largo de un eje: cada solape se reparte por su mitad"""
+    bounds = [0] + [(a + b + size) / 2 for a, b in zip(starts, starts[1:])] + [length]
+    return list(zip(bounds, bounds[1:]))
+
+
+def radius_nms(xs, ys, scores, radius):
+    """Supresión de no máximos por radio -> máscara de los puntos conservados
+
+    Entre los puntos a menos de radius entre sí se conserva el de mayor
+    puntaje (a igual puntaje, el de menor y, luego menor x), así que el
+    resultado no depende del orden de los puntos; los vecinos se buscan con
+    un árbol k-d y solo los puntos con algún vecino pasan por la supresión voraz.
+    """
+    keep = np.ones(len(xs), dtype=bool)
+    if len(xs) < 2 or radius <= 0:
+        return keep
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+
+    pairs = cKDTree(np.column_stack([xs, ys])).query_pairs(radius, output_type='ndarray')
+    if not len(pairs):
+        return keep
+    n = len(xs)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n, n)).tocsr()
+    candidates = np.unique(pairs)
+    visited = np.zeros(n, dtype=bool)
+    order = np.lexsort((np.asarray(xs)[candidates], np.asarray(ys)[candidates], -np.asarray(scores)[candidates]))
+    for i in candidates[order]:
+        visited[i] = True
+        if keep[i]:
+            neighbors = graph.indices[graph.indptr[i]:graph.indptr[i + 1]]
+            keep[neighbors[~visited[neighbors]]] = False
+    return keep
+
+
+def nms_clusters(xs, ys, radius):
+    """Grupos de puntos unidos por cadenas de vecinos a menos de radius -> etiqueta por punto
+
+    La supresión por radio de un grupo solo depende de sus propios puntos.
+    """
+    if len(xs) < 2:
+        return np.arange(len(xs))
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    pairs = cKDTree(np.column_stack([xs, ys])).query_pairs(radius, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                       shape=(len(xs), len(xs)))
+    return connected_components(graph, directed=False)[1]
+
+
+class PathoNetEngine:
+    """Conteo automático por parches solapados con un modelo PathoNet en CPU
+
+    Los parches se leen de la imagen a medida que se necesitan, de a
+    batch_size, y cada lote se evalúa en uno de threads hilos; como mucho
+    threads + 1 lotes están en memoria a la vez, sea cual sea el tamaño de
+    la imagen. Cada parche solo aporta los núcleos de su tramo propio (el
+    solape se reparte por la mitad) y la supresión por radio elimina los
+    que quedan duplicados a ambos lados de una costura.
+    """
+
+    def __init__(self, model, thresholds=THRESHOLDS, labels=CHANNEL_LABELS, min_distance=MIN_DISTANCE,
+                 batch_size=BATCH_SIZE, threads=INFERENCE_THREADS, patch_size=PATCH_SIZE,
+                 overlap=PATCH_OVERLAP, nms_radius=NMS_RADIUS):
+        self.model = model
+        self.thresholds = tuple(thresholds)
+        self.labels = tuple(labels)
+        self.min_distance = min_distance
+        self.batch_size = batch_size
+        self.threads = threads
+        self.patch_size = patch_size
+        self.overlap = overlap
+        self.nms_radius = nms_radius
+
+    @classmethod
+    def from_file(cls, path, threads=INFERENCE_THREADS, cpus=INFERENCE_CPUS):
+        config = model_config(path)
+        return cls(load_model(path, threads, cpus),
+                   thresholds=config.get("thresholds", THRESHOLDS),
+                   labels=config.get("labels", CHANNEL_LABELS),
+                   min_distance=config.get("min_distance", MIN_DISTANCE),
+                   batch_size=config.get("batch_size", BATCH_SIZE),
+                   threads=threads,
+                   overlap=config.get("overlap", PATCH_OVERLAP),
+                   nms_radius=config.get("nms_radius", NMS_RADIUS))
+
+    def patch_grid(self, width, height):
+        """Inicios y tramos propios de los parches en cada eje -> (xs, ys, x_owned, y_owned)"""
+        size = self.patch_size
+        xs, ys = tile_starts(width, size, self.overlap), tile_starts(height, size, self.overlap)
+        return xs, ys, owned_ranges(xs, size, width), owned_ranges(ys, size, height)
+
+    def patch_box(self, grid, row, col, width, height):
+        """(caja, tramo propio) del parche de la fila y columna dadas"""
+        xs, ys, x_owned, y_owned = grid
+        x, y, size = xs[col], ys[row], self.patch_size
+        return ((x, y, min(x + size, width), min(y + size, height)),
+                (x_owned[col][0], y_owned[row][0], x_owned[col][1], y_owned[row][1]))
+
+    def patch_boxes(self, width, height):
+        """Parches solapados que cubren la imagen -> [(caja, tramo propio)]
+
+        Los parches de una imagen más pequeña que patch_size quedan recortados.
+        """
+        grid = self.patch_grid(width, height)
+        return [self.patch_box(grid, row, col, width, height)
+                for row in range(len(grid[1])) for col in range(len(grid[0]))]
+
+    def read_patch(self, read, box):
+        """Parche float32 de patch_size×patch_size; los recortados se completan en espejo"""
+        tile = read(box)
+        pad_y, pad_x = self.patch_size - tile.shape[0], self.patch_size - tile.shape[1]
+        if pad_y or pad_x:
+            tile = np.pad(tile, ((0, pad_y), (0, pad_x), (0, 0)), mode='symmetric')
+        return tile.astype(np.float32) / 255
+
+    def iter_batches(self, image, boxes):
+        """Lotes (parches, cajas) leídos de la imagen solo cuando se piden"""
+        read = region_reader(image)
+        for i in range(0, len(boxes), self.batch_size):
+            batch = boxes[i:i + self.batch_size]
+            yield np.stack([self.read_patch(read, box) for box, _ in batch]), batch
+
+    def detect_batch(self, patches, boxes):
+        """Evalúa un lote y pasa a coordenadas de la imagen los núcleos del tramo propio de cada parche
+
+        -> lista con un arreglo K×4 (x, y, label_id, puntaje) por parche
+        """
+        patch, xs, ys, labels, scores = density_peaks(self.model.predict(patches), self.thresholds,
+                                                      self.labels, self.min_distance)
+        origin = np.array([box[:2] for box, _ in boxes], dtype=np.float64).reshape(-1, 2)
+        owned = np.array([own for _, own in boxes], dtype=np.float64).reshape(-1, 4)
+        xs, ys = xs + origin[patch, 0], ys + origin[patch, 1]
+        own = owned[patch]
+        keep = (xs >= own[:, 0]) & (xs < own[:, 2]) & (ys >= own[:, 1]) & (ys < own[:, 3])
+        table = np.column_stack([xs, ys, labels, scores])[keep]
+        patch = patch[keep]
+        return [table[patch == i] for i in range(len(boxes))]
+
+    def evaluate(self, image, boxes, progress=None):
+        """Núcleos del tramo propio de cada parche, antes de la supresión por radio -> lista K×4 por parche
+
+        progress(hecho, total) se llama tras cada lote; si lanza una
+        excepción (cancelación), los lotes pendientes se descartan.
+        """
+        n_batches = -(-len(boxes) // self.batch_size)
+        points = []
+        if progress:
+            progress(0, n_batches)
+        pending = deque()
+        done = 0
+
+        def collect():
+            nonlocal done
+            points.extend(pending.popleft().result())
+            done += 1
+            if progress:
+                progress(done, n_batches)
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            try:
+                for patches, batch in self.iter_batches(image, boxes):
+                    pending.append(executor.submit(self.detect_batch, patches, batch))
+                    if len(pending) > self.threads:
+                        collect()
+                while pending:
+                    collect()
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+        return points
+
+    def detect_region(self, image, box, progress=None, cache=None):
+        """Los núcleos de detect() con centro dentro de una región -> columnas (xs, ys, labels)
+
+        La región usa los mismos parches que la imagen completa, sin relleno
+        en sus bordes, y la supresión por radio se resuelve con todos los
+        núcleos encadenados a los suyos aunque caigan fuera (se amplía el
+        halo alrededor de la región hasta contenerlos); así la unión de las
+        regiones que cubren la imagen es exactamente detect(), en cualquier
+        orden. cache ({(fila, columna): núcleos}) guarda los parches ya
+        evaluados, para no repetirlos en las regiones vecinas de la misma imagen.
+        """
+        width, height = image.size
+        grid = self.patch_grid(width, height)
+        cache = {} if cache is None else cache
+        x0, y0, x1, y1 = box
+        halo = 2 * self.nms_radius
+        while True:
+            # Parches cuyo tramo propio toca la región ampliada; juntos cubren un rectángulo
+            cols = [c for c, (a, b) in enumerate(grid[2]) if a < x1 + halo and b > x0 - halo]
+            rows = [r for r, (a, b) in enumerate(grid[3]) if a < y1 + halo and b > y0 - halo]
+            cells = [(r, c) for r in rows for c in cols]
+            missing = [cell for cell in cells if cell not in cache]
+            if missing:
+                found = self.evaluate(image, [self.patch_box(grid, r, c, width, height) for r, c in missing],
+                                      progress)
+                cache.update(zip(missing, found))
+            table = np.concatenate([np.empty((0, 4))] + [cache[cell] for cell in cells])
+            xs, ys = table[:, 0], table[:, 1]
+            cx0, cx1 = grid[2][cols[0]][0], grid[2][cols[-1]][1]
+            cy0, cy1 = grid[3][rows[0]][0], grid[3][rows[-1]][1]
+            inside = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+            cluster = nms_clusters(xs, ys, self.nms_radius)
+            linked = np.isin(cluster, cluster[inside])
+            # Un grupo de la región que llega al borde abierto del rectángulo puede seguir fuera
+            r = self.nms_radius
+            open_edge = (((xs - cx0 <= r) & (cx0 > 0)) | ((cx1 - xs <= r) & (cx1 < width)) |
+                         ((ys - cy0 <= r) & (cy0 > 0)) | ((cy1 - ys <= r) & (cy1 < height)))
+            if not (linked & open_edge).any():
+                break
+            halo *= 2
+        keep = radius_nms(xs, ys, table[:, 3], self.nms_radius) & inside
+        table = table[keep]
+        return (np.rint(table[:, 0]).astype(COORD_DTYPE), np.rint(table[:, 1]).astype(COORD_DTYPE),
+                table[:, 2].astype(LABEL_DTYPE))
+
+    def detect(self, image, progress=None):
+        """Núcleos de una imagen completa -> columnas (xs, ys, labels)
+
+        progress(hecho, total) se llama tras cada lote; si lanza una
+        excepción (cancelación), los lotes pendientes se descartan.
+        """
+        width, height = image.size
+        table = np.concatenate([np.empty((0, 4))] + self.evaluate(image, self.patch_boxes(width, height), progress))
+        table = table[radius_nms(table[:, 0], table[:, 1], table[:, 3], self.nms_radius)]
+        return (np.rint(table[:, 0]).astype(COORD_DTYPE), np.rint(table[:, 1]).astype(COORD_DTYPE),
+                table[:, 2].astype(LABEL_DTYPE))
+
+
+def main(argv=None):
+    """Conteo automático por lotes: python histopath_inference.py modelo imagenes... -o directorio"""
+    from histopath_project import write_annotations
+
+    parser = argparse.ArgumentParser(description="Conteo automático con PathoNet en CPU (HistoPath Analyst)")
+    parser.add_argument("model", help="Modelo entrenado (.onnx/.keras/.h5)")
+    parser.add_argument("images", nargs="+", help="Imágenes a analizar")
+    parser.add_argument("-o", "--output-dir", required=True, help="Directorio para las anotaciones (.json)")
+    parser.add_argument("--threads", type=int, default=INFERENCE_THREADS, help="Lotes evaluados en paralelo")
+    parser.add_argument("--cpus", type=int, default=INFERENCE_CPUS, help="Núcleos totales para la inferencia")
+    args = parser.parse_args(argv)
+
+    engine = PathoNetEngine.from_file(args.model, threads=args.threads, cpus=args.cpus)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in args.images:
+        image = load_image(path)
+        try:
+            xs, ys, labels = engine.detect(image)
+        finally:
+            if is_lazy_image(image):
+                image.close()
+        out_path = os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0] + ".json")
+        write_annotations(out_path, xs, ys, labels)
+        print(f"{os.path.basename(path)}: {len(xs)} núcleos -> {out_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
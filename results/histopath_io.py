@@ -0,0 +1,456 @@
+"""
+Lectura de imágenes de HistoPath Analyst.
+
+Los TIFF grandes se abren como vistas perezosas: el archivo se proyecta en
+memoria (mmap) y los bloques nativos (tiles o franjas) se decodifican solo
+cuando se leen, guardándose en una caché LRU con presupuesto en bytes. Así
+el consumo de memoria depende de la vista y de la caché, no del tamaño del
+archivo. Las láminas completas (.svs, TIFF piramidales) exponen sus niveles
+de resolución y las lecturas reducidas usan el nivel más cercano. Las
+imágenes pequeñas se siguen abriendo con PIL.
+"""
+import argparse
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from histopath_cache import cache_path, key_digest
+
+TIFF_EXTENSIONS = (".tif", ".tiff", ".svs")
+IMAGE_EXTENSIONS = TIFF_EXTENSIONS + (".jpg", ".jpeg", ".png", ".bmp")
+# Imágenes con al menos estos píxeles se abren de forma perezosa
+LAZY_MIN_PIXELS = int(os.environ.get("HISTOPATH_LAZY_MIN_PIXELS", 4096 * 4096))
+# Presupuesto de la caché de bloques decodificados
+TILE_CACHE_BYTES = int(os.environ.get("HISTOPATH_TILE_CACHE_MB", "256")) << 20
+# Bloque virtual para TIFF sin comprimir, que se leen directamente del mmap
+VIRTUAL_TILE = 512
+# Parámetros de las pirámides escritas por write_pyramid
+PYRAMID_TILE = 256
+PYRAMID_MIN_SIZE = 512
+# Lado máximo de las miniaturas guardadas en disco
+THUMBNAIL_SIZE = 320
+
+
+class TileCache:
+    """Caché LRU de bloques decodificados, acotada por bytes y segura entre hilos"""
+
+    def __init__(self, max_bytes=TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._entries.get(key)
+            if tile is not None:
+                self._entries.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        if tile.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._entries[key] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def discard(self, prefix):
+        """Quita los bloques de los niveles cuya clave empieza por prefix (los de una imagen cerrada)"""
+        n = len(prefix)
+        with self._lock:
+            for key in [key for key in self._entries if key[0][:n] == prefix]:
+                self.nbytes -= self._entries.pop(key).nbytes
+
+
+# Caché compartida por todas las imágenes abiertas
+tile_cache = TileCache()
+
+
+def _as_rgb(array):
+    """Convierte un bloque (alto, ancho[, muestras]) en RGB uint8"""
+    if array.ndim == 2:
+        array = array[:, :, None]
+    if array.shape[2] == 1:
+        return np.repeat(array, 3, axis=2)
+    return array[:, :, :3]
+
+
+def _reduce(tile, factor, phase_y=0, phase_x=0):
+    """Reduce un bloque por un factor entero: promedio por bloques si está alineado, si no submuestreo"""
+    if factor == 1:
+        return tile
+    if phase_y == 0 and phase_x == 0:
+        return np.asarray(Image.fromarray(tile).reduce(factor))
+    return np.ascontiguousarray(tile[phase_y::factor, phase_x::factor])
+
+
+class TiffLevel:
+    """Una página TIFF leída por bloques desde el archivo proyectado en memoria"""
+
+    def __init__(self, page, buffer, key, cache=tile_cache):
+        if page.planarconfig != 1 or page.dtype != np.uint8 or page.samplesperpixel not in (1, 3, 4):
+            raise ValueError("Formato TIFF no soportado para lectura por bloques")
+        self.key = key
+        self.cache = cache
+        self.height, self.width = page.shape[:2]
+        self._page = page
+        self._buffer = buffer
+        self._array = None
+        if page.is_memmappable:
+            # Sin compresión y contiguo: vista directa sobre el mmap, sin decodificar
+            count = int(np.prod(page.shaped[1:]))
+            self._array = np.frombuffer(buffer, np.uint8, count, page.dataoffsets[0]).reshape(
+                self.height, self.width, -1)
+            self.tile_height = self.tile_width = VIRTUAL_TILE
+        elif page.is_tiled:
+            self.tile_height, self.tile_width = page.tilelength, page.tilewidth
+        else:
+            self.tile_height, self.tile_width = page.rowsperstrip or self.height, self.width
+        self.tiles_across = -(-self.width // self.tile_width)
+        self.tiles_down = -(-self.height // self.tile_height)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def read_tile(self, ty, tx, factor=1):
+        """Bloque (ty, tx) en RGB, reducido por factor; decodificado una sola vez"""
+        y0, x0 = ty * self.tile_height, tx * self.tile_width
+        if self._array is not None and factor == 1:
+            return _as_rgb(self._array[y0:y0 + self.tile_height, x0:x0 + self.tile_width])
+        key = (self.key, ty, tx, factor)
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+        if factor == 1:
+            tile = self._decode(ty, tx)
+        else:
+            # Fase para que el submuestreo quede alineado con la rejilla global
+            tile = _reduce(self.read_tile(ty, tx), factor, -y0 % factor, -x0 % factor)
+        self.cache.put(key, tile)
+        return tile
+
+    def _decode(self, ty, tx):
+        page = self._page
+        index = ty * self.tiles_across + tx
+        offset, count = page.dataoffsets[index], page.databytecounts[index]
+        segment, _, _ = page.decode(self._buffer[offset:offset + count], index,
+                                    jpegtables=page.jpegtables)
+        h = min(self.tile_height, self.height - ty * self.tile_height)
+        w = min(self.tile_width, self.width - tx * self.tile_width)
+        return np.ascontiguousarray(_as_rgb(segment[0, :h, :w]))
+
+    def read_region(self, box, factor=1):
+        """Región (x0, y0, x1, y1) en RGB uint8, reducida por factor"""
+        x0, y0, x1, y1 = box
+        out_w = -(-(x1 - x0) // factor)
+        out_h = -(-(y1 - y0) // factor)
+        out = np.zeros((out_h, out_w, 3), dtype=np.uint8)
+        if out_w <= 0 or out_h <= 0:
+            return out
+        for ty in range(y0 // self.tile_height, (y1 - 1) // self.tile_height + 1):
+            for tx in range(x0 // self.tile_width, (x1 - 1) // self.tile_width + 1):
+                tile = self.read_tile(ty, tx, factor)
+                # Origen del bloque reducido en coordenadas reducidas globales
+                ty0 = -(-ty * self.tile_height // factor)
+                tx0 = -(-tx * self.tile_width // factor)
+                oy, ox = y0 // factor, x0 // factor
+                sy, sx = max(0, oy - ty0), max(0, ox - tx0)
+                dy, dx = max(0, ty0 - oy), max(0, tx0 - ox)
+                h = min(tile.shape[0] - sy, out_h - dy)
+                w = min(tile.shape[1] - sx, out_w - dx)
+                if h > 0 and w > 0:
+                    out[dy:dy + h, dx:dx + w] = tile[sy:sy + h, sx:sx + w]
+        return out
+
+
+class TiledImage:
+    """Vista perezosa de un TIFF (plano o piramidal) con la interfaz mínima de una imagen PIL
+
+    Ofrece size, width, height, mode, crop(), iter_tiles() y region();
+    ninguna de ellas carga la imagen completa. Las coordenadas son siempre
+    las del nivel 0; region() elige el nivel de la pirámide según el factor
+    de reducción. to_image() materializa la imagen de forma explícita.
+    """
+
+    mode = "RGB"
+
+    def __init__(self, path, cache=tile_cache):
+        import tifffile
+
+        self.path = path
+        self.filename = path
+        self._cache = cache
+        self._file = open(path, 'rb')
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._tiff = tifffile.TiffFile(self._file)
+            stat = os.stat(path)
+            key = self._cache_key = (os.path.abspath(path), stat.st_mtime_ns)
+            self.levels = [TiffLevel(series.keyframe, self._buffer, key + (i,), cache)
+                           for i, series in enumerate(self._tiff.series[0].levels)]
+            # Decodificar un bloque confirma que el códec está disponible
+            self.levels[0].read_tile(0, 0)
+        except Exception:
+            self.close()
+            raise
+        self.level_downsamples = [self.width / level.width for level in self.levels]
+        self.microns_per_pixel = self._read_mpp(self._tiff.series[0].levels[0].keyframe)
+        self.info = {}
+
+    @staticmethod
+    def _read_mpp(page):
+        """Escala en µm/píxel: campo MPP de Aperio o etiquetas de resolución"""
+        match = re.search(r"MPP\s*=\s*([0-9.]+)", page.description or "")
+        if match:
+            mpp = float(match.group(1))
+        else:
+            resolution, unit = page.tags.get('XResolution'), page.tags.get('ResolutionUnit')
+            if resolution is None or unit is None or unit.value not in (2, 3):
+                return None
+            numerator, denominator = resolution.value
+            if not numerator or not denominator:
+                return None
+            microns_per_unit = 25400.0 if unit.value == 2 else 10000.0
+            mpp = microns_per_unit * denominator / numerator
+        # Descartar valores por defecto sin sentido (p. ej. 72 dpi)
+        return mpp if 0.01 <= mpp <= 10.0 else None
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    @property
+    def width(self):
+        return self.levels[0].width
+
+    @property
+    def height(self):
+        return self.levels[0].height
+
+    @property
+    def level_count(self):
+        return len(self.levels)
+
+    def best_level(self, factor):
+        """Nivel más reducido cuyo factor no supera el pedido"""
+        best = 0
+        for i, downsample in enumerate(self.level_downsamples):
+            if downsample <= factor * 1.01:
+                best = i
+        return best
+
+    def crop(self, box):
+        """Región a resolución completa como imagen PIL"""
+        return Image.fromarray(self.levels[0].read_region(tuple(int(v) for v in box)))
+
+    def region(self, box, factor=1):
+        """Región reducida aproximadamente por factor, leída del nivel adecuado, como imagen PIL"""
+        return Image.fromarray(self.read_region(box, factor))
+
+    def read_region(self, box, factor=1):
+        """Como region(), pero devuelve el arreglo RGB uint8"""
+        index = self.best_level(factor)
+        level, downsample = self.levels[index], self.level_downsamples[index]
+        residual = max(1, int(factor / downsample + 0.01))
+        x0, y0, x1, y1 = box
+        level_box = (int(x0 / downsample), int(y0 / downsample),
+                     min(level.width, int(np.ceil(x1 / downsample))),
+                     min(level.height, int(np.ceil(y1 / downsample))))
+        return level.read_region(level_box, residual)
+
+    def iter_tiles(self, tile_size):
+        """Recorre la imagen por bloques (x, y, bloque RGB uint8), como histopath_color.iter_tiles"""
+        for y in range(0, self.height, tile_size):
+            for x in range(0, self.width, tile_size):
+                box = (x, y, min(x + tile_size, self.width), min(y + tile_size, self.height))
+                yield x, y, self.levels[0].read_region(box)
+
+    def to_image(self):
+        """Materializa la imagen completa en memoria"""
+        return self.crop((0, 0, self.width, self.height))
+
+    def close(self):
+        """Cierra el archivo y el mmap y descarta sus bloques de la caché"""
+        if getattr(self, "_cache_key", None) is not None:
+            self._cache.discard(self._cache_key)
+        for attr in ("_tiff", "_buffer", "_file"):
+            handle = getattr(self, attr, None)
+            if handle is not None:
+                try:
+                    handle.close()
+                except (BufferError, ValueError):
+                    # Quedan vistas numpy sobre el mmap; se libera al recolectarlas
+                    pass
+            setattr(self, attr, None)
+
+
+def is_lazy_image(image):
+    return isinstance(image, TiledImage)
+
+
+def reduction_factor(zoom):
+    """Mayor potencia de dos que no supera 1/zoom, para leer reducido sin perder detalle"""
+    factor = 1
+    while factor * 2 <= 1.0 / max(zoom, 1e-6):
+        factor *= 2
+    return factor
+
+
+def load_image(path, lazy_min_pixels=LAZY_MIN_PIXELS):
+    """Abre una imagen: vista perezosa si es un TIFF grande o piramidal, imagen PIL RGB en otro caso"""
+    if path.lower().endswith(TIFF_EXTENSIONS):
+        try:
+            image = TiledImage(path)
+        except Exception:
+            # Sin tifffile, códec no disponible o formato no soportado: usar PIL
+            image = None
+        if image is not None:
+            if image.level_count > 1 or image.width * image.height >= lazy_min_pixels:
+                return image
+            image.close()
+    image = Image.open(path)
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+    return image
+
+
+def make_thumbnail(image, max_size=THUMBNAIL_SIZE):
+    """Miniatura RGB; en láminas se lee del nivel más pequeño de la pirámide"""
+    width, height = image.size
+    factor = reduction_factor(max_size / max(width, height))
+    if is_lazy_image(image):
+        thumb = image.region((0, 0, width, height), factor)
+    else:
+        thumb = image.reduce(factor) if factor > 1 else image.copy()
+        if thumb.mode != "RGB":
+            thumb = thumb.convert("RGB")
+    thumb.thumbnail((max_size, max_size), Image.LANCZOS)
+    return thumb
+
+
+def cached_thumbnail(path, image=None, max_size=THUMBNAIL_SIZE):
+    """Miniatura de un archivo con caché en disco por (ruta, fecha de modificación, tamaño)
+
+    Si no está en caché se genera a partir de image (ya abierta) o abriendo
+    el archivo.
+    """
+    stat = os.stat(path)
+    name = key_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, max_size) + ".png"
+    cached = cache_path("thumbnails", name)
+    if os.path.exists(cached):
+        with Image.open(cached) as thumb:
+            return thumb.convert("RGB")
+    source = image if image is not None else load_image(path)
+    try:
+        thumb = make_thumbnail(source, max_size)
+    finally:
+        if image is None and is_lazy_image(source):
+            source.close()
+    tmp_path = cached + ".tmp.png"
+    thumb.save(tmp_path)
+    os.replace(tmp_path, cached)
+    return thumb
+
+
+def region_reader(image):
+    """Función (caja, factor) -> arreglo RGB para una imagen perezosa, una vista con read_region o PIL"""
+    if hasattr(image, "read_region"):
+        return image.read_region
+
+    def read(box, factor=1):
+        region = image.crop(box)
+        if region.mode != "RGB":
+            region = region.convert("RGB")
+        return np.asarray(region.reduce(factor) if factor > 1 else region)
+    return read
+
+
+def write_pyramid(image, path, tile_size=PYRAMID_TILE, compression="zlib",
+                  microns_per_pixel=None, min_size=PYRAMID_MIN_SIZE, progress=None):
+    """Escribe un TIFF piramidal en mosaico (niveles 1:1, 1:2, 1:4...) bloque a bloque
+
+    Cada nivel se genera leyendo la imagen de origen reducida por bloques,
+    sin tenerla completa en memoria; progress(hecho, total) informa avance.
+    """
+    import tifffile
+
+    width, height = image.size
+    read = region_reader(image)
+    factors = [1]
+    while max(width, height) // (factors[-1] * 2) >= min_size:
+        factors.append(factors[-1] * 2)
+    shapes = [(-(-height // f), -(-width // f)) for f in factors]
+    total = sum(-(-h // tile_size) * -(-w // tile_size) for h, w in shapes)
+    done = [0]
+
+    def tiles(factor, shape):
+        h, w = shape
+        for y in range(0, h, tile_size):
+            for x in range(0, w, tile_size):
+                box = (x * factor, y * factor,
+                       min((x + tile_size) * factor, width), min((y + tile_size) * factor, height))
+                block = read(box, factor)[:tile_size, :tile_size]
+                tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+                tile[:block.shape[0], :block.shape[1]] = block
+                done[0] += 1
+                if progress:
+                    progress(done[0], total)
+                yield tile
+
+    options = dict(tile=(tile_size, tile_size), dtype=np.uint8, photometric='rgb',
+                   compression=compression)
+    resolution = {}
+    if microns_per_pixel:
+        resolution = dict(resolution=(1e4 / microns_per_pixel, 1e4 / microns_per_pixel),
+                          resolutionunit='CENTIMETER')
+    tmp_path = path + ".tmp"
+    with tifffile.TiffWriter(tmp_path, bigtiff=True) as tif:
+        tif.write(tiles(1, shapes[0]), shape=shapes[0] + (3,), subifds=len(factors) - 1,
+                  **resolution, **options)
+        for factor, shape in zip(factors[1:], shapes[1:]):
+            tif.write(tiles(factor, shape), shape=shape + (3,), subfiletype=1, **options)
+    os.replace(tmp_path, path)
+    return path
+
+
+def main(argv=None):
+    """Convierte imágenes a TIFF piramidal: python histopath_io.py entrada... -o salida/"""
+    parser = argparse.ArgumentParser(description="Genera TIFF piramidales en mosaico para HistoPath Analyst")
+    parser.add_argument("images", nargs="+", help="Imágenes de entrada")
+    parser.add_argument("-o", "--output-dir", default=".", help="Directorio de salida")
+    parser.add_argument("--tile-size", type=int, default=PYRAMID_TILE, help="Lado del bloque en píxeles")
+    parser.add_argument("--compression", default="zlib", help="Compresión TIFF (zlib, jpeg, none...)")
+    parser.add_argument("--mpp", type=float, default=None, help="Escala en µm/píxel a registrar")
+    args = parser.parse_args(argv)
+
+    Image.MAX_IMAGE_PIXELS = None
+    os.makedirs(args.output_dir, exist_ok=True)
+    compression = None if args.compression == "none" else args.compression
+    for path in args.images:
+        image = load_image(path)
+        name = os.path.splitext(os.path.basename(path))[0] + "_pyramid.tif"
+        mpp = args.mpp or getattr(image, "microns_per_pixel", None)
+        out = write_pyramid(image, os.path.join(args.output_dir, name), args.tile_size,
+                            compression, mpp)
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
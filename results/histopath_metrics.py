@@ -0,0 +1,311 @@
+"""
+Motor de métricas de HistoPath Analyst, sin interfaz gráfica.
+
+Las mismas funciones que usan las ventanas de análisis calculan, a partir
+de las coordenadas de los núcleos y de la imagen, las métricas básicas
+(conteos, índice Ki-67, densidades), las de tinción H-DAB, las de
+distribución espacial y las de agrupamiento. batch_metrics las aplica a
+una lista de imágenes con sus anotaciones en un grupo de procesos y
+write_table reúne los resultados en una tabla CSV o Parquet. Los resultados
+costosos se guardan en la caché de resultados (histopath_cache) con claves
+por contenido: al cambiar un parámetro solo se recalcula lo que depende de él.
+Como CLI:
+
+    python histopath_metrics.py "imagenes/*.jpg" -o metricas.csv --jobs 8
+"""
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from histopath_cache import array_digest, key_digest, result_cache, stat_file_digest
+from histopath_color import StainDeconvolver
+from histopath_io import IMAGE_EXTENSIONS, is_lazy_image, load_image
+from histopath_project import LABEL_IDS, find_annotations, read_points, read_project, PROJECT_EXTENSIONS
+
+DEFAULT_SCALE = 0.25  # µm/pixel
+# Distancia máxima (µm) para que dos núcleos pertenezcan al mismo grupo
+CLUSTER_DISTANCE = 50
+# Pares por bloque en el cálculo de distancias entre todos los pares
+DISTANCE_BLOCK_PAIRS = 1 << 22
+# Versión de los resultados en caché: cambiarla invalida los ya guardados
+RESULT_VERSION = 1
+
+
+def cached_result(cache, parts, compute):
+    """compute() a través de la caché de resultados con clave por las partes; sin caché, lo calcula"""
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(key_digest(RESULT_VERSION, *parts), compute)
+
+
+def points_key(points):
+    """Clave del contenido de unos puntos N×2, independiente de su orden"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return array_digest(points[np.lexsort((points[:, 1], points[:, 0]))])
+
+
+def area_mm2(width, height, scale):
+    return (width * scale) * (height * scale) / 1e6
+
+
+def basic_metrics(n_ki67, n_negative, n_mitosis, width, height, scale):
+    """Conteos, índice de proliferación Ki-67 y densidades por mm²"""
+    total = n_ki67 + n_negative + n_mitosis
+    area = area_mm2(width, height, scale)
+    ki67_base = n_ki67 + n_negative
+    return {
+        'n_ki67': n_ki67,
+        'n_negative': n_negative,
+        'n_mitosis': n_mitosis,
+        'n_total': total,
+        'ki67_index': n_ki67 / ki67_base * 100 if ki67_base > 0 else 0,
+        'density_total': total / area if area > 0 else 0,
+        'density_ki67': n_ki67 / area if area > 0 else 0,
+        'density_negative': n_negative / area if area > 0 else 0,
+        'mitosis_per_mm2': n_mitosis / area if area > 0 else 0,
+        'area_mm2': area,
+        'calibration_scale': scale,
+        'width': width,
+        'height': height,
+    }
+
+
+def points_to_um(point_lists, scale):
+    """Arreglo N×2 en µm a partir de listas de marcadores (x, y, ...)"""
+    coords = [(p[0], p[1]) for points in point_lists for p in points]
+    return np.array(coords, dtype=np.float64).reshape(-1, 2) * scale
+
+
+def distribution_metrics(points, progress=None, cache=None):
+    """Estadísticas de las distancias entre todos los pares de núcleos (puntos N×2 en µm)
+
+    Los pares se recorren por bloques de filas y los momentos se combinan
+    bloque a bloque, con memoria acotada por DISTANCE_BLOCK_PAIRS.
+    """
+    if cache is not None:
+        return cached_result(cache, ("distribution", points_key(points)),
+                             lambda: distribution_metrics(points, progress))
+    n = len(points)
+    if n < 2:
+        return {'min_distance': 0, 'max_distance': 0, 'avg_distance': 0, 'std_distance': 0,
+                'cv_distance': 0}
+    count, mean, m2 = 0, 0.0, 0.0
+    min_d, max_d = np.inf, -np.inf
+    rows = max(1, DISTANCE_BLOCK_PAIRS // n)
+    for start in range(0, n - 1, rows):
+        if progress:
+            progress(start, n)
+        stop = min(start + rows, n - 1)
+        block, others = points[start:stop], points[start + 1:]
+        d = np.hypot(block[:, 0, None] - others[None, :, 0], block[:, 1, None] - others[None, :, 1])
+        # Solo los pares (i, j) con j > i
+        d = d[np.arange(len(block))[:, None] <= np.arange(d.shape[1])[None, :]]
+        # Combinación de medias y sumas de cuadrados (Chan et al.)
+        block_mean = d.mean()
+        block_m2 = ((d - block_mean) ** 2).sum()
+        delta = block_mean - mean
+        total = count + d.size
+        mean += delta * d.size / total
+        m2 += block_m2 + delta ** 2 * count * d.size / total
+        count = total
+        min_d, max_d = min(min_d, d.min()), max(max_d, d.max())
+    std = np.sqrt(m2 / count)
+    return {
+        'min_distance': float(min_d),
+        'max_distance': float(max_d),
+        'avg_distance': float(mean),
+        'std_distance': float(std),
+        'cv_distance': float(std / mean) if mean > 0 else 0
+    }
+
+
+def clustering_metrics(points, area, cluster_distance=CLUSTER_DISTANCE, progress=None, cache=None):
+    """Grupos de núcleos conectados a menos de cluster_distance µm (puntos N×2 en µm)
+
+    Un grupo es una componente conexa con al menos dos núcleos; los vecinos
+    se buscan con un árbol k-d en lugar de comparar todos los pares.
+    """
+    if cache is not None:
+        return cached_result(cache, ("clustering", points_key(points), area, cluster_distance),
+                             lambda: clustering_metrics(points, area, cluster_distance, progress))
+    n = len(points)
+    empty = {'clustering_index': 0, 'num_clusters': 0, 'avg_cluster_size': 0, 'cluster_density': 0}
+    if n < 3:
+        return empty
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    # query_pairs incluye la distancia límite; el criterio es estricto (<)
+    pairs = cKDTree(points).query_pairs(np.nextafter(cluster_distance, 0), output_type='ndarray')
+    if progress:
+        progress(1, 2)
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, component = connected_components(graph, directed=False)
+    sizes = np.bincount(component)
+    sizes = sizes[sizes > 1]
+    if progress:
+        progress(2, 2)
+    if not len(sizes):
+        return empty
+    return {
+        'clustering_index': len(sizes) / n,
+        'num_clusters': int(len(sizes)),
+        'avg_cluster_size': float(sizes.mean()),
+        'cluster_density': len(sizes) / area if area > 0 else 0
+    }
+
+
+def stain_statistics(image, image_key=None, deconvolver=None, cache=None, progress=None):
+    """Estadísticas H-DAB de la imagen; con image_key (hash de la imagen) pasan por la caché"""
+    deconvolver = deconvolver or StainDeconvolver()
+    if image_key is None:
+        cache = None
+    return cached_result(cache, ("stain", image_key, array_digest(deconvolver.stains)),
+                         lambda: deconvolver.statistics(image, progress=progress))
+
+
+def image_metrics(image, xs, ys, labels, scale, stain=True, deconvolver=None, progress=None,
+                  image_key=None, cache=None):
+    """Todas las métricas de una imagen con sus anotaciones en columnas, como un dict plano"""
+    labels = np.asarray(labels)
+    counts = {name: int(np.count_nonzero(labels == label_id)) for name, label_id in LABEL_IDS.items()}
+    width, height = image.size
+    row = basic_metrics(counts['ki67'], counts['negative'], counts['mitosis'], width, height, scale)
+    if stain:
+        row.update(stain_statistics(image, image_key, deconvolver, cache))
+    points = np.column_stack([np.asarray(xs, np.float64), np.asarray(ys, np.float64)]) * scale
+    row.update(distribution_metrics(points, progress, cache))
+    row.update(clustering_metrics(points, row['area_mm2'], cache=cache))
+    return row
+
+
+def file_metrics(image_path, annotation_path, scale=None, stain=True, use_cache=True):
+    """Métricas de un par (imagen, anotaciones) en un proceso del grupo
+
+    La escala sale, por orden, de scale, del proyecto (.hpz/.hpa), de la
+    lámina o de DEFAULT_SCALE. Con use_cache, la imagen solo se decodifica
+    si sus métricas de tinción no están ya en la caché de resultados.
+    """
+    if scale is None and os.path.splitext(annotation_path)[1].lower() in PROJECT_EXTENSIONS:
+        scale = read_project(annotation_path)[0].get("calibration_scale")
+    image = load_image(image_path)
+    try:
+        if scale is None:
+            scale = getattr(image, "microns_per_pixel", None) or DEFAULT_SCALE
+        xs, ys, labels = read_points(annotation_path)
+        row = {'image': image_path, 'annotations': annotation_path}
+        if use_cache:
+            row.update(image_metrics(image, xs, ys, labels, scale, stain,
+                                     image_key=stat_file_digest(image_path), cache=result_cache))
+        else:
+            row.update(image_metrics(image, xs, ys, labels, scale, stain))
+        return row
+    finally:
+        if is_lazy_image(image):
+            image.close()
+
+
+def expand_inputs(patterns):
+    """Imágenes de una lista de rutas, globs o directorios, con sus anotaciones -> [(imagen, anotaciones)]
+
+    Las imágenes sin archivo de anotaciones se omiten.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(os.path.join(pattern, name) for name in sorted(os.listdir(pattern)))
+        else:
+            paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    pairs = []
+    for path in dict.fromkeys(paths):
+        if os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+            continue
+        annotation_path = find_annotations(path)
+        if annotation_path:
+            pairs.append((path, annotation_path))
+    return pairs
+
+
+def batch_metrics(pairs, jobs=None, scale=None, stain=True, progress=None, on_row=None, use_cache=True):
+    """Métricas de varios pares (imagen, anotaciones) en un grupo de procesos -> filas en el orden de entrada
+
+    Un par que falla produce una fila con la columna 'error'. on_row(índice,
+    fila) se llama en cuanto cada fila está lista, para registrarla de inmediato.
+    """
+    rows = [None] * len(pairs)
+    if progress:
+        progress(0, len(pairs))
+    if not pairs:
+        return rows
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, len(pairs)),
+                             mp_context=context) as executor:
+        futures = {executor.submit(file_metrics, image_path, annotation_path, scale, stain, use_cache): i
+                   for i, (image_path, annotation_path) in enumerate(pairs)}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                try:
+                    rows[i] = future.result()
+                except Exception as e:
+                    rows[i] = {'image': pairs[i][0], 'annotations': pairs[i][1], 'error': str(e)}
+                if on_row:
+                    on_row(i, rows[i])
+                if progress:
+                    progress(done, len(pairs))
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return rows
+
+
+def write_table(rows, path):
+    """Escribe las filas en una tabla: Parquet si la extensión es .parquet, CSV en otro caso"""
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    if os.path.splitext(path)[1].lower() == ".parquet":
+        import pandas as pd
+        pd.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        return path
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+def main(argv=None):
+    """Calcula métricas por lotes: python histopath_metrics.py imagenes... -o tabla.csv"""
+    parser = argparse.ArgumentParser(description="Métricas por lotes de HistoPath Analyst (sin interfaz)")
+    parser.add_argument("inputs", nargs="+", help="Imágenes, globs o directorios (anotaciones junto a cada imagen)")
+    parser.add_argument("-o", "--output", required=True, help="Tabla de salida (.csv o .parquet)")
+    parser.add_argument("--jobs", type=int, default=None, help="Procesos en paralelo")
+    parser.add_argument("--scale", type=float, default=None, help="Escala en µm/píxel (por defecto, la del proyecto o la lámina)")
+    parser.add_argument("--no-stain", action="store_true", help="Omite las métricas de tinción H-DAB")
+    parser.add_argument("--no-cache", action="store_true", help="Recalcula todo sin usar la caché de resultados")
+    args = parser.parse_args(argv)
+
+    pairs = expand_inputs(args.inputs)
+    if not pairs:
+        parser.error("no se encontraron imágenes con anotaciones")
+
+    def report(done, total):
+        print(f"\r{done}/{total}", end="", flush=True)
+
+    rows = batch_metrics(pairs, args.jobs, args.scale, not args.no_stain, progress=report,
+                         use_cache=not args.no_cache)
+    write_table(rows, args.output)
+    failed = [row for row in rows if 'error' in row]
+    print(f"\n{len(rows) - len(failed)} imágenes en {args.output}, con error: {len(failed)}")
+    for row in failed:
+        print(f"  {row['image']}: {row['error']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,517 @@
+"""
+Formatos de proyecto y de anotaciones de HistoPath Analyst.
+
+.hpa  JSON legible (versión 1.3) con las anotaciones como lista de
+      {"x", "y", "label_id"}; se mantiene para importar y exportar.
+.hpz  Contenedor NumPy (.npz comprimido) con las anotaciones en columnas
+      (x, y, label_id) y los metadatos del proyecto en JSON. Se lee con
+      una sola lectura vectorizada por columna, sin construir un dict por
+      anotación.
+
+Las anotaciones sueltas ([{"x", "y", "label_id"}, ...] en .json, o un
+objeto por línea en .jsonl) se leen y escriben en streaming: la memoria
+de trabajo es constante y solo crecen las columnas de resultado.
+
+El autoguardado añade cada edición a un diario <proyecto>.journal que se
+reproduce al abrir el proyecto y se compacta periódicamente en él.
+
+Todas las escrituras son atómicas: se serializan en un temporal del mismo
+directorio, se sincronizan con fsync y se renombran sobre el destino, de
+modo que un cierre inesperado o un disco lleno dejan el archivo anterior intacto.
+"""
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from itertools import repeat
+
+import numpy as np
+
+PROJECT_VERSION = "1.3"
+JSON_EXTENSION = ".hpa"
+BINARY_EXTENSION = ".hpz"
+PROJECT_EXTENSIONS = (JSON_EXTENSION, BINARY_EXTENSION)
+# Identificadores de clase usados en los archivos
+LABEL_IDS = {"ki67": 1, "negative": 2, "mitosis": 3}
+COORD_DTYPE = np.int32
+LABEL_DTYPE = np.uint8
+ZIP_MAGIC = b"PK\x03\x04"
+JSONL_EXTENSION = ".jsonl"
+# Anotaciones buscadas junto a una imagen (mismo nombre base), en orden de preferencia
+ANNOTATION_EXTENSIONS = (BINARY_EXTENSION, JSON_EXTENSION, ".json", JSONL_EXTENSION)
+# Tamaño de lectura del parser incremental y de los bloques de escritura
+STREAM_CHUNK = 1 << 16
+WRITE_CHUNK = 4096
+# Tamaño máximo de una anotación individual antes de considerar el archivo corrupto
+MAX_RECORD_CHARS = 1 << 20
+
+
+def points_to_columns(point_lists):
+    """Listas de marcadores {label_id: [(x, y, id), ...]} -> columnas x, y, label_id
+
+    Las coordenadas se truncan a enteros, igual que en el formato JSON.
+    """
+    xs, ys, labels = [], [], []
+    for label_id, points in point_lists.items():
+        coords = np.array([(x, y) for x, y, _ in points], dtype=np.float64).reshape(-1, 2)
+        xs.append(coords[:, 0].astype(COORD_DTYPE))
+        ys.append(coords[:, 1].astype(COORD_DTYPE))
+        labels.append(np.full(len(coords), label_id, dtype=LABEL_DTYPE))
+    if not xs:
+        empty = np.empty(0, dtype=COORD_DTYPE)
+        return empty, empty.copy(), np.empty(0, dtype=LABEL_DTYPE)
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(labels)
+
+
+def columns_to_points(xs, ys, labels, label_ids=tuple(LABEL_IDS.values())):
+    """Columnas -> {label_id: [(x, y, None), ...]} con enteros de Python"""
+    point_lists = {}
+    for label_id in label_ids:
+        mask = labels == label_id
+        point_lists[label_id] = list(zip(xs[mask].tolist(), ys[mask].tolist(), repeat(None)))
+    return point_lists
+
+
+def annotations_to_columns(annotations):
+    """Lista de dicts {"x", "y", "label_id"} -> columnas, descartando entradas incompletas"""
+    rows = [(a.get('x'), a.get('y'), a.get('label_id')) for a in annotations]
+    rows = [r for r in rows if r[0] is not None and r[1] is not None and r[2] is not None]
+    table = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return (table[:, 0].astype(COORD_DTYPE), table[:, 1].astype(COORD_DTYPE),
+            table[:, 2].astype(LABEL_DTYPE))
+
+
+def columns_to_annotations(xs, ys, labels):
+    """Columnas -> lista de dicts {"x", "y", "label_id"} del formato JSON"""
+    return [{"x": x, "y": y, "label_id": label_id}
+            for x, y, label_id in zip(xs.tolist(), ys.tolist(), labels.tolist())]
+
+
+def is_binary_project(path):
+    """True si el archivo es un contenedor .hpz (se reconoce por contenido, no por extensión)"""
+    with open(path, 'rb') as f:
+        return f.read(len(ZIP_MAGIC)) == ZIP_MAGIC
+
+
+def read_project(path):
+    """Lee un proyecto .hpa o .hpz -> (metadatos, x, y, label_id)"""
+    if is_binary_project(path):
+        with np.load(path, allow_pickle=False) as data:
+            metadata = json.loads(data['metadata'].tobytes().decode('utf-8'))
+            return (metadata, data['x'].astype(COORD_DTYPE), data['y'].astype(COORD_DTYPE),
+                    data['label_id'].astype(LABEL_DTYPE))
+    with open(path, 'r') as f:
+        project_data = json.load(f)
+    xs, ys, labels = annotations_to_columns(project_data.pop("annotations", []))
+    return project_data, xs, ys, labels
+
+
+def read_project_metadata(path):
+    """Metadatos de un proyecto .hpa o .hpz, sin decodificar las anotaciones del .hpz"""
+    if is_binary_project(path):
+        with np.load(path, allow_pickle=False) as data:
+            return json.loads(data['metadata'].tobytes().decode('utf-8'))
+    with open(path, 'r') as f:
+        project_data = json.load(f)
+    project_data.pop("annotations", None)
+    return project_data
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Abre un temporal junto a path; al salir sin error lo sincroniza y lo renombra sobre path"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, mode, **({} if 'b' in mode else {"encoding": "utf-8"})) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_directory(directory)
+
+
+def _fsync_directory(directory):
+    """Persiste el renombrado; no todos los sistemas permiten abrir directorios"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_project(path, metadata, xs, ys, labels):
+    """Escribe un proyecto: binario .hpz salvo que la extensión sea .hpa (JSON)"""
+    metadata = dict(metadata, version=metadata.get("version", PROJECT_VERSION))
+    if os.path.splitext(path)[1].lower() == JSON_EXTENSION:
+        project_data = dict(metadata, annotations=columns_to_annotations(xs, ys, labels))
+        with atomic_write(path) as f:
+            json.dump(project_data, f, indent=4)
+    else:
+        encoded = np.frombuffer(json.dumps(metadata).encode('utf-8'), dtype=np.uint8)
+        with atomic_write(path, 'wb') as f:
+            np.savez_compressed(f, metadata=encoded, x=np.asarray(xs, COORD_DTYPE),
+                                y=np.asarray(ys, COORD_DTYPE), label_id=np.asarray(labels, LABEL_DTYPE))
+    return path
+
+
+def _decode_batch(decoder, segment, in_array):
+    """Decodifica los registros completos de un segmento -> (registros, caracteres consumidos)
+
+    Camino rápido: el segmento entero como un arreglo JSON. Si el corte no
+    coincide con el final de un registro (p. ej. objetos anidados), se
+    decodifica registro a registro y se devuelve cuánto se consumió.
+    """
+    body = segment.strip(" \t\r\n,")
+    if not body:
+        return [], len(segment)
+    if not in_array:
+        body = ",".join(line for line in body.splitlines() if line.strip())
+    try:
+        return json.loads("[" + body + "]"), len(segment)
+    except json.JSONDecodeError:
+        pass
+    records, pos = [], 0
+    while True:
+        while pos < len(segment) and segment[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(segment):
+            return records, pos
+        try:
+            record, pos = decoder.raw_decode(segment, pos)
+        except json.JSONDecodeError:
+            return records, pos
+        records.append(record)
+
+
+def iter_annotation_batches(path):
+    """Recorre un archivo .json o .jsonl por lotes de anotaciones, sin cargarlo completo
+
+    El archivo se lee por bloques de STREAM_CHUNK caracteres; cada bloque se
+    corta tras el último '}' y se decodifica de una vez, así que la memoria
+    de trabajo no depende del tamaño del archivo.
+    """
+    decoder = json.JSONDecoder()
+    jsonl = path.lower().endswith(JSONL_EXTENSION)
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ""
+        while not buffer:
+            chunk = f.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            buffer = chunk.lstrip()
+        if not buffer:
+            # Un registro .jsonl sin anotaciones es un archivo vacío (write_annotations)
+            if jsonl:
+                return
+            raise ValueError("El archivo de anotaciones está vacío.")
+        eof = False
+        # Arreglo JSON; los objetos sueltos (uno por línea) solo en .jsonl
+        in_array = buffer.startswith("[")
+        if in_array:
+            buffer = buffer[1:]
+        elif not (jsonl and buffer.startswith("{")):
+            raise ValueError("El archivo JSON debe contener una lista de anotaciones.")
+        while True:
+            if not eof:
+                chunk = f.read(STREAM_CHUNK)
+                eof = not chunk
+                buffer += chunk
+            if eof:
+                segment, buffer = buffer, ""
+                if in_array:
+                    segment = segment.rstrip()
+                    if not segment.endswith("]"):
+                        raise ValueError("Archivo de anotaciones incompleto: falta ']'")
+                    segment = segment[:-1]
+            else:
+                cut = buffer.rfind("}") + 1
+                if cut == 0 and len(buffer) > MAX_RECORD_CHARS:
+                    raise ValueError("Anotación demasiado grande: el archivo parece estar dañado.")
+                segment, buffer = buffer[:cut], buffer[cut:]
+            records, consumed = _decode_batch(decoder, segment, in_array)
+            if records:
+                yield records
+            if consumed < len(segment):
+                if eof:
+                    # Resto que no es un registro válido
+                    decoder.raw_decode(segment, consumed)
+                buffer = segment[consumed:] + buffer
+            elif eof:
+                return
+
+
+def read_annotations(path):
+    """Lee un archivo de anotaciones .json/.jsonl en streaming -> columnas x, y, label_id
+
+    Un registro sin las claves x, y y label_id (otro tipo de archivo) es un
+    error; las entradas con alguno de esos valores en null se descartan,
+    como en la carga original.
+    """
+    blocks = []
+    for records in iter_annotation_batches(path):
+        try:
+            rows = [(r['x'], r['y'], r['label_id']) for r in records]
+        except (KeyError, TypeError):
+            raise ValueError("Cada anotación debe ser un objeto {\"x\", \"y\", \"label_id\"}.")
+        rows = [r for r in rows if r[0] is not None and r[1] is not None and r[2] is not None]
+        if rows:
+            blocks.append(np.array(rows, dtype=np.float64))
+    table = np.concatenate(blocks) if blocks else np.empty((0, 3), dtype=np.float64)
+    return (table[:, 0].astype(COORD_DTYPE), table[:, 1].astype(COORD_DTYPE),
+            table[:, 2].astype(LABEL_DTYPE))
+
+
+def _format_rows(xs, ys, labels):
+    return ['{"x": %d, "y": %d, "label_id": %d}' % row
+            for row in zip(xs.tolist(), ys.tolist(), labels.tolist())]
+
+
+def _write_rows(f, xs, ys, labels, separator, first=True):
+    """Escribe las anotaciones por bloques de WRITE_CHUNK filas"""
+    for start in range(0, len(xs), WRITE_CHUNK):
+        if not first:
+            f.write(separator)
+        end = start + WRITE_CHUNK
+        f.write(separator.join(_format_rows(xs[start:end], ys[start:end], labels[start:end])))
+        first = False
+
+
+def write_annotations(path, xs, ys, labels):
+    """Escribe anotaciones en .json (arreglo, un objeto por línea) o .jsonl, por bloques"""
+    xs, ys = np.asarray(xs, COORD_DTYPE), np.asarray(ys, COORD_DTYPE)
+    labels = np.asarray(labels, LABEL_DTYPE)
+    with atomic_write(path) as f:
+        if path.lower().endswith(JSONL_EXTENSION):
+            _write_rows(f, xs, ys, labels, "\n")
+            if len(xs):
+                f.write("\n")
+        else:
+            f.write("[\n")
+            _write_rows(f, xs, ys, labels, ",\n")
+            f.write("\n]\n")
+    return path
+
+
+def append_annotations(path, xs, ys, labels):
+    """Añade anotaciones al final de un registro .jsonl sin reescribirlo"""
+    with open(path, 'a', encoding='utf-8') as f:
+        _write_rows(f, np.asarray(xs, COORD_DTYPE), np.asarray(ys, COORD_DTYPE),
+                    np.asarray(labels, LABEL_DTYPE), "\n")
+        if len(xs):
+            f.write("\n")
+
+
+def read_points(path):
+    """Columnas (x, y, label_id) de un proyecto (.hpz/.hpa) o de un archivo de anotaciones"""
+    if os.path.splitext(path)[1].lower() in PROJECT_EXTENSIONS:
+        return read_project(path)[1:]
+    return read_annotations(path)
+
+
+def find_annotations(image_path):
+    """Archivo de anotaciones de una imagen (mismo nombre base), o None"""
+    stem = os.path.splitext(image_path)[0]
+    for ext in ANNOTATION_EXTENSIONS:
+        if os.path.exists(stem + ext):
+            return stem + ext
+    return None
+
+
+# --- Diario de ediciones (autoguardado incremental) ---
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_PREV_SUFFIX = ".journal.prev"
+
+
+class AnnotationJournal:
+    """Diario de solo-añadir con las ediciones de anotaciones de un proyecto
+
+    Cada alta, baja o limpieza se añade como una línea JSON al archivo
+    <proyecto>.journal, cuya primera línea indica la generación del proyecto
+    sobre la que se aplica; las altas en bloque (conteo automático,
+    importación) van en una sola línea. Al compactar, el diario actual pasa
+    a .prev (rotate) y se abre uno nuevo con la generación siguiente; cuando
+    el proyecto con esa generación ya está escrito, finish_rotation borra .prev.
+
+    Un diario anterior en la misma ruta no se trunca ni se borra al abrir:
+    se aparta en .prev como en una rotación. Quien lo abre debe haber
+    recuperado antes sus ediciones (pending_journal).
+    """
+
+    def __init__(self, project_path, generation):
+        self.path = project_path + JOURNAL_SUFFIX
+        self.prev_path = project_path + JOURNAL_PREV_SUFFIX
+        self.generation = generation
+        self.pending = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            self._set_aside()
+        self._file = self._start(generation)
+
+    def _start(self, generation):
+        f = open(self.path, 'w', encoding='utf-8')
+        f.write(json.dumps({"op": "header", "generation": generation}) + "\n")
+        f.flush()
+        return f
+
+    def record(self, op, label_id=None, x=None, y=None):
+        """Añade una edición: op es 'add', 'delete' o 'clear'"""
+        if op == "clear":
+            entry = {"op": op}
+        else:
+            entry = {"op": op, "label_id": int(label_id), "x": float(x), "y": float(y)}
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self.pending += 1
+
+    def record_batch(self, xs, ys, labels):
+        """Añade un alta en bloque de columnas (x, y, label_id); cuenta como len(xs) ediciones"""
+        entry = {"op": "add_batch", "x": np.asarray(xs, np.float64).tolist(),
+                 "y": np.asarray(ys, np.float64).tolist(), "label_id": np.asarray(labels, int).tolist()}
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self.pending += len(entry["x"])
+
+    def _set_aside(self):
+        """Mueve el diario a .prev; si .prev ya existe (compactación fallida), lo añade en orden"""
+        if os.path.exists(self.prev_path):
+            with open(self.path, 'r', encoding='utf-8') as src, \
+                    open(self.prev_path, 'a', encoding='utf-8') as dst:
+                # La cabecera se conserva: marca la generación de cada tramo
+                for line in src:
+                    dst.write(line)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.prev_path)
+
+    def rotate(self, generation):
+        """Aparta las ediciones actuales en .prev y empieza un diario para la nueva generación"""
+        with self._lock:
+            self._file.close()
+            self._set_aside()
+            self.generation = generation
+            self.pending = 0
+            self._file = self._start(generation)
+
+    def finish_rotation(self, generation):
+        """El proyecto de esa generación ya está en disco: las ediciones apartadas sobran
+
+        Si hubo otra rotación después, .prev aún guarda ediciones que ese
+        proyecto no contiene y se conserva hasta que se escriba el siguiente.
+        """
+        with self._lock:
+            if generation == self.generation and os.path.exists(self.prev_path):
+                os.remove(self.prev_path)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def read_journal(project_path, generation):
+    """Ediciones pendientes de un proyecto -> (registros, mayor generación encontrada)
+
+    Cada tramo del diario empieza con una cabecera de generación; solo cuentan
+    los tramos con generación >= la del proyecto, los demás ya fueron
+    compactados en él.
+    """
+    records = []
+    max_generation = generation
+    for path in (project_path + JOURNAL_PREV_SUFFIX, project_path + JOURNAL_SUFFIX):
+        if not os.path.exists(path):
+            continue
+        segment_generation = -1
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Línea cortada por un cierre inesperado
+                    continue
+                if entry.get("op") == "header":
+                    segment_generation = entry.get("generation", -1)
+                    max_generation = max(max_generation, segment_generation)
+                elif segment_generation >= generation:
+                    records.append(entry)
+    return records, max_generation
+
+
+def pending_journal(project_path):
+    """Ediciones del diario que el proyecto guardado en project_path aún no contiene
+
+    Sin proyecto en disco, todas las del diario están pendientes.
+    """
+    generation = 0
+    if os.path.exists(project_path):
+        generation = read_project_metadata(project_path).get("journal_generation", 0)
+    return read_journal(project_path, generation)[0]
+
+
+def project_path_in_use(project_path):
+    """True si ya hay un proyecto o un diario en esa ruta"""
+    return any(os.path.exists(project_path + suffix) for suffix in ("", JOURNAL_SUFFIX, JOURNAL_PREV_SUFFIX))
+
+
+def free_project_path(stem, extension=BINARY_EXTENSION):
+    """Primera ruta libre entre <stem>.hpz, <stem> (2).hpz, <stem> (3).hpz, ..."""
+    path, n = stem + extension, 1
+    while project_path_in_use(path):
+        n += 1
+        path = f"{stem} ({n}){extension}"
+    return path
+
+
+def discard_journal(project_path):
+    """Borra los diarios de un proyecto"""
+    for path in (project_path + JOURNAL_PREV_SUFFIX, project_path + JOURNAL_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def apply_journal(point_lists, records):
+    """Aplica ediciones del diario a {label_id: [(x, y, id), ...]}; devuelve cuántas se aplicaron
+
+    Las bajas se comparan con coordenadas truncadas, porque el proyecto
+    guarda enteros y la sesión original trabajaba con decimales.
+    """
+    applied = 0
+    for entry in records:
+        op = entry.get("op")
+        if op == "clear":
+            for points in point_lists.values():
+                points.clear()
+        elif op == "add_batch":
+            for x, y, label_id in zip(entry.get("x", ()), entry.get("y", ()), entry.get("label_id", ())):
+                if label_id in point_lists:
+                    point_lists[label_id].append((x, y, None))
+                    applied += 1
+            continue
+        elif op in ("add", "delete") and entry.get("label_id") in point_lists:
+            points = point_lists[entry["label_id"]]
+            x, y = entry["x"], entry["y"]
+            if op == "add":
+                points.append((x, y, None))
+            else:
+                for i in range(len(points) - 1, -1, -1):
+                    if int(points[i][0]) == int(x) and int(points[i][1]) == int(y):
+                        del points[i]
+                        break
+        else:
+            continue
+        applied += 1
+    return applied
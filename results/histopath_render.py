@@ -0,0 +1,221 @@
+"""
+Renderizado fuera de pantalla de HistoPath Analyst.
+
+Los gráficos de las ventanas de análisis se dibujan con el backend Agg en
+un hilo de trabajo y se entregan como mapas de bits (PIL), que se guardan
+en una caché LRU por (análisis, revisión de datos).
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+FIGURE_DPI = 100
+FIGURE_CACHE_ENTRIES = 32
+
+
+def render_figure(build, args=(), figsize=(8, 6), dpi=FIGURE_DPI):
+    """Construye una figura con build(fig, *args) y la rasteriza con Agg"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    build(fig, *args)
+    canvas.draw()
+    return Image.fromarray(np.asarray(canvas.buffer_rgba())).convert("RGB")
+
+
+class FigureRenderer:
+    """Rasteriza figuras en un hilo propio y guarda los resultados en caché
+
+    Un único hilo serializa el uso de matplotlib, que no admite dibujar
+    figuras en paralelo de forma segura.
+    """
+
+    def __init__(self, max_entries=FIGURE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="figure-render")
+
+    def cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        return None
+
+    def submit(self, key, build, args=(), figsize=(8, 6)):
+        """Future con el mapa de bits de la figura; reutiliza la caché y los envíos en curso"""
+        bitmap = self.cached(key)
+        if bitmap is not None:
+            future = Future()
+            future.set_result(bitmap)
+            return future
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+        future = self._executor.submit(self._render, key, build, args, figsize)
+        with self._lock:
+            self._pending[key] = future
+        return future
+
+    def _render(self, key, build, args, figsize):
+        bitmap = self.cached(key)
+        if bitmap is None:
+            bitmap = render_figure(build, args, figsize)
+        with self._lock:
+            self._cache[key] = bitmap
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            self._pending.pop(key, None)
+        return bitmap
+
+
+# --- Constructores de figuras (solo datos, sin dependencias de Tk) ---
+
+def build_count_distribution(fig, counts, colors):
+    """Gráfico de barras con el conteo de cada tipo de núcleo"""
+    ax1 = fig.add_subplot(111)
+    categories = ['Ki-67 Positivo (+)', 'Ki-67 Negativo (-)', 'Otros']
+    bars = ax1.bar(categories, counts, color=colors)
+    ax1.set_title('Distribución de Núcleos Identificados')
+    ax1.set_ylabel('Cantidad')
+
+    # Añadir valores en las barras
+    for bar, count in zip(bars, counts):
+        height = bar.get_height()
+        ax1.text(bar.get_x() + bar.get_width()/2., height,
+                 f'{count}', ha='center', va='bottom')
+
+
+def build_spatial_scatter(fig, points_by_class, colors):
+    """Dispersión de la posición de los núcleos (µm), una serie por clase"""
+    from matplotlib.patches import Patch
+
+    ax2 = fig.add_subplot(111)
+    labels = ['Ki-67 Positivo (+)', 'Ki-67 Negativo (-)', 'Otros']
+    for points, color in zip(points_by_class, colors):
+        if len(points):
+            ax2.scatter(points[:, 0], points[:, 1], c=color, alpha=0.6, s=20)
+    ax2.set_xlabel('Coordenada X (µm)')
+    ax2.set_ylabel('Coordenada Y (µm)')
+    ax2.set_title('Distribución Espacial de Núcleos')
+    ax2.grid(True, alpha=0.3)
+
+    # Añadir leyenda
+    legend_elements = [Patch(facecolor=color, label=label) for color, label in zip(colors, labels)]
+    ax2.legend(handles=legend_elements)
+
+
+def build_color_scatter(fig, sample_pixels):
+    """Diagrama de dispersión 3D de la muestra de píxeles en el espacio RGB"""
+    ax_scatter = fig.add_subplot(111, projection='3d')
+
+    # Normalizar colores para visualización
+    norm_pixels = sample_pixels / 255.0
+
+    ax_scatter.scatter(
+        sample_pixels[:, 0],  # Rojo
+        sample_pixels[:, 1],  # Verde
+        sample_pixels[:, 2],  # Azul
+        c=norm_pixels,
+        marker='o',
+        alpha=0.6,
+        s=10
+    )
+
+    ax_scatter.set_xlabel('Canal Rojo')
+    ax_scatter.set_ylabel('Canal Verde')
+    ax_scatter.set_zlabel('Canal Azul')
+    ax_scatter.set_title('Espacio de Color RGB - Distribución de Píxeles')
+
+
+def build_color_histograms(fig, rgb_hist, hsv_hist, total):
+    """Histogramas exactos de los canales RGB y HSV"""
+    ax_hist1 = fig.add_subplot(211)
+    ax_hist2 = fig.add_subplot(212)
+
+    # Histograma RGB (exacto, 256 niveles)
+    levels = np.arange(257)
+    colors = ['red', 'green', 'blue']
+    channels = ['Rojo', 'Verde', 'Azul']
+    for i, color in enumerate(colors):
+        ax_hist1.stairs(rgb_hist[i] / total, levels, fill=True,
+                        alpha=0.5, color=color, label=channels[i])
+    ax_hist1.set_title('Distribución de Canales RGB')
+    ax_hist1.set_xlabel('Intensidad')
+    ax_hist1.set_ylabel('Densidad')
+    ax_hist1.legend()
+    ax_hist1.grid(True, alpha=0.3)
+
+    # Histograma HSV
+    hsv_channels = ['Matiz (Hue)', 'Saturación (Sat)', 'Valor (Val)']
+    hsv_colors = ['magenta', 'cyan', 'yellow']
+    for i in range(3):
+        ax_hist2.stairs(hsv_hist[i] / total, levels, fill=True,
+                        alpha=0.5, color=hsv_colors[i], label=hsv_channels[i])
+    ax_hist2.set_title('Distribución de Canales HSV')
+    ax_hist2.set_xlabel('Valor')
+    ax_hist2.set_ylabel('Densidad')
+    ax_hist2.legend()
+    ax_hist2.grid(True, alpha=0.3)
+
+    fig.tight_layout()
+
+
+def build_color_palette(fig, dominant_colors, color_fractions):
+    """Paleta de colores dominantes con el porcentaje de píxeles de cada uno"""
+    ax_palette = fig.add_subplot(111)
+    n_colors = len(dominant_colors)
+    palette = [np.asarray(color) / 255.0 for color in dominant_colors]
+
+    # Mostrar paleta
+    ax_palette.imshow([palette], aspect='auto', extent=[0, n_colors, 0, 1])
+    ax_palette.set_title(f'Paleta de {n_colors} Colores Dominantes')
+    ax_palette.set_xlabel('Colores')
+    ax_palette.set_ylabel('')
+    ax_palette.set_yticks([])
+    ax_palette.set_xticks(np.arange(n_colors) + 0.5)
+    ax_palette.set_xticklabels([f'Color {i+1}' for i in range(n_colors)], rotation=45)
+
+    # Añadir información de porcentajes
+    for i, fraction in enumerate(color_fractions):
+        ax_palette.text(i + 0.5, 0.5, f'{fraction * 100:.1f}%',
+                        ha='center', va='center', fontsize=8,
+                        bbox=dict(boxstyle="round,pad=0.3", facecolor="white", alpha=0.8))
+
+    fig.tight_layout()
+
+
+def build_color_pca(fig, sample_pixels, explained_ratio, pca_result):
+    """Proyecciones 2D y 3D de la muestra de píxeles sobre las componentes principales"""
+    ax_pca1 = fig.add_subplot(221)
+    ax_pca2 = fig.add_subplot(222)
+    ax_pca3 = fig.add_subplot(223)
+    ax_pca4 = fig.add_subplot(224, projection='3d')
+
+    norm_pixels = sample_pixels / 255.0
+
+    # Gráficos 2D: pares de componentes
+    for ax, (a, b) in [(ax_pca1, (0, 1)), (ax_pca2, (0, 2)), (ax_pca3, (1, 2))]:
+        ax.scatter(pca_result[:, a], pca_result[:, b], c=norm_pixels, alpha=0.6, s=10)
+        ax.set_xlabel(f'PC{a + 1} ({explained_ratio[a]:.2%} var.)')
+        ax.set_ylabel(f'PC{b + 1} ({explained_ratio[b]:.2%} var.)')
+        ax.set_title(f'PCA: Componente {a + 1} vs Componente {b + 1}')
+        ax.grid(True, alpha=0.3)
+
+    # Gráfico 3D
+    ax_pca4.scatter(pca_result[:, 0], pca_result[:, 1], pca_result[:, 2],
+                    c=norm_pixels, alpha=0.6, s=10)
+    ax_pca4.set_xlabel('PC1')
+    ax_pca4.set_ylabel('PC2')
+    ax_pca4.set_zlabel('PC3')
+    ax_pca4.set_title('PCA 3D - Espacio de Color Reducido')
+
+    fig.tight_layout()
@@ -0,0 +1,169 @@
+"""
+Servicio de inferencia en segundo plano para HistoPath Analyst.
+
+Un proceso aparte carga el modelo PathoNet una sola vez y lo mantiene
+listo entre conteos. La interfaz le envía trabajos (imagen y lista de
+regiones) por una cola y recibe por otra los núcleos de cada región en
+cuanto están listos, de modo que los marcadores aparecen región por
+región sin bloquear el bucle de Tk. Las regiones se analizan por
+prioridad: primero las que se ven en pantalla, luego las vecinas y al
+final el resto; la interfaz actualiza la vista visible en memoria
+compartida y el proceso reordena lo pendiente antes de cada región. Solo
+un trabajo está activo a la vez: enviar uno nuevo o cancelar descarta el
+anterior, también a mitad de una región.
+
+Con model_path = "stub" (histopath_inference.STUB_MODEL) el servicio usa
+un modelo de prueba sin red neuronal.
+"""
+import multiprocessing
+import queue
+
+import numpy as np
+
+from histopath_inference import INFERENCE_CPUS, INFERENCE_THREADS, PathoNetEngine
+
+# Lado de las regiones en que se reparte una imagen (píxeles)
+REGION_SIZE = 1024
+# Espera máxima al cerrar el proceso antes de terminarlo a la fuerza (s)
+SHUTDOWN_TIMEOUT = 5
+
+
+def region_grid(width, height, size=REGION_SIZE):
+    """Regiones que cubren la imagen, por filas"""
+    return [(x, y, min(x + size, width), min(y + size, height))
+            for y in range(0, height, size) for x in range(0, width, size)]
+
+
+def region_order(boxes, viewport):
+    """Índices de las regiones por prioridad respecto de la vista visible (x0, y0, x1, y1)
+
+    Primero las que tocan la vista, luego por distancia a ella; a igual
+    distancia, la más cercana al centro de la vista.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    vx0, vy0, vx1, vy1 = viewport
+    gap_x = np.maximum(np.maximum(vx0 - boxes[:, 2], boxes[:, 0] - vx1), 0)
+    gap_y = np.maximum(np.maximum(vy0 - boxes[:, 3], boxes[:, 1] - vy1), 0)
+    center_x = (boxes[:, 0] + boxes[:, 2] - vx0 - vx1) / 2
+    center_y = (boxes[:, 1] + boxes[:, 3] - vy0 - vy1) / 2
+    return np.lexsort((np.hypot(center_x, center_y), np.hypot(gap_x, gap_y)))
+
+
+class JobCancelled(Exception):
+    """El trabajo dejó de ser el activo"""
+
+
+def _serve(model_path, threads, cpus, requests, results, active, viewport):
+    """Bucle del proceso de inferencia: carga el modelo y atiende trabajos hasta recibir None"""
+    from histopath_io import is_lazy_image, load_image
+
+    try:
+        engine = PathoNetEngine.from_file(model_path, threads, cpus)
+    except Exception as e:
+        results.put(("failed", 0, f"No se pudo cargar el modelo: {e}"))
+        return
+    results.put(("ready", 0, None))
+
+    while True:
+        job = requests.get()
+        if job is None:
+            return
+        job_id, image_path, regions = job
+        if active.value != job_id:
+            results.put(("cancelled", job_id, None))
+            continue
+
+        def check(done, total):
+            if active.value != job_id:
+                raise JobCancelled()
+
+        image = None
+        try:
+            image = load_image(image_path)
+            pending = np.arange(len(regions))
+            view = None
+            # Parches ya evaluados: los comparten las regiones vecinas del trabajo
+            cache = {}
+            for done in range(1, len(regions) + 1):
+                check(done, len(regions))
+                # Reordenar lo pendiente solo si la vista cambió
+                if tuple(viewport) != view:
+                    view = tuple(viewport)
+                    pending = pending[region_order([regions[i] for i in pending], view)]
+                box, pending = regions[pending[0]], pending[1:]
+                columns = engine.detect_region(image, box, check, cache)
+                results.put(("points", job_id, (done, len(regions), box, columns)))
+            results.put(("done", job_id, None))
+        except JobCancelled:
+            results.put(("cancelled", job_id, None))
+        except Exception as e:
+            results.put(("error", job_id, str(e)))
+        finally:
+            if image is not None and is_lazy_image(image):
+                image.close()
+
+
+class InferenceService:
+    """Proceso de inferencia con el modelo cargado y las colas para hablar con él
+
+    Los mensajes se leen con poll() desde el hilo de Tk: tuplas (tipo,
+    trabajo, dato) con tipo "ready", "failed", "points" ((regiones
+    hechas, total, caja, (xs, ys, labels))), "done", "cancelled" o "error".
+    """
+
+    def __init__(self, model_path, threads=INFERENCE_THREADS, cpus=INFERENCE_CPUS):
+        context = multiprocessing.get_context("spawn")
+        self.model_path = model_path
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.active = context.Value('q', 0, lock=False)
+        # Vista visible (x0, y0, x1, y1) en píxeles de la imagen
+        self.viewport = context.Array('d', 4, lock=False)
+        self.last_job = 0
+        self.process = context.Process(target=_serve, daemon=True,
+                                       args=(model_path, threads, cpus, self.requests, self.results,
+                                             self.active, self.viewport))
+        self.process.start()
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def submit(self, image_path, regions, viewport=None):
+        """Encola un trabajo, que reemplaza al activo -> identificador del trabajo"""
+        if viewport is not None:
+            self.set_viewport(viewport)
+        self.last_job += 1
+        self.active.value = self.last_job
+        self.requests.put((self.last_job, image_path, list(regions)))
+        return self.last_job
+
+    def set_viewport(self, box):
+        """Nueva vista visible: las regiones pendientes se reordenan antes de la próxima"""
+        self.viewport[:] = [float(v) for v in box]
+
+    def cancel(self):
+        """Descarta el trabajo activo; el proceso lo deja en la próxima comprobación"""
+        self.active.value = 0
+
+    def poll(self, limit=64):
+        """Mensajes ya recibidos, sin esperar (como mucho limit por llamada)"""
+        messages = []
+        try:
+            while len(messages) < limit:
+                messages.append(self.results.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+
+    def close(self):
+        """Detiene el proceso: termina el trabajo en curso y lo espera SHUTDOWN_TIMEOUT segundos"""
+        self.cancel()
+        try:
+            self.requests.put(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
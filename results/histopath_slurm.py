@@ -0,0 +1,213 @@
+"""
+Reparto de lotes de HistoPath Analyst en arreglos de trabajos SLURM.
+
+Cada tarea del arreglo (SLURM_ARRAY_TASK_ID) procesa un fragmento fijo de
+la lista de imágenes: la asignación depende solo de la ruta de cada
+imagen, así que es la misma en cada reenvío aunque el orden del listado
+cambie. Los resultados de cada fragmento van a archivos propios en el
+directorio de salida y un paso final (merge) los reúne.
+
+Las métricas de cada imagen terminada se añaden de inmediato al manifiesto
+del fragmento (un registro JSON por línea), de modo que al reenviar un
+trabajo interrumpido se saltan las ya calculadas. La exportación usa el
+manifiesto de histopath_export, uno por fragmento.
+
+    sbatch --array=0-15 slurm_jobs/histopath_metrics.sbatch
+    python histopath_slurm.py metrics "imgs/*.jpg" -o runs/metrics
+    python histopath_slurm.py merge runs/metrics -o metricas.csv
+
+Para probar en local basta con simular la tarea:
+
+    SLURM_ARRAY_TASK_ID=3 SLURM_ARRAY_TASK_COUNT=8 python histopath_slurm.py metrics ...
+"""
+import argparse
+import glob
+import json
+import os
+
+from histopath_cache import key_digest
+from histopath_export import (MANIFEST_NAME, MARKER_RADIUS, WORKER_MEMORY_MB, batch_export,
+                              find_annotated_images, read_manifest, write_manifest)
+from histopath_metrics import batch_metrics, expand_inputs, write_table
+
+SHARD_MANIFEST = "manifest-{index:04d}.jsonl"
+SHARD_TABLE = "shard-{index:04d}-of-{count:04d}.csv"
+EXPORT_SHARD_MANIFEST = ".histopath_export.shard-{index:04d}.json"
+
+
+def array_task(index=None, count=None):
+    """(índice, total) de la tarea: argumentos explícitos o variables de SLURM; (0, 1) fuera de un arreglo
+
+    El índice se cuenta desde SLURM_ARRAY_TASK_MIN, para admitir arreglos
+    que empiezan en 1 (--array=1-16).
+    """
+    env = os.environ
+    if index is None:
+        index = int(env.get("SLURM_ARRAY_TASK_ID", 0)) - int(env.get("SLURM_ARRAY_TASK_MIN", 0))
+    if count is None:
+        count = int(env.get("SLURM_ARRAY_TASK_COUNT", 1))
+    if not 0 <= index < count:
+        raise ValueError(f"Tarea {index} fuera del arreglo de {count} tareas")
+    return index, count
+
+
+def shard_of(item, count):
+    """Fragmento de un elemento: hash estable de su ruta, independiente del orden de la lista"""
+    return int(key_digest(os.path.normpath(item)), 16) % count
+
+
+def shard_items(pairs, index, count):
+    """Pares (imagen, anotaciones) que corresponden al fragmento index de count"""
+    return [pair for pair in pairs if shard_of(pair[0], count) == index]
+
+
+def _input_key(image_path, annotation_path):
+    """Identifica una entrada por ruta, tamaño y fecha: si cambia, se vuelve a calcular"""
+    stats = [(os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in (image_path, annotation_path)]
+    return key_digest(os.path.normpath(image_path), stats)
+
+
+def read_shard_manifest(path):
+    """Filas registradas por un fragmento -> {clave de entrada: fila}; ignora una última línea cortada"""
+    done = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                done[entry["key"]] = entry["row"]
+    return done
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def run_metrics_shard(inputs, output_dir, index, count, jobs=None, scale=None, stain=True, progress=None):
+    """Calcula las métricas del fragmento index/count y escribe su tabla -> (filas, calculadas ahora)
+
+    Las filas con error no se registran en el manifiesto: se reintentan al reenviar.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pairs = shard_items(expand_inputs(inputs), index, count)
+    manifest_path = os.path.join(output_dir, SHARD_MANIFEST.format(index=index))
+    done = read_shard_manifest(manifest_path)
+    keys = [_input_key(*pair) for pair in pairs]
+    pending = [i for i, key in enumerate(keys) if key not in done]
+
+    with open(manifest_path, 'a', encoding='utf-8') as manifest:
+        if manifest.tell() and not _ends_with_newline(manifest_path):
+            # Última línea cortada por una interrupción: los registros nuevos van en la siguiente
+            manifest.write("\n")
+
+        def record(i, row):
+            if 'error' not in row:
+                manifest.write(json.dumps({"key": keys[pending[i]], "row": row}, default=float) + "\n")
+                manifest.flush()
+                os.fsync(manifest.fileno())
+                done[keys[pending[i]]] = row
+
+        new_rows = batch_metrics([pairs[i] for i in pending], jobs, scale, stain, progress, on_row=record)
+
+    failed = {keys[pending[i]]: row for i, row in enumerate(new_rows) if 'error' in row}
+    rows = [done.get(key) or failed[key] for key in keys]
+    write_table(rows, os.path.join(output_dir, SHARD_TABLE.format(index=index, count=count)))
+    return rows, len(pending)
+
+
+def merge_metrics(output_dir, output_path):
+    """Reúne los manifiestos de todos los fragmentos en una tabla ordenada por imagen
+
+    Si una imagen se recalculó (cambió su entrada), vale su registro más reciente.
+    """
+    rows = {}
+    for path in sorted(glob.glob(os.path.join(output_dir, "manifest-*.jsonl"))):
+        for row in read_shard_manifest(path).values():
+            rows[row['image']] = row
+    ordered = sorted(rows.values(), key=lambda row: row['image'])
+    write_table(ordered, output_path)
+    return ordered
+
+
+def run_export_shard(directory, output_dir, index, count, radius=MARKER_RADIUS, jobs=None,
+                     memory_mb=WORKER_MEMORY_MB, progress=None):
+    """Exporta las superposiciones del fragmento index/count con su propio manifiesto"""
+    pairs = shard_items(find_annotated_images(directory), index, count)
+    return batch_export(directory, output_dir, radius, jobs=jobs, memory_mb=memory_mb, progress=progress,
+                        pairs=pairs, manifest_name=EXPORT_SHARD_MANIFEST.format(index=index))
+
+
+def merge_export(output_dir):
+    """Une los manifiestos de exportación de los fragmentos en el manifiesto general del directorio"""
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = read_manifest(manifest_path)
+    for path in sorted(glob.glob(os.path.join(output_dir, ".histopath_export.shard-*.json"))):
+        manifest.update(read_manifest(path))
+    write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def main(argv=None):
+    """Tarea de un arreglo SLURM: python histopath_slurm.py {metrics,export,merge} ..."""
+    parser = argparse.ArgumentParser(description="Lotes de HistoPath Analyst repartidos en arreglos SLURM")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_shard_options(command):
+        command.add_argument("-o", "--output-dir", required=True, help="Directorio de salida de los fragmentos")
+        command.add_argument("--shard", type=int, default=None, help="Índice del fragmento (por defecto SLURM_ARRAY_TASK_ID)")
+        command.add_argument("--shards", type=int, default=None, help="Número de fragmentos (por defecto SLURM_ARRAY_TASK_COUNT)")
+        command.add_argument("--jobs", type=int, default=None,
+                             help="Procesos en paralelo (por defecto SLURM_CPUS_PER_TASK o los núcleos)")
+
+    metrics = commands.add_parser("metrics", help="Métricas de un fragmento")
+    metrics.add_argument("inputs", nargs="+", help="Imágenes, globs o directorios")
+    metrics.add_argument("--scale", type=float, default=None, help="Escala en µm/píxel")
+    metrics.add_argument("--no-stain", action="store_true", help="Omite las métricas de tinción H-DAB")
+    add_shard_options(metrics)
+
+    export = commands.add_parser("export", help="Superposiciones de un fragmento")
+    export.add_argument("directory", help="Directorio con imágenes y anotaciones")
+    export.add_argument("--radius", type=int, default=MARKER_RADIUS, help="Radio de los marcadores en píxeles")
+    export.add_argument("--memory-mb", type=int, default=WORKER_MEMORY_MB, help="Memoria por proceso (MB)")
+    add_shard_options(export)
+
+    merge = commands.add_parser("merge", help="Reúne los resultados de todos los fragmentos")
+    merge.add_argument("output_dir", help="Directorio con los fragmentos")
+    merge.add_argument("-o", "--output", default=None,
+                       help="Tabla de métricas (.csv o .parquet); sin ella se unen los manifiestos de exportación")
+    args = parser.parse_args(argv)
+
+    if args.command == "merge":
+        if args.output:
+            rows = merge_metrics(args.output_dir, args.output)
+            print(f"{len(rows)} imágenes en {args.output}")
+        else:
+            manifest = merge_export(args.output_dir)
+            print(f"{len(manifest)} superposiciones registradas en {args.output_dir}")
+        return 0
+
+    index, count = array_task(args.shard, args.shards)
+    jobs = args.jobs or int(os.environ.get("SLURM_CPUS_PER_TASK", 0)) or None
+    print(f"Fragmento {index + 1}/{count}", flush=True)
+    if args.command == "metrics":
+        rows, computed = run_metrics_shard(args.inputs, args.output_dir, index, count, jobs,
+                                           args.scale, not args.no_stain)
+        failed = [(row['image'], row['error']) for row in rows if 'error' in row]
+        print(f"{len(rows)} imágenes ({computed} calculadas ahora, {len(rows) - computed} ya registradas), "
+              f"con error: {len(failed)}")
+    else:
+        summary = run_export_shard(args.directory, args.output_dir, index, count, args.radius, jobs,
+                                   args.memory_mb)
+        failed = summary["failed"]
+        print(f"Exportadas: {summary['exported']}, al día: {summary['skipped']}, con error: {len(failed)}")
+    for name, error in failed:
+        print(f"  {name}: {error}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,120 @@
+"""
+Tareas en segundo plano para HistoPath Analyst.
+
+Ejecuta cálculos largos en un hilo de trabajo y entrega resultados
+parciales, progreso y errores al hilo de Tk mediante root.after, de modo
+que la interfaz nunca queda bloqueada. La cancelación es cooperativa: el
+trabajo consulta la tarea en cada bloque y se detiene con TaskCancelled.
+"""
+import queue
+import threading
+
+
+class TaskCancelled(Exception):
+    """El usuario canceló la tarea en curso"""
+
+
+class BackgroundTask:
+    """Ejecuta target(task) en un hilo y despacha sus mensajes en el hilo de Tk
+
+    Dentro del hilo, target usa task.emit(clave, valor) para publicar
+    resultados parciales y task.progress(fracción, texto) para informar
+    avance; ambas llamadas lanzan TaskCancelled si la tarea fue cancelada.
+    """
+
+    POLL_MS = 50
+
+    def __init__(self, root, target, on_result=None, on_progress=None, on_done=None,
+                 on_error=None, on_cancel=None):
+        self.root = root
+        self.target = target
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self._queue = queue.Queue()
+        self._cancel_event = threading.Event()
+        self._thread = None
+        self.finished = False
+
+    # --- Lado del hilo de Tk ---
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.root.after(self.POLL_MS, self._poll)
+        return self
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def join(self, timeout=None):
+        """Espera a que termine el hilo de trabajo (sin despachar sus mensajes)"""
+        if self._thread:
+            self._thread.join(timeout)
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _poll(self):
+        try:
+            while True:
+                kind, key, value = self._queue.get_nowait()
+                if kind == "result" and self.on_result:
+                    self.on_result(key, value)
+                elif kind == "progress" and self.on_progress:
+                    self.on_progress(key, value)
+                elif kind == "done":
+                    self.finished = True
+                    if self.on_done:
+                        self.on_done()
+                elif kind == "cancelled":
+                    self.finished = True
+                    if self.on_cancel:
+                        self.on_cancel()
+                elif kind == "error":
+                    self.finished = True
+                    if self.on_error:
+                        self.on_error(value)
+        except queue.Empty:
+            pass
+        except Exception:
+            # Un error en un callback de la interfaz no debe detener el sondeo
+            import traceback
+            traceback.print_exc()
+        if not self.finished:
+            try:
+                self.root.after(self.POLL_MS, self._poll)
+            except Exception:
+                # La ventana principal se cerró: cancelar el trabajo
+                self.cancel()
+
+    # --- Lado del hilo de trabajo ---
+    def _run(self):
+        try:
+            self.target(self)
+            self._queue.put(("done", None, None))
+        except TaskCancelled:
+            self._queue.put(("cancelled", None, None))
+        except Exception as e:
+            self._queue.put(("error", None, e))
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise TaskCancelled()
+
+    def emit(self, key, value):
+        self.check_cancelled()
+        self._queue.put(("result", key, value))
+
+    def progress(self, fraction, text=""):
+        self.check_cancelled()
+        self._queue.put(("progress", fraction, text))
+
+    def progress_range(self, start, end, text=""):
+        """Callback de progreso (hecho, total) que se mapea al tramo [start, end]"""
+        def report(done, total):
+            fraction = start + (end - start) * (done / total if total else 1.0)
+            self.progress(fraction, text)
+        return report
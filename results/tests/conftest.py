@@ -0,0 +1,41 @@
+"""
+Utilidades comunes de las pruebas de HistoPath Analyst.
+
+Los módulos viven sueltos en results/, así que se agregan al camino de
+importación. synthetic_slide genera una imagen con núcleos marrones (DAB),
+azules (hematoxilina) y oscuros que el modelo de prueba (STUB_MODEL) detecta.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+NUCLEUS_COLORS = ((150, 70, 40), (60, 70, 190), (20, 20, 20))
+
+
+def make_slide(width, height, n_nuclei, seed=0):
+    """Arreglo RGB uint8 con núcleos circulares de radio 3-6 sobre fondo claro"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 235, dtype=np.uint8)
+    yy, xx = np.mgrid[:height, :width]
+    for _ in range(n_nuclei):
+        x, y, r = rng.uniform(0, width), rng.uniform(0, height), rng.uniform(3, 6)
+        color = NUCLEUS_COLORS[rng.integers(len(NUCLEUS_COLORS))]
+        x0, x1 = max(0, int(x - r)), min(width, int(x + r) + 2)
+        y0, y1 = max(0, int(y - r)), min(height, int(y + r) + 2)
+        disk = (xx[y0:y1, x0:x1] - x) ** 2 + (yy[y0:y1, x0:x1] - y) ** 2 <= r * r
+        image[y0:y1, x0:x1][disk] = color
+    return image
+
+
+@pytest.fixture
+def synthetic_slide(tmp_path):
+    """Ruta de un PNG sintético de 1300×900 con núcleos repartidos al azar"""
+    from PIL import Image
+
+    path = tmp_path / "slide.png"
+    Image.fromarray(make_slide(1300, 900, 700)).save(path)
+    return str(path)
@@ -0,0 +1,49 @@
+"""
+Pruebas de la caché de resultados en disco (histopath_cache.ResultCache).
+"""
+import os
+
+import pytest
+
+import histopath_cache
+from histopath_cache import ResultCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(histopath_cache, "CACHE_DIR", str(tmp_path))
+    return ResultCache("pruebas", max_bytes=10000)
+
+
+def directory_size(cache):
+    return sum(os.path.getsize(os.path.join(cache.directory, name)) for name in os.listdir(cache.directory))
+
+
+def test_get_or_compute(cache):
+    calls = []
+    assert cache.get_or_compute("a", lambda: calls.append(1) or {"n": 1}) == {"n": 1}
+    assert cache.get_or_compute("a", lambda: calls.append(1) or {"n": 2}) == {"n": 1}
+    assert calls == [1]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_overwriting_a_key_keeps_size_exact(cache):
+    for key in ("a", "b", "c"):
+        cache.put(key, b"x" * 2000)
+    for i in range(20):
+        cache.put("a", b"y" * (1000 + 50 * i))
+        assert cache._size == directory_size(cache)
+    # Reescribir una clave no debe expulsar a las demás antes de tiempo
+    assert cache.get("b") == b"x" * 2000
+    assert cache.get("c") == b"x" * 2000
+
+
+def test_eviction_removes_least_recently_used(cache):
+    for i, key in enumerate("abcde"):
+        cache.put(key, b"x" * 3000)
+        path = cache._path(key)
+        os.utime(path, ns=(i * 10 ** 9, i * 10 ** 9))
+    assert cache._size <= cache.max_bytes
+    assert cache._size == directory_size(cache)
+    assert cache.get("a") is None
+    assert cache.get("e") == b"x" * 3000
@@ -0,0 +1,134 @@
+"""
+Pruebas del motor de color (histopath_color).
+
+Las imágenes de prueba se componen a partir de concentraciones conocidas
+de hematoxilina y DAB con los vectores de Ruifrok & Johnston, de modo que
+la descomposición esperada se conoce de antemano.
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import make_slide
+from histopath_color import (HDAB_STAINS, ColorHistogram, ColorStatistics, StainDeconvolver, StainNormalizer,
+                             dominant_colors, normalize_stains)
+
+pytest.importorskip("cv2")
+
+
+def compose_hdab(height=300, width=400, seed=0):
+    """(imagen RGB uint8, concentraciones H y DAB) compuestas con la ley de Beer-Lambert"""
+    stains = normalize_stains(HDAB_STAINS)[:2].astype(np.float64)
+    rng = np.random.default_rng(seed)
+    conc = rng.gamma(2.0, 0.15, (height, width, 2)) * (rng.random((height, width, 1)) < 0.7)
+    image = np.clip(255 * 10 ** -(conc @ stains), 0, 255).round().astype(np.uint8)
+    return image, conc
+
+
+def test_deconvolution_recovers_known_concentrations():
+    image, conc = compose_hdab()
+    deconvolver = StainDeconvolver()
+    result = deconvolver.concentrations(image)
+
+    # Misma cuenta en float64 con la matriz de Ruifrok: solo difiere el redondeo a float32
+    od = -np.log10(np.maximum(image, 1) / 255.0)
+    expected = np.maximum(od @ np.linalg.inv(normalize_stains(HDAB_STAINS).astype(np.float64)), 0)
+    np.testing.assert_allclose(result, expected, atol=1e-4)
+
+    # Frente a las concentraciones de origen, el error es el de cuantizar a 8 bits
+    visible = image.min(axis=2) >= 20
+    np.testing.assert_allclose(result[visible][:, :2], conc[visible], atol=0.02)
+    assert np.abs(result[visible][:, 2]).max() < 0.02
+    np.testing.assert_allclose(deconvolver.channel(image, "DAB"), result[..., 1], atol=1e-6)
+
+
+def test_tiled_deconvolution_matches_untiled():
+    image = Image.fromarray(compose_hdab(333, 517)[0])
+    tiled, whole = StainDeconvolver(tile_size=64), StainDeconvolver(tile_size=4096)
+    for name in ("H", "DAB"):
+        np.testing.assert_array_equal(np.asarray(tiled.channel_image(image, name)),
+                                      np.asarray(whole.channel_image(image, name)))
+    tiled_stats, whole_stats = tiled.statistics(image), whole.statistics(image)
+    assert tiled_stats.keys() == whole_stats.keys()
+    for key in whole_stats:
+        assert tiled_stats[key] == pytest.approx(whole_stats[key], rel=1e-6)
+
+
+@pytest.mark.parametrize("method", StainNormalizer.METHODS)
+def test_normalizing_reference_onto_itself(method):
+    reference = Image.fromarray(compose_hdab()[0])
+    normalizer = StainNormalizer(method, tile_size=128).fit(reference)
+    difference = np.abs(np.asarray(normalizer.transform(reference)).astype(int) - np.asarray(reference))
+    assert difference.mean() < 0.5
+    assert np.percentile(difference, 99) <= 1
+
+
+def test_macenko_estimates_ruifrok_vectors():
+    reference = Image.fromarray(compose_hdab()[0])
+    stains = np.array(StainNormalizer("macenko").estimate(reference)['stains'])
+    ruifrok = normalize_stains(HDAB_STAINS)[:2]
+    # Hematoxilina primero, DAB segundo
+    assert (stains * ruifrok).sum(axis=1).min() > 0.98
+
+
+@pytest.mark.parametrize("method", StainNormalizer.METHODS)
+def test_normalization_is_independent_of_tiling(method):
+    reference = Image.fromarray(compose_hdab()[0])
+    image = Image.fromarray(make_slide(300, 260, 120, seed=4))
+    source = StainNormalizer(method).estimate(image)
+    results = [np.asarray(StainNormalizer(method, tile_size=tile_size).fit(reference)
+                          .transform(image, source=source)) for tile_size in (50, 4096)]
+    np.testing.assert_array_equal(*results)
+
+
+def test_low_tissue_estimate_raises():
+    blank = Image.new("RGB", (200, 200), (240, 240, 240))
+    with pytest.raises(ValueError):
+        StainNormalizer("macenko").estimate(blank)
+
+
+def test_dominant_colors_are_exact_means():
+    colors = np.array([[200, 40, 30], [30, 60, 190], [240, 240, 240], [20, 20, 20]], dtype=np.uint8)
+    counts = np.array([500, 2000, 12000, 1500])
+    pixels = np.repeat(colors, counts, axis=0).reshape(100, 160, 3)
+    found, fractions = dominant_colors(ColorHistogram.from_image(Image.fromarray(pixels), tile_size=64),
+                                       n_colors=4)
+    order = np.argsort(-counts)
+    np.testing.assert_array_equal(found, colors[order])
+    np.testing.assert_allclose(fractions, counts[order] / counts.sum())
+
+    # Con más colores que grupos, cada color es la media ponderada de sus píxeles
+    found, fractions = dominant_colors(ColorHistogram.from_image(Image.fromarray(pixels)), n_colors=2)
+    assert fractions.sum() == pytest.approx(1.0)
+    assert len(found) == 2
+
+
+def test_color_statistics_are_exact():
+    pixels = make_slide(257, 190, 150, seed=5)
+    stats = ColorStatistics.from_image(Image.fromarray(pixels), tile_size=64)
+    flat = pixels.reshape(-1, 3)
+    assert stats.total == len(flat)
+    np.testing.assert_allclose(stats.mean, flat.mean(axis=0))
+    np.testing.assert_allclose(stats.covariance, np.cov(flat, rowvar=False, bias=True), atol=1e-6)
+    for q in (0, 1, 25, 50, 90, 99, 100):
+        np.testing.assert_array_equal(stats.percentile(q), np.percentile(flat, q, axis=0, method="inverted_cdf"))
+    # El histograma no depende del tamaño de bloque
+    whole = ColorStatistics.from_image(Image.fromarray(pixels), tile_size=4096)
+    np.testing.assert_array_equal(stats.rgb_hist, whole.rgb_hist)
+    np.testing.assert_array_equal(stats.hsv_hist, whole.hsv_hist)
+    np.testing.assert_array_equal(stats.color_hist.counts, whole.color_hist.counts)
+
+
+def test_reservoir_sample_is_uniform_and_reproducible():
+    # Mitad superior negra, mitad inferior blanca: la muestra debe repartirse por igual
+    pixels = np.zeros((400, 300, 3), dtype=np.uint8)
+    pixels[200:] = 255
+    image = Image.fromarray(pixels)
+    stats = ColorStatistics.from_image(image, tile_size=50, n_samples=4000, seed=7, color_hist=False)
+    assert stats.sample.shape == (4000, 3)
+    assert abs(np.mean(stats.sample[:, 0] == 255) - 0.5) < 0.03
+    again = ColorStatistics.from_image(image, tile_size=50, n_samples=4000, seed=7, color_hist=False)
+    np.testing.assert_array_equal(stats.sample, again.sample)
+
+    small = ColorStatistics.from_image(Image.fromarray(pixels[:10, :10]), n_samples=4000)
+    assert small.sample.shape == (100, 3)
@@ -0,0 +1,83 @@
+"""
+Pruebas de la comprobación de paridad y del descarte de modelos (histopath_convert).
+
+La paridad se evalúa con el modelo de prueba (STUB_MODEL), que no necesita
+TensorFlow ni onnxruntime.
+"""
+import csv
+
+import numpy as np
+import pytest
+
+from histopath_convert import _matched_fraction, discard_model, main, parity_check, split_references
+from histopath_inference import STUB_MODEL
+from histopath_project import LABEL_IDS
+
+
+def test_stub_parity_with_itself(synthetic_slide):
+    rows, passed = parity_check(STUB_MODEL, STUB_MODEL, [synthetic_slide], threads=1, cpus=1)
+    assert passed
+    (row,) = rows
+    assert row['image'] == synthetic_slide
+    assert row['max_count_difference'] == 0.0
+    assert row['matched_fraction'] == 1.0
+    assert sum(row[f'n_{name}_reference'] for name in LABEL_IDS) > 100
+    for name in LABEL_IDS:
+        assert row[f'n_{name}_candidate'] == row[f'n_{name}_reference']
+
+
+def test_parity_command_writes_table(synthetic_slide, tmp_path):
+    output = tmp_path / "paridad.csv"
+    assert main(["parity", STUB_MODEL, STUB_MODEL, synthetic_slide, "-o", str(output),
+                 "--threads", "1", "--cpus", "1"]) == 0
+    with open(output, newline='', encoding='utf-8') as f:
+        (row,) = list(csv.DictReader(f))
+    assert row['passed'] == "True"
+
+
+def test_matched_fraction():
+    xs, ys = np.array([10.0, 50.0, 90.0, 130.0]), np.array([10.0, 10.0, 10.0, 10.0])
+    labels = np.array([1, 1, 2, 2])
+    assert _matched_fraction((xs, ys, labels), (xs + 1, ys, labels)) == 1.0
+    # Misma posición pero otra clase no cuenta; lejos tampoco
+    assert _matched_fraction((xs, ys, labels), (xs, ys, 3 - labels)) == 0.0
+    assert _matched_fraction((xs, ys, labels), (xs + 100, ys + 100, labels)) == 0.0
+    assert _matched_fraction((xs[:0], ys[:0], labels[:0]), (xs, ys, labels)) == 1.0
+
+
+def test_split_references_is_disjoint_and_order_independent():
+    images = [f"ref/{i:02d}.jpg" for i in range(7)]
+    calibration, holdout = split_references(reversed(images))
+    assert (calibration, holdout) == split_references(images)
+    assert not set(calibration) & set(holdout)
+    assert sorted(calibration + holdout) == images
+    assert len(holdout) == 3
+    with pytest.raises(ValueError):
+        split_references(images[:1])
+
+
+def test_quantize_rejects_overlapping_holdout(capsys):
+    with pytest.raises(SystemExit):
+        main(["quantize", "modelo.onnx", "--reference", "a.jpg", "b.jpg", "--holdout", "b.jpg"])
+    assert "--holdout" in capsys.readouterr().err
+    with pytest.raises(SystemExit):
+        main(["quantize", "modelo.onnx", "--reference", "a.jpg"])
+
+
+def test_discard_model_keeps_source_config(tmp_path):
+    source = tmp_path / "pathonet.onnx"
+    source_config = tmp_path / "pathonet.json"
+    quantized = tmp_path / "pathonet.int8.onnx"
+    for path in (source, source_config, quantized):
+        path.write_text("{}")
+    # La versión int8 comparte el .json de su origen: no se borra
+    discard_model(str(quantized), str(source))
+    assert not quantized.exists() and source_config.exists()
+
+    # Un .json copiado junto a un modelo con otro nombre sí se borra
+    other, other_config = tmp_path / "salida.onnx", tmp_path / "salida.json"
+    other.write_text("{}")
+    other_config.write_text("{}")
+    discard_model(str(other), str(source))
+    assert not other.exists() and not other_config.exists()
+    assert source.exists() and source_config.exists()
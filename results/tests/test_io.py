@@ -0,0 +1,64 @@
+"""
+Pruebas de lectura por niveles de los TIFF piramidales (histopath_io).
+
+Cada nivel escrito por write_pyramid debe coincidir con la imagen completa
+decodificada y reducida por el mismo factor.
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import make_slide
+
+pytest.importorskip("tifffile")
+
+from histopath_io import TileCache, TiledImage, load_image, write_pyramid  # noqa: E402
+
+BOXES = [(0, 0, 1300, 900), (128, 256, 640, 512), (1000, 600, 1300, 900), (44, 8, 940, 852)]
+
+
+@pytest.fixture
+def pyramid(tmp_path):
+    """(imagen PIL original, ruta del TIFF piramidal con niveles 1:1, 1:2 y 1:4)"""
+    original = Image.fromarray(make_slide(1300, 900, 400))
+    path = write_pyramid(original, str(tmp_path / "slide.tif"), tile_size=128, min_size=256)
+    return original, path
+
+
+@pytest.mark.parametrize("factor", [1, 2, 4])
+@pytest.mark.parametrize("box", BOXES)
+def test_level_crop_matches_full_decode(pyramid, box, factor):
+    original, path = pyramid
+    image = load_image(path, lazy_min_pixels=1)
+    try:
+        assert isinstance(image, TiledImage)
+        assert image.level_count == 3
+        assert image.best_level(factor) == {1: 0, 2: 1, 4: 2}[factor]
+        expected = np.asarray(original.crop(box).reduce(factor))
+        np.testing.assert_array_equal(image.read_region(box, factor), expected)
+        np.testing.assert_array_equal(np.asarray(image.region(box, factor)), expected)
+    finally:
+        image.close()
+
+
+def test_full_decode_matches_original(pyramid):
+    original, path = pyramid
+    image = TiledImage(path)
+    try:
+        np.testing.assert_array_equal(np.asarray(image.to_image()), np.asarray(original))
+        tiles = {(x, y): tile for x, y, tile in image.iter_tiles(300)}
+        np.testing.assert_array_equal(tiles[(300, 600)], np.asarray(original.crop((300, 600, 600, 900))))
+    finally:
+        image.close()
+
+
+def test_close_discards_cached_tiles(pyramid):
+    _, path = pyramid
+    cache = TileCache()
+    other = ((path + ".otro", 0, 0), 0, 0, 1)
+    cache.put(other, np.zeros((4, 4, 3), dtype=np.uint8))
+    image = TiledImage(path, cache=cache)
+    image.read_region((0, 0, 1300, 900), 2)
+    assert len(cache._entries) > 1
+    image.close()
+    assert list(cache._entries) == [other]
@@ -0,0 +1,251 @@
+"""
+Pruebas de los formatos de anotaciones y de proyecto (histopath_project).
+
+Son los caminos de persistencia: un error aquí pierde anotaciones, así que
+se prueban los viajes de ida y vuelta, los cortes de bloque del lector en
+streaming y los archivos que no son anotaciones.
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+import histopath_project
+from histopath_project import (JOURNAL_PREV_SUFFIX, JOURNAL_SUFFIX, AnnotationJournal, append_annotations,
+                               apply_journal, atomic_write, columns_to_points, find_annotations,
+                               is_binary_project, pending_journal, points_to_columns, read_annotations,
+                               read_journal, read_points, read_project, read_project_metadata,
+                               write_annotations, write_project)
+
+METADATA = {"project_name": "Caso 12", "image_path": "/datos/caso12.svs", "calibration_scale": 0.2527,
+            "filter": "NONE", "journal_generation": 3}
+
+
+def sample_columns(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.integers(0, 100000, n).astype(np.int32), rng.integers(0, 100000, n).astype(np.int32),
+            rng.integers(1, 4, n).astype(np.uint8))
+
+
+def assert_columns_equal(actual, expected):
+    for a, e in zip(actual, expected):
+        np.testing.assert_array_equal(a, e)
+        assert a.dtype == e.dtype
+
+
+@pytest.mark.parametrize("name", ["anotaciones.json", "anotaciones.jsonl"])
+@pytest.mark.parametrize("chunk", [7, 23, 64, 1 << 16])
+def test_streaming_read_across_chunk_boundaries(tmp_path, monkeypatch, name, chunk):
+    columns = sample_columns()
+    path = str(tmp_path / name)
+    write_annotations(path, *columns)
+    # Con bloques pequeños casi todos los cortes caen dentro de un registro
+    monkeypatch.setattr(histopath_project, "STREAM_CHUNK", chunk)
+    assert_columns_equal(read_annotations(path), columns)
+
+
+@pytest.mark.parametrize("chunk", [5, 16, 1 << 16])
+def test_streaming_read_of_other_layouts(tmp_path, monkeypatch, chunk):
+    """Arreglo en una línea, objetos con claves extra anidadas y nulls descartados como en la carga original"""
+    annotations = [{"x": i, "y": 2 * i, "label_id": 1 + i % 3, "extra": {"nota": "a}b", "n": [i]}}
+                   for i in range(40)]
+    annotations.insert(5, {"x": None, "y": 3, "label_id": 1})
+    path = tmp_path / "anotaciones.json"
+    path.write_text(json.dumps(annotations), encoding="utf-8")
+    monkeypatch.setattr(histopath_project, "STREAM_CHUNK", chunk)
+    xs, ys, labels = read_annotations(str(path))
+    assert xs.tolist() == list(range(40))
+    assert ys.tolist() == [2 * i for i in range(40)]
+    assert labels.tolist() == [1 + i % 3 for i in range(40)]
+
+
+def test_jsonl_append(tmp_path):
+    first, second = sample_columns(30, seed=1), sample_columns(20, seed=2)
+    path = str(tmp_path / "registro.jsonl")
+    write_annotations(path, *first)
+    append_annotations(path, *second)
+    append_annotations(path, *sample_columns(0))
+    expected = [np.concatenate([a, b]) for a, b in zip(first, second)]
+    assert_columns_equal(read_annotations(path), expected)
+
+
+def test_empty_annotation_sets_round_trip(tmp_path):
+    for name in ("vacio.json", "vacio.jsonl"):
+        path = str(tmp_path / name)
+        write_annotations(path, *sample_columns(0))
+        assert all(len(column) == 0 for column in read_annotations(path))
+
+
+@pytest.mark.parametrize("name, content", [
+    ("objeto.json", '{"a": 1}'),
+    ("vacio.json", ""),
+    ("blanco.json", "  \n\n"),
+    ("proyecto.json", json.dumps({"image_path": "a.png", "annotations": [{"x": 1, "y": 2, "label_id": 1}]})),
+    ("proyecto.jsonl", json.dumps({"image_path": "a.png", "annotations": [{"x": 1, "y": 2, "label_id": 1}]})),
+    ("lineas.json", '{"x": 1, "y": 2, "label_id": 1}\n{"x": 3, "y": 4, "label_id": 2}\n'),
+    ("ajeno.json", '[{"x": 1, "y": 2, "label_id": 1}, {"nombre": "otro"}]'),
+    ("ajeno.jsonl", '{"x": 1, "y": 2, "label_id": 1}\n{"nombre": "otro"}\n'),
+    ("numeros.json", "[1, 2, 3]"),
+    ("cortado.json", '[{"x": 1, "y": 2, "label_id": 1}, {"x": 3, "y"'),
+    ("cortado.jsonl", '{"x": 1, "y": 2, "label_id": 1}\n{"x": 3, "y"'),
+])
+def test_non_annotation_files_raise(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_text(content, encoding="utf-8")
+    with pytest.raises(ValueError):
+        read_annotations(str(path))
+
+
+@pytest.mark.parametrize("name", ["caso.hpz", "caso.hpa"])
+def test_project_round_trip(tmp_path, name):
+    columns = sample_columns(2000)
+    path = str(tmp_path / name)
+    write_project(path, METADATA, *columns)
+    assert is_binary_project(path) == name.endswith(".hpz")
+    metadata, *read_columns = read_project(path)
+    assert_columns_equal(read_columns, columns)
+    assert metadata == dict(METADATA, version="1.3")
+    assert read_project_metadata(path) == metadata
+    assert_columns_equal(read_points(path), columns)
+
+
+def test_empty_project_round_trip(tmp_path):
+    for name in ("vacio.hpz", "vacio.hpa"):
+        path = str(tmp_path / name)
+        write_project(path, {}, *sample_columns(0))
+        metadata, *columns = read_project(path)
+        assert metadata == {"version": "1.3"}
+        assert all(len(column) == 0 for column in columns)
+
+
+def test_binary_project_recognized_by_content(tmp_path):
+    """Un .hpz renombrado a .hpa se sigue leyendo como binario"""
+    columns = sample_columns(50)
+    path = str(tmp_path / "caso.hpz")
+    write_project(path, METADATA, *columns)
+    renamed = str(tmp_path / "caso.hpa")
+    os.replace(path, renamed)
+    assert_columns_equal(read_project(renamed)[1:], columns)
+
+
+def test_atomic_write_keeps_previous_file_on_error(tmp_path):
+    path = tmp_path / "caso.hpa"
+    path.write_text("anterior", encoding="utf-8")
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path)) as f:
+            f.write("a medias")
+            raise RuntimeError("disco lleno")
+    assert path.read_text(encoding="utf-8") == "anterior"
+    assert os.listdir(tmp_path) == ["caso.hpa"]
+
+    with atomic_write(str(path), 'wb') as f:
+        f.write(b"nuevo")
+    assert path.read_bytes() == b"nuevo"
+    assert os.listdir(tmp_path) == ["caso.hpa"]
+
+
+def test_find_annotations_prefers_project(tmp_path):
+    image = tmp_path / "caso.png"
+    image.write_bytes(b"")
+    assert find_annotations(str(image)) is None
+    write_annotations(str(tmp_path / "caso.jsonl"), *sample_columns(3))
+    assert find_annotations(str(image)) == str(tmp_path / "caso.jsonl")
+    write_project(str(tmp_path / "caso.hpz"), METADATA, *sample_columns(3))
+    assert find_annotations(str(image)) == str(tmp_path / "caso.hpz")
+
+
+def saved_points(path):
+    """Marcadores del proyecto en disco con las ediciones pendientes del diario aplicadas"""
+    point_lists = columns_to_points(*read_project(path)[1:])
+    apply_journal(point_lists, pending_journal(path))
+    return {label_id: sorted((int(x), int(y)) for x, y, _ in points) for label_id, points in point_lists.items()}
+
+
+def compact(path, journal, point_lists):
+    """Compactación como en la aplicación: rotar, escribir el proyecto y descartar lo apartado"""
+    generation = journal.generation + 1
+    journal.rotate(generation)
+    write_project(path, dict(METADATA, journal_generation=generation), *points_to_columns(point_lists))
+    journal.finish_rotation(generation)
+
+
+def test_journal_replay_ignores_truncated_last_record(tmp_path):
+    path = str(tmp_path / "caso.hpz")
+    write_project(path, dict(METADATA, journal_generation=0), [10, 20], [10, 20], [1, 2])
+    journal = AnnotationJournal(path, 0)
+    journal.record("add", 3, 30.6, 31.2)
+    journal.record("delete", 1, 10.0, 10.0)
+    journal.record_batch([40, 50], [41, 51], [2, 2])
+    journal.record("add", 1, 60, 61)
+    assert journal.pending == 5
+    journal.close()
+    # Cierre inesperado a mitad de la última línea
+    with open(path + JOURNAL_SUFFIX, 'r+', encoding='utf-8') as f:
+        content = f.read()
+        f.seek(0)
+        f.truncate()
+        f.write(content[:-12])
+    assert [entry["op"] for entry in pending_journal(path)] == ["add", "delete", "add_batch"]
+    assert saved_points(path) == {1: [], 2: [(20, 20), (40, 41), (50, 51)], 3: [(30, 31)]}
+
+
+def test_journal_clear_and_unknown_labels(tmp_path):
+    point_lists = {1: [(1, 1, None)], 2: [], 3: [(3, 3, None)]}
+    records = [{"op": "clear"}, {"op": "add", "label_id": 9, "x": 0, "y": 0},
+               {"op": "add_batch", "x": [5, 6], "y": [5, 6], "label_id": [1, 9]}]
+    assert apply_journal(point_lists, records) == 2
+    assert point_lists == {1: [(5, 5, None)], 2: [], 3: []}
+
+
+def test_journal_replay_after_rotation(tmp_path):
+    path = str(tmp_path / "caso.hpz")
+    point_lists = {1: [], 2: [], 3: []}
+    write_project(path, dict(METADATA, journal_generation=0), *points_to_columns(point_lists))
+    journal = AnnotationJournal(path, 0)
+    journal.record("add", 1, 1, 1)
+    point_lists[1].append((1, 1, None))
+    compact(path, journal, point_lists)
+    assert not os.path.exists(path + JOURNAL_PREV_SUFFIX)
+    assert pending_journal(path) == []
+
+    # Rotación sin proyecto escrito (cierre durante la compactación): .prev conserva las ediciones
+    journal.record("add", 2, 2, 2)
+    journal.rotate(2)
+    journal.record("add", 3, 3, 3)
+    journal.close()
+    assert os.path.exists(path + JOURNAL_PREV_SUFFIX)
+    records, max_generation = read_journal(path, 1)
+    assert [entry["label_id"] for entry in records] == [2, 3]
+    assert max_generation == 2
+    assert saved_points(path) == {1: [(1, 1)], 2: [(2, 2)], 3: [(3, 3)]}
+
+
+def test_rotation_keeps_prev_until_its_generation_is_written(tmp_path):
+    path = str(tmp_path / "caso.hpz")
+    write_project(path, dict(METADATA, journal_generation=0), [], [], [])
+    journal = AnnotationJournal(path, 0)
+    journal.record("add", 1, 1, 1)
+    journal.rotate(1)
+    journal.record("add", 1, 2, 2)
+    journal.rotate(2)
+    # El proyecto de la generación 1 llega tarde: .prev aún tiene ediciones de la 1
+    journal.finish_rotation(1)
+    assert os.path.exists(path + JOURNAL_PREV_SUFFIX)
+    journal.close()
+    assert saved_points(path)[1] == [(1, 1), (2, 2)]
+
+
+def test_reopening_journal_sets_previous_edits_aside(tmp_path):
+    path = str(tmp_path / "caso.hpz")
+    write_project(path, dict(METADATA, journal_generation=0), [], [], [])
+    journal = AnnotationJournal(path, 0)
+    journal.record("add", 2, 7, 7)
+    journal.close()
+    # Abrir otro diario en la misma ruta no trunca ni borra el anterior
+    journal = AnnotationJournal(path, 0)
+    journal.record("add", 2, 8, 8)
+    journal.close()
+    journal = AnnotationJournal(path, 0)
+    journal.close()
+    assert saved_points(path)[2] == [(7, 7), (8, 8)]
@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from histopath_inference import STUB_MODEL, PathoNetEngine, StubModel
+from histopath_service import InferenceService, region_grid, region_order
+
+from conftest import make_slide
+
+
+def as_rows(columns):
+    return sorted(zip(*(np.asarray(c).tolist() for c in columns)))
+
+
+@pytest.mark.parametrize("region_size", [1024, 300, 97])
+def test_regions_union_equals_detect(synthetic_slide, region_size):
+    image = Image.open(synthetic_slide).convert("RGB")
+    engine = PathoNetEngine(StubModel(), threads=2)
+    expected = as_rows(engine.detect(image))
+    assert expected
+    cache = {}
+    # Orden inverso: el resultado no debe depender del orden de las regiones
+    regions = region_grid(*image.size, region_size)[::-1]
+    found = [engine.detect_region(image, box, cache=cache) for box in regions]
+    assert as_rows([np.concatenate(c) for c in zip(*found)]) == expected
+    # Cada parche de la imagen se evaluó una sola vez
+    assert len(cache) == len(engine.patch_boxes(*image.size))
+
+
+def test_region_smaller_than_patch():
+    image = Image.fromarray(make_slide(200, 150, 40, seed=3))
+    engine = PathoNetEngine(StubModel(), threads=1)
+    found = [engine.detect_region(image, box) for box in region_grid(*image.size, 64)]
+    assert as_rows([np.concatenate(c) for c in zip(*found)]) == as_rows(engine.detect(image))
+
+
+def test_region_order_starts_at_viewport():
+    boxes = region_grid(5000, 5000, 1024)
+    order = region_order(boxes, (2100, 2100, 2900, 2900))
+    assert boxes[order[0]] == (2048, 2048, 3072, 3072)
+    # Las vecinas (a distancia 0 de la vista o tocándola) antes que las lejanas
+    neighbours = {(x, y, x + 1024, y + 1024) for x in (1024, 2048, 3072) for y in (1024, 2048, 3072)}
+    assert set(boxes[i] for i in order[1:9]) == neighbours - {(2048, 2048, 3072, 3072)}
+    assert boxes[order[-1]] in {(0, 0, 1024, 1024), (4096, 0, 5000, 1024), (0, 4096, 1024, 5000),
+                                (4096, 4096, 5000, 5000)}
+
+
+def test_service_matches_detect(synthetic_slide):
+    image = Image.open(synthetic_slide).convert("RGB")
+    expected = as_rows(PathoNetEngine(StubModel(), threads=2).detect(image))
+    service = InferenceService(STUB_MODEL, threads=2, cpus=2)
+    try:
+        regions = region_grid(*image.size, 256)
+        job = service.submit(synthetic_slide, regions, viewport=(1000, 600, 1300, 900))
+        found, first_box = [], None
+        for _ in range(6000):
+            messages = service.poll()
+            kinds = [kind for kind, job_id, _ in messages if job_id == job]
+            for kind, job_id, data in messages:
+                if kind == "points" and job_id == job:
+                    first_box = first_box or data[2]
+                    found.append(data[3])
+                assert kind not in ("failed", "error"), data
+            if "done" in kinds:
+                break
+            time.sleep(0.01)
+        assert len(found) == len(regions)
+        # Primero la región más cercana al centro de la vista
+        assert first_box == (1024, 768, 1280, 900)
+        assert as_rows([np.concatenate(c) for c in zip(*found)]) == expected
+    finally:
+        service.close()
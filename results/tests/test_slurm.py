@@ -0,0 +1,98 @@
+"""
+Pruebas del reparto en fragmentos de histopath_slurm.
+
+La asignación debe ser estable (independiente del orden del listado) y
+cubrir cada imagen exactamente una vez; un fragmento reenviado retoma
+desde su manifiesto sin recalcular lo ya registrado.
+"""
+import csv
+import os
+import random
+
+import pytest
+from PIL import Image
+
+from conftest import make_slide
+from histopath_project import write_annotations
+from histopath_slurm import (SHARD_MANIFEST, SHARD_TABLE, array_task, merge_metrics, read_shard_manifest,
+                             run_metrics_shard, shard_of, shard_items)
+
+PAIRS = [(f"lote/{i // 50}/img_{i:03d}.png", f"lote/{i // 50}/img_{i:03d}.jsonl") for i in range(200)]
+
+
+@pytest.mark.parametrize("count", [1, 3, 8])
+def test_shards_cover_every_item_once(count):
+    shards = [shard_items(PAIRS, index, count) for index in range(count)]
+    assigned = [pair for shard in shards for pair in shard]
+    assert sorted(assigned) == sorted(PAIRS)
+    assert len(assigned) == len(set(assigned))
+    if count > 1:
+        assert all(shards)
+
+
+def test_shard_assignment_is_stable():
+    shuffled = PAIRS[:]
+    random.Random(1).shuffle(shuffled)
+    for index in range(4):
+        assert sorted(shard_items(shuffled, index, 4)) == sorted(shard_items(PAIRS, index, 4))
+    # Solo cuenta la ruta normalizada de la imagen, no su forma ni sus anotaciones
+    assert shard_of("lote/0/./img_000.png", 5) == shard_of("lote/0/img_000.png", 5)
+    assert [shard_of(path, 7) for path, _ in PAIRS] == [shard_of(path, 7) for path, _ in PAIRS]
+
+
+def test_array_task(monkeypatch):
+    for name in ("SLURM_ARRAY_TASK_ID", "SLURM_ARRAY_TASK_COUNT", "SLURM_ARRAY_TASK_MIN"):
+        monkeypatch.delenv(name, raising=False)
+    assert array_task() == (0, 1)
+    assert array_task(2, 4) == (2, 4)
+    monkeypatch.setenv("SLURM_ARRAY_TASK_ID", "5")
+    monkeypatch.setenv("SLURM_ARRAY_TASK_COUNT", "16")
+    monkeypatch.setenv("SLURM_ARRAY_TASK_MIN", "1")
+    assert array_task() == (4, 16)
+    with pytest.raises(ValueError):
+        array_task(16, 16)
+
+
+@pytest.fixture
+def annotated_dir(tmp_path, monkeypatch):
+    """Directorio con seis imágenes pequeñas y sus anotaciones; caché de resultados aislada"""
+    monkeypatch.setenv("HISTOPATH_CACHE", str(tmp_path / "cache"))
+    directory = tmp_path / "imgs"
+    directory.mkdir()
+    for i in range(6):
+        Image.fromarray(make_slide(96, 64, 10, seed=i)).save(directory / f"img_{i}.png")
+        write_annotations(str(directory / f"img_{i}.jsonl"), [10.0, 20.0 + i, 30.0], [12.0, 14.0, 40.0],
+                          [1, 2, 3])
+    return directory
+
+
+def test_shard_resumes_from_manifest(annotated_dir, tmp_path):
+    inputs, output_dir = [str(annotated_dir)], str(tmp_path / "runs")
+    count = 2
+    first = {index: run_metrics_shard(inputs, output_dir, index, count, jobs=1, stain=False)
+             for index in range(count)}
+    assert sum(computed for _, computed in first.values()) == 6
+    assert all('error' not in row for rows, _ in first.values() for row in rows)
+
+    # Reenvío: nada que calcular, misma tabla reconstruida desde el manifiesto
+    for index in range(count):
+        rows, computed = run_metrics_shard(inputs, output_dir, index, count, jobs=1, stain=False)
+        assert computed == 0
+        assert [row['image'] for row in rows] == [row['image'] for row in first[index][0]]
+        assert os.path.exists(os.path.join(output_dir, SHARD_TABLE.format(index=index, count=count)))
+
+    # Un registro cortado (trabajo interrumpido) se ignora y esa imagen se recalcula
+    manifest_path = os.path.join(output_dir, SHARD_MANIFEST.format(index=0))
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines[:-1])
+        f.write(lines[-1][:len(lines[-1]) // 2])
+    assert len(read_shard_manifest(manifest_path)) == len(lines) - 1
+    _, computed = run_metrics_shard(inputs, output_dir, 0, count, jobs=1, stain=False)
+    assert computed == 1
+
+    merged = merge_metrics(output_dir, str(tmp_path / "metricas.csv"))
+    assert [os.path.basename(row['image']) for row in merged] == [f"img_{i}.png" for i in range(6)]
+    with open(tmp_path / "metricas.csv", newline='', encoding='utf-8') as f:
+        assert len(list(csv.DictReader(f))) == 6